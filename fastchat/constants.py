@@ -33,7 +33,14 @@ CONTROLLER_HEART_BEAT_EXPIRATION = int(
     os.getenv("FASTCHAT_CONTROLLER_HEART_BEAT_EXPIRATION", 90)
 )
 WORKER_HEART_BEAT_INTERVAL = int(os.getenv("FASTCHAT_WORKER_HEART_BEAT_INTERVAL", 45))
+WORKER_TELEMETRY_INTERVAL = float(os.getenv("FASTCHAT_WORKER_TELEMETRY_INTERVAL", 2))
+# A worker whose channel stays silent this long is removed by the controller.
+WORKER_CHANNEL_TIMEOUT = float(os.getenv("FASTCHAT_WORKER_CHANNEL_TIMEOUT", 10))
 WORKER_API_TIMEOUT = int(os.getenv("FASTCHAT_WORKER_API_TIMEOUT", 100))
+# Requests beyond the concurrency limit of a worker wait in its queue. Full
+# queues and long waits are rejected with ENGINE_OVERLOADED.
+WORKER_MAX_QUEUE_SIZE = int(os.getenv("FASTCHAT_WORKER_MAX_QUEUE_SIZE", 1024))
+WORKER_MAX_QUEUE_TIME = float(os.getenv("FASTCHAT_WORKER_MAX_QUEUE_TIME", 60))
 WORKER_API_EMBEDDING_BATCH_SIZE = int(
     os.getenv("FASTCHAT_WORKER_API_EMBEDDING_BATCH_SIZE", 4)
 )
@@ -7,6 +7,8 @@ import re
 import torch
 from transformers.generation.logits_process import LogitsProcessor
 
+from fastchat.utils import IncrementalDetokenizer
+
 
 class InvalidScoreLogitsProcessor(LogitsProcessor):
     def __call__(
@@ -102,16 +104,21 @@ def generate_stream_chatglm(
     if temperature > 1e-5:
         gen_kwargs["temperature"] = temperature
 
+    detokenizer = IncrementalDetokenizer(
+        tokenizer,
+        0 if echo else input_echo_len,
+        skip_special_tokens=False,
+        spaces_between_special_tokens=True,
+        clean_up_tokenization_spaces=None,
+    )
+    token_ids = []
     total_len = 0
     for total_ids in model.stream_generate(**inputs, **gen_kwargs):
-        total_ids = total_ids.tolist()[0]
-        total_len = len(total_ids)
-        if echo:
-            output_ids = total_ids
-        else:
-            output_ids = total_ids[input_echo_len:]
-        response = tokenizer.decode(output_ids)
-        response = process_response(response)
+        # Only convert and decode the tokens generated since the last step.
+        token_ids.extend(total_ids[0, len(token_ids) :].tolist())
+        total_len = len(token_ids)
+        detokenizer.update(token_ids)
+        response = process_response(detokenizer.text)
 
         yield {
             "text": response,
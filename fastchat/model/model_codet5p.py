@@ -6,9 +6,10 @@ from transformers import (
     GenerationConfig,
     StoppingCriteria,
     StoppingCriteriaList,
-    TextIteratorStreamer,
 )
 
+from fastchat.utils import IncrementalTextIteratorStreamer
+
 
 @torch.inference_mode()
 def generate_stream_codet5p(
@@ -30,7 +31,7 @@ def generate_stream_codet5p(
     stop_token_ids.append(tokenizer.eos_token_id)
 
     decode_config = dict(skip_special_tokens=True, clean_up_tokenization_spaces=True)
-    streamer = TextIteratorStreamer(tokenizer, **decode_config)
+    streamer = IncrementalTextIteratorStreamer(tokenizer, **decode_config)
     encoding = tokenizer(prompt, return_tensors="pt").to(device)
     input_ids = encoding.input_ids
     encoding["decoder_input_ids"] = encoding["input_ids"].clone()
@@ -1,12 +1,11 @@
 import gc
 from threading import Thread
-from typing import Iterable
 
 import torch
 import transformers
-from transformers import TextIteratorStreamer, GenerationConfig
+from transformers import GenerationConfig
 
-from fastchat.utils import is_partial_stop
+from fastchat.utils import IncrementalTextIteratorStreamer, StopStringMatcher
 
 
 @torch.inference_mode()
@@ -42,7 +41,9 @@ def generate_stream_falcon(
     input_echo_len = len(input_ids)
 
     decode_config = dict(skip_special_tokens=True, clean_up_tokenization_spaces=True)
-    streamer = TextIteratorStreamer(tokenizer, skip_prompt=True, **decode_config)
+    streamer = IncrementalTextIteratorStreamer(
+        tokenizer, skip_prompt=True, **decode_config
+    )
 
     generation_config = GenerationConfig(
         max_new_tokens=max_new_tokens,
@@ -70,35 +71,15 @@ def generate_stream_falcon(
         output = prompt
     else:
         output = ""
+    stop_matcher = StopStringMatcher(stop_str, len_prompt if echo else 0)
 
     for i, new_text in enumerate(streamer):
         output += new_text
         if i % stream_interval == 0:
-            if echo:
-                rfind_start = len_prompt
-            else:
-                rfind_start = 0
-
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                    else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
+            pos, partial_len = stop_matcher.update(output)
+            if pos != -1:
+                output = output[:pos]
+            partially_stopped = partial_len > 0
 
             # prevent yielding partial stop sequence
             if not partially_stopped:
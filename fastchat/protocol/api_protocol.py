@@ -123,6 +123,15 @@ class APITokenCheckResponse(BaseModel):
     prompts: List[APITokenCheckResponseItem]
 
 
+class APIInvalidateModelCacheRequest(BaseModel):
+    worker_address: Optional[str] = None
+    model: Optional[str] = None
+
+
+class APIInvalidateModelCacheResponse(BaseModel):
+    num_invalidated: int
+
+
 class CompletionRequest(BaseModel):
     model: str
     prompt: Union[str, List[Any]]
@@ -46,6 +46,20 @@ class UsageInfo(BaseModel):
     prompt_tokens: int = 0
     total_tokens: int = 0
     completion_tokens: Optional[int] = 0
+    # The fraction of the draft tokens accepted by speculative decoding
+    acceptance_rate: Optional[float] = None
+
+    # Only sent with speculative decoding, to keep the OpenAI usage format
+    def dict(self, **kwargs):
+        data = super().dict(**kwargs)
+        if "acceptance_rate" in data and data["acceptance_rate"] is None:
+            del data["acceptance_rate"]
+        return data
+
+    def json(self, **kwargs):
+        if self.acceptance_rate is None and kwargs.get("exclude") is None:
+            kwargs["exclude"] = {"acceptance_rate"}
+        return super().json(**kwargs)
 
 
 class LogProbs(BaseModel):
@@ -72,6 +86,7 @@ class ChatCompletionRequest(BaseModel):
     presence_penalty: Optional[float] = 0.0
     frequency_penalty: Optional[float] = 0.0
     user: Optional[str] = None
+    seed: Optional[int] = None
 
 
 class ChatMessage(BaseModel):
@@ -139,6 +154,8 @@ class EmbeddingsRequest(BaseModel):
     input: Union[str, List[Any]]
     user: Optional[str] = None
     encoding_format: Optional[str] = None
+    # float32, float16 or int8 (scaled by 127)
+    embedding_dtype: Optional[str] = "float32"
 
 
 class EmbeddingsResponse(BaseModel):
@@ -166,6 +183,7 @@ class CompletionRequest(BaseModel):
     user: Optional[str] = None
     use_beam_search: Optional[bool] = False
     best_of: Optional[int] = None
+    seed: Optional[int] = None
 
 
 class CompletionResponseChoice(BaseModel):
@@ -197,3 +215,58 @@ class CompletionStreamResponse(BaseModel):
     created: int = Field(default_factory=lambda: int(time.time()))
     model: str
     choices: List[CompletionResponseStreamChoice]
+
+
+class FileObject(BaseModel):
+    id: str = Field(default_factory=lambda: f"file-{shortuuid.random()}")
+    object: str = "file"
+    bytes: int
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    filename: str
+    purpose: str = "batch"
+    # The hash of the API key that created the file, not sent to clients
+    owner: Optional[str] = Field(None, exclude=True)
+
+
+class BatchRequest(BaseModel):
+    input_file_id: str
+    endpoint: str
+    completion_window: str = "24h"
+    metadata: Optional[Dict[str, str]] = None
+
+
+class BatchRequestCounts(BaseModel):
+    total: int = 0
+    completed: int = 0
+    failed: int = 0
+
+
+class Batch(BaseModel):
+    id: str = Field(default_factory=lambda: f"batch_{shortuuid.random()}")
+    object: str = "batch"
+    endpoint: str
+    errors: Optional[Dict[str, Any]] = None
+    input_file_id: str
+    completion_window: str
+    status: str = "validating"
+    output_file_id: Optional[str] = None
+    error_file_id: Optional[str] = None
+    created_at: int = Field(default_factory=lambda: int(time.time()))
+    in_progress_at: Optional[int] = None
+    expires_at: Optional[int] = None
+    finalizing_at: Optional[int] = None
+    completed_at: Optional[int] = None
+    failed_at: Optional[int] = None
+    expired_at: Optional[int] = None
+    cancelling_at: Optional[int] = None
+    cancelled_at: Optional[int] = None
+    request_counts: BatchRequestCounts = Field(default_factory=BatchRequestCounts)
+    metadata: Optional[Dict[str, str]] = None
+    # The hash of the API key that created the batch, not sent to clients
+    owner: Optional[str] = Field(None, exclude=True)
+
+
+class BatchList(BaseModel):
+    object: str = "list"
+    data: List[Batch] = []
+    has_more: bool = False
@@ -0,0 +1,150 @@
+"""
+Admission control of a model worker.
+
+Requests wait in a queue for one of the `limit_worker_concurrency` slots of
+the worker. Lower priority values are served first. Within a priority, the
+tenants (e.g., API keys) take turns, so that a tenant with many queued
+requests cannot starve the others. A request is rejected with
+ENGINE_OVERLOADED when the queue is full or when it has waited longer than
+its queue-time deadline, so that clients get a fast 429 instead of a timeout.
+"""
+import asyncio
+from collections import OrderedDict, deque
+from typing import Dict, Optional
+
+from fastapi.responses import JSONResponse
+
+from fastchat.constants import ErrorCode
+
+
+class WorkerOverloadedError(Exception):
+    pass
+
+
+class AdmissionQueue:
+    def __init__(
+        self,
+        limit: int,
+        max_queue_size: Optional[int] = None,
+        max_queue_time: Optional[float] = None,
+    ):
+        """
+        :param limit: The number of requests that run concurrently.
+        :param max_queue_size: The maximum number of waiting requests.
+        :param max_queue_time: The maximum seconds a request waits for a slot.
+        """
+        self.limit = limit
+        self.max_queue_size = max_queue_size
+        self.max_queue_time = max_queue_time
+        self.num_running = 0
+        self.num_waiting = 0
+        # Dict[priority -> OrderedDict[tenant -> deque of futures]]. The tenant
+        # served last moves to the end.
+        self.queues = {}
+        # The event loop of the waiters. `release` may be called from the
+        # threads of background tasks.
+        self.loop = None
+
+    def __repr__(self):
+        return (
+            f"AdmissionQueue(limit={self.limit}, running={self.num_running}, "
+            f"waiting={self.num_waiting})"
+        )
+
+    def get_queue_length(self) -> int:
+        return self.num_running + self.num_waiting
+
+    async def acquire(
+        self,
+        priority: int = 0,
+        tenant: Optional[str] = None,
+        max_queue_time: Optional[float] = None,
+    ):
+        """Wait for a slot, raise WorkerOverloadedError if it is not granted."""
+        self.loop = asyncio.get_running_loop()
+        if self.num_running < self.limit and self.num_waiting == 0:
+            self.num_running += 1
+            return
+        if self.max_queue_size is not None and self.num_waiting >= self.max_queue_size:
+            raise WorkerOverloadedError(
+                f"The worker queue is full ({self.num_waiting} requests)."
+            )
+
+        timeout = self.max_queue_time
+        if max_queue_time is not None:
+            timeout = (
+                max_queue_time if timeout is None else min(timeout, max_queue_time)
+            )
+
+        future = self.loop.create_future()
+        tenants = self.queues.setdefault(priority, OrderedDict())
+        tenants.setdefault(tenant, deque()).append(future)
+        self.num_waiting += 1
+        try:
+            await asyncio.wait([future], timeout=timeout)
+        except asyncio.CancelledError:
+            if future.done():
+                # The slot was granted while the request was cancelled.
+                self._release()
+            else:
+                self._remove(future, priority, tenant)
+            raise
+        if not future.done():
+            self._remove(future, priority, tenant)
+            raise WorkerOverloadedError(
+                f"The request waited more than {timeout} seconds in the worker queue."
+            )
+
+    def _remove(self, future: asyncio.Future, priority: int, tenant: Optional[str]):
+        future.cancel()
+        tenants = self.queues[priority]
+        waiters = tenants[tenant]
+        waiters.remove(future)
+        self.num_waiting -= 1
+        if not waiters:
+            del tenants[tenant]
+            if not tenants:
+                del self.queues[priority]
+
+    def release(self):
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if self.loop is not None and running_loop is not self.loop:
+            self.loop.call_soon_threadsafe(self._release)
+        else:
+            self._release()
+
+    def _release(self):
+        self.num_running -= 1
+        while self.queues and self.num_running < self.limit:
+            priority = min(self.queues)
+            tenants = self.queues[priority]
+            tenant, waiters = next(iter(tenants.items()))
+            future = waiters.popleft()
+            self.num_waiting -= 1
+            if waiters:
+                tenants.move_to_end(tenant)
+            else:
+                del tenants[tenant]
+                if not tenants:
+                    del self.queues[priority]
+            self.num_running += 1
+            future.set_result(None)
+
+
+def get_admission_params(params: Dict) -> Dict:
+    """The arguments of `AdmissionQueue.acquire` for a worker request."""
+    return {
+        "priority": int(params.get("priority", None) or 0),
+        "tenant": params.get("tenant", None),
+        "max_queue_time": params.get("max_queue_time", None),
+    }
+
+
+async def handle_worker_overloaded(request, exc: WorkerOverloadedError):
+    return JSONResponse(
+        {"text": str(exc), "error_code": ErrorCode.ENGINE_OVERLOADED},
+        status_code=429,
+    )
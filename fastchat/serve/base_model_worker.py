@@ -1,21 +1,40 @@
 import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait
+import json
 import threading
 import time
-from typing import List
+from typing import Callable, List
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 import requests
 
-from fastchat.constants import WORKER_HEART_BEAT_INTERVAL
+from fastchat.constants import (
+    WORKER_HEART_BEAT_INTERVAL,
+    WORKER_MAX_QUEUE_SIZE,
+    WORKER_MAX_QUEUE_TIME,
+    WORKER_TELEMETRY_INTERVAL,
+)
 from fastchat.conversation import Conversation
-from fastchat.utils import pretty_print_semaphore, build_logger
+from fastchat.serve.admission import (
+    AdmissionQueue,
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
+from fastchat.serve.worker_telemetry import MIN_WORKER_SPEED, WorkerTelemetry
+from fastchat.utils import build_logger
 
 
 worker = None
 logger = None
+# Seconds to coalesce load changes before the next channel message
+CHANNEL_MIN_INTERVAL = 0.05
+# Seconds between two checks whether the client of a request is gone
+DISCONNECT_CHECK_INTERVAL = 0.5
 
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 
 
 def heart_beat_worker(obj):
@@ -24,6 +43,10 @@ def heart_beat_worker(obj):
         obj.send_heart_beat()
 
 
+def channel_worker(obj):
+    obj.run_channel()
+
+
 class BaseModelWorker:
     def __init__(
         self,
@@ -43,6 +66,7 @@ class BaseModelWorker:
         self.worker_id = worker_id
         if model_path.endswith("/"):
             model_path = model_path[:-1]
+        self.model_path = model_path
         self.model_names = model_names or [model_path.split("/")[-1]]
         self.limit_worker_concurrency = limit_worker_concurrency
         self.conv = self.make_conv_template(conv_template, model_path)
@@ -51,9 +75,20 @@ class BaseModelWorker:
         self.tokenizer = None
         self.context_len = None
         self.call_ct = 0
-        self.semaphore = None
+        self.admission_queue = AdmissionQueue(
+            limit_worker_concurrency, WORKER_MAX_QUEUE_SIZE, WORKER_MAX_QUEUE_TIME
+        )
+        # Runs the blocking model calls, so that the event loop keeps serving
+        # heart beats and status requests during long forward passes.
+        self.executor = ThreadPoolExecutor(
+            max_workers=limit_worker_concurrency, thread_name_prefix="inference"
+        )
 
         self.heart_beat_thread = None
+        self.telemetry = WorkerTelemetry(get_kv_cache_usage=self.get_kv_cache_usage)
+        self.channel_thread = None
+        # Set when the load changes, wakes up the channel to push it.
+        self.load_changed = threading.Event()
 
         if logger is None:
             logger = build_logger("model_worker", f"model_worker_{self.worker_id}.log")
@@ -85,6 +120,12 @@ class BaseModelWorker:
             daemon=True,
         )
         self.heart_beat_thread.start()
+        self.channel_thread = threading.Thread(
+            target=channel_worker,
+            args=(self,),
+            daemon=True,
+        )
+        self.channel_thread.start()
 
     def register_to_controller(self):
         logger.info("Register to controller")
@@ -102,7 +143,7 @@ class BaseModelWorker:
     def send_heart_beat(self):
         logger.info(
             f"Send heart beat. Models: {self.model_names}. "
-            f"Semaphore: {pretty_print_semaphore(self.semaphore)}. "
+            f"Queue: {self.admission_queue}. "
             f"call_ct: {self.call_ct}. "
             f"worker_id: {self.worker_id}. "
         )
@@ -128,25 +169,68 @@ class BaseModelWorker:
         if not exist:
             self.register_to_controller()
 
+    def push_load(self):
+        """Push the current load to the controller without waiting for a ping."""
+        self.load_changed.set()
+
+    def channel_messages(self):
+        self.load_changed.set()
+        while True:
+            self.load_changed.wait(timeout=WORKER_TELEMETRY_INTERVAL)
+            self.load_changed.clear()
+            msg = {
+                "worker_name": self.worker_addr,
+                "queue_length": self.get_queue_length(),
+                "telemetry": self.telemetry.get_stats(),
+            }
+            yield json.dumps(msg).encode() + b"\n"
+            # Coalesce the load changes of a burst of requests.
+            time.sleep(CHANNEL_MIN_INTERVAL)
+
+    def run_channel(self):
+        """
+        Keep a streaming POST open to the controller and push the load over it.
+        The controller removes the worker as soon as the channel breaks, so the
+        worker registers again before it reconnects.
+        """
+        url = self.controller_addr + "/worker_channel"
+        backoff = 1
+        while True:
+            start = time.time()
+            try:
+                r = requests.post(url, data=self.channel_messages(), timeout=(5, None))
+                logger.info(f"worker channel closed: {r.status_code}")
+            except requests.exceptions.RequestException as e:
+                logger.error(f"worker channel error: {e}")
+            if time.time() - start > 60:
+                backoff = 1
+            time.sleep(backoff)
+            backoff = min(backoff * 2, 30)
+            try:
+                self.register_to_controller()
+            except (requests.exceptions.RequestException, AssertionError) as e:
+                logger.error(f"register error: {e}")
+
+    async def run_in_executor(self, func, *args):
+        """Run a blocking call on the inference threads of the worker."""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, func, *args)
+
+    def get_kv_cache_usage(self) -> float:
+        """The used fraction of the KV cache, 0 if unknown."""
+        return 0.0
+
     def get_queue_length(self):
-        if self.semaphore is None:
-            return 0
-        else:
-            sempahore_value = (
-                self.semaphore._value
-                if self.semaphore._value is not None
-                else self.limit_worker_concurrency
-            )
-            waiter_count = (
-                0 if self.semaphore._waiters is None else len(self.semaphore._waiters)
-            )
-            return self.limit_worker_concurrency - sempahore_value + waiter_count
+        return self.admission_queue.get_queue_length()
 
     def get_status(self):
+        telemetry = self.telemetry.get_stats()
         return {
             "model_names": self.model_names,
-            "speed": 1,
+            "model_paths": {name: self.model_path for name in self.model_names},
+            "speed": max(telemetry["speed"], MIN_WORKER_SPEED),
             "queue_length": self.get_queue_length(),
+            "telemetry": telemetry,
         }
 
     def count_token(self, params):
@@ -178,13 +262,13 @@ class BaseModelWorker:
 
 
 def release_worker_semaphore():
-    worker.semaphore.release()
+    worker.admission_queue.release()
+    worker.push_load()
 
 
-def acquire_worker_semaphore():
-    if worker.semaphore is None:
-        worker.semaphore = asyncio.Semaphore(worker.limit_worker_concurrency)
-    return worker.semaphore.acquire()
+def acquire_worker_semaphore(params):
+    worker.push_load()
+    return worker.admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks():
@@ -193,30 +277,100 @@ def create_background_tasks():
     return background_tasks
 
 
+async def stream_until_disconnect(
+    worker, generator, cancel_event: threading.Event, on_close: Callable[[], None]
+):
+    """
+    Stream a synchronous generator on the inference threads of the worker.
+    When the client disconnects, the response is cancelled and `cancel_event`
+    tells the generation loop to stop.
+
+    The generator is closed on the executor once its running step returns, so
+    that its cleanup runs, and `on_close` is called on the event loop after
+    that, e.g. to release the admission slot.
+    """
+    loop = asyncio.get_running_loop()
+    done = object()
+    step = None
+    try:
+        while True:
+            step = worker.executor.submit(next, generator, done)
+            chunk = await asyncio.wrap_future(step)
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        cancel_event.set()
+
+        def close():
+            if step is not None:
+                wait([step])
+            generator.close()
+
+        closing = worker.executor.submit(close)
+        closing.add_done_callback(lambda _: loop.call_soon_threadsafe(on_close))
+
+
+async def watch_disconnect(request: Request, cancel_event: threading.Event):
+    """Set `cancel_event` when the client of a non-streaming request is gone."""
+    while not cancel_event.is_set():
+        if await request.is_disconnected():
+            cancel_event.set()
+            return
+        await asyncio.sleep(DISCONNECT_CHECK_INTERVAL)
+
+
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
-    generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
-    return StreamingResponse(generator, background=background_tasks)
+    stats = worker.telemetry.start_request(params)
+    try:
+        await acquire_worker_semaphore(params)
+    except WorkerOverloadedError:
+        worker.telemetry.finish_request(stats)
+        raise
+    params["cancel_event"] = cancel_event = threading.Event()
+    generator = worker.telemetry.track_stream(
+        stats, worker.generate_stream_gate(params)
+    )
+    return StreamingResponse(
+        stream_until_disconnect(
+            worker, generator, cancel_event, release_worker_semaphore
+        )
+    )
 
 
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
-    output = await asyncio.to_thread(worker.generate_gate, params)
-    release_worker_semaphore()
+    stats = worker.telemetry.start_request(params)
+    try:
+        await acquire_worker_semaphore(params)
+    except WorkerOverloadedError:
+        worker.telemetry.finish_request(stats)
+        raise
+    params["cancel_event"] = cancel_event = threading.Event()
+    watcher = asyncio.create_task(watch_disconnect(request, cancel_event))
+    output = {}
+    try:
+        output = await worker.run_in_executor(worker.generate_gate, params)
+    finally:
+        watcher.cancel()
+        release_worker_semaphore()
+        worker.telemetry.finish_request(stats, output.get("usage", None))
     return JSONResponse(output)
 
 
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
-    embedding = worker.get_embeddings(params)
-    release_worker_semaphore()
+    await acquire_worker_semaphore(params)
+    try:
+        embedding = await worker.run_in_executor(worker.get_embeddings, params)
+    finally:
+        release_worker_semaphore()
+    if isinstance(embedding, bytes):
+        return Response(content=embedding, media_type="application/octet-stream")
     return JSONResponse(content=embedding)
 
 
@@ -0,0 +1,432 @@
+"""
+Offline batch inference for the OpenAI API server, modeled after the OpenAI
+Batch API (https://platform.openai.com/docs/api-reference/batch).
+
+A batch is a JSONL file of requests to one endpoint. Its requests run at a
+low queue priority with a bounded concurrency, so that they fill the idle
+capacity of the workers while interactive requests are served first. They
+are ordered by model, prompt prefix and prompt length: the requests with a
+shared prefix run together and hit the prefix caches of the workers, and the
+requests that run at the same time have similar lengths.
+
+The results are appended to the output and error files of a batch as they
+finish, and they are its checkpoint: after a restart of the server, the
+unfinished batches resume with the requests that have no result yet.
+
+Layout of the batch directory:
+    files/<file id>.jsonl   the content of an uploaded or a result file
+    files/<file id>.json    its FileObject
+    batches/<batch id>.json the Batch object and the queue priority of a batch
+
+Files and batches belong to the hash of the API key that created them, see
+`get_owner`, and the output files of a batch to the owner of the batch.
+"""
+import asyncio
+import hashlib
+import json
+import os
+import re
+import time
+from typing import Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+import shortuuid
+
+from fastchat.protocol.openai_api_protocol import (
+    Batch,
+    BatchRequest,
+    BatchRequestCounts,
+    FileObject,
+)
+
+BATCH_ENDPOINTS = ["/v1/chat/completions", "/v1/completions"]
+# The requests with the same first characters of their prompts run together,
+# from the shortest to the longest.
+BATCH_PREFIX_CHARS = 256
+# Seconds between the retries of a request rejected by overloaded workers
+BATCH_RETRY_INTERVAL = 5.0
+# Seconds between the checkpoints of the request counts of a running batch
+BATCH_SAVE_INTERVAL = 1.0
+# The number of reported invalid lines of an input file
+MAX_BATCH_ERRORS = 100
+ACTIVE_STATUSES = ("validating", "in_progress", "finalizing", "cancelling")
+
+
+def get_owner(api_key: Optional[str]) -> Optional[str]:
+    """The owner of the objects created with an API key, None without keys."""
+    if api_key is None:
+        return None
+    return hashlib.sha256(api_key.encode()).hexdigest()
+
+
+def write_json(path: str, obj: Dict):
+    """Replace a JSON file atomically, so that a crash leaves the old one."""
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def read_custom_ids(path: str) -> List[str]:
+    """The custom ids of the results in a file. A line torn by a crash is dropped."""
+    if not os.path.exists(path):
+        return []
+    with open(path, "rb+") as f:
+        data = f.read()
+        end = data.rfind(b"\n") + 1
+        if end < len(data):
+            f.truncate(end)
+    return [json.loads(line)["custom_id"] for line in data[:end].splitlines()]
+
+
+def get_schedule_key(request: Dict) -> Tuple[str, str, int]:
+    body = request["body"]
+    prompt = body.get("messages", body.get("prompt", ""))
+    if not isinstance(prompt, str):
+        prompt = json.dumps(prompt, ensure_ascii=False)
+    return str(body.get("model")), prompt[:BATCH_PREFIX_CHARS], len(prompt)
+
+
+class BatchStore:
+    """The files and the batches in the batch directory."""
+
+    def __init__(self, root: str):
+        self.files_dir = os.path.join(root, "files")
+        self.batches_dir = os.path.join(root, "batches")
+        os.makedirs(self.files_dir, exist_ok=True)
+        os.makedirs(self.batches_dir, exist_ok=True)
+
+    @staticmethod
+    def check_id(object_id: str):
+        # The ids come from the clients and end up in paths.
+        if not re.fullmatch(r"[\w-]+", object_id):
+            raise KeyError(object_id)
+
+    def get_file_path(self, file_id: str) -> str:
+        self.check_id(file_id)
+        return os.path.join(self.files_dir, f"{file_id}.jsonl")
+
+    def create_file(
+        self,
+        filename: str,
+        purpose: str,
+        data: bytes = b"",
+        owner: Optional[str] = None,
+    ) -> FileObject:
+        file = FileObject(
+            bytes=len(data), filename=filename, purpose=purpose, owner=owner
+        )
+        with open(self.get_file_path(file.id), "wb") as f:
+            f.write(data)
+        self.save_file(file)
+        return file
+
+    def save_file(self, file: FileObject):
+        # The owner is excluded from the exports for the clients.
+        write_json(
+            os.path.join(self.files_dir, f"{file.id}.json"),
+            {**file.dict(), "owner": file.owner},
+        )
+
+    def get_file(self, file_id: str) -> FileObject:
+        self.check_id(file_id)
+        path = os.path.join(self.files_dir, f"{file_id}.json")
+        if not os.path.exists(path):
+            raise KeyError(file_id)
+        return FileObject.parse_file(path)
+
+    def save_batch(self, batch: Batch, priority: int):
+        write_json(
+            os.path.join(self.batches_dir, f"{batch.id}.json"),
+            {"batch": {**batch.dict(), "owner": batch.owner}, "priority": priority},
+        )
+
+    def load_batch(self, batch_id: str) -> Tuple[Batch, int]:
+        self.check_id(batch_id)
+        path = os.path.join(self.batches_dir, f"{batch_id}.json")
+        if not os.path.exists(path):
+            raise KeyError(batch_id)
+        with open(path) as f:
+            state = json.load(f)
+        return Batch.parse_obj(state["batch"]), state["priority"]
+
+    def list_batch_ids(self) -> List[str]:
+        return [
+            name[: -len(".json")]
+            for name in os.listdir(self.batches_dir)
+            if name.endswith(".json")
+        ]
+
+
+class BatchRunner:
+    def __init__(
+        self,
+        store: BatchStore,
+        execute: Callable[[str, Dict, int, str], Awaitable[Tuple[int, Dict]]],
+        concurrency: int = 8,
+    ):
+        """
+        :param execute: Runs one request, `execute(url, body, priority, tenant)`
+            returns the status code and the body of the response.
+        :param concurrency: The number of requests of the batches that run at once.
+        """
+        self.store = store
+        self.execute = execute
+        self.concurrency = concurrency
+        # Dict[batch id -> (batch, queue priority)] of the batches that are not done
+        self.active = {}
+        self.queue = None
+        self.task = None
+
+    def start(self):
+        """Start running batches in the event loop, resume the unfinished ones."""
+        self.queue = asyncio.Queue()
+        batches = [self.store.load_batch(i) for i in self.store.list_batch_ids()]
+        for batch, priority in sorted(batches, key=lambda x: x[0].created_at):
+            if batch.status in ACTIVE_STATUSES:
+                self.active[batch.id] = (batch, priority)
+                self.queue.put_nowait(batch.id)
+        self.task = asyncio.ensure_future(self._loop())
+
+    def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+
+    def create(
+        self, request: BatchRequest, priority: int, owner: Optional[str] = None
+    ) -> Batch:
+        if request.endpoint not in BATCH_ENDPOINTS:
+            raise ValueError(
+                f"Unsupported endpoint {request.endpoint}, "
+                f"expected one of {BATCH_ENDPOINTS}."
+            )
+        window = re.fullmatch(r"(\d+)h", request.completion_window)
+        if window is None:
+            raise ValueError(
+                f"Invalid completion window {request.completion_window}, "
+                "expected a number of hours like 24h."
+            )
+        if self.store.get_file(request.input_file_id).owner != owner:
+            raise KeyError(request.input_file_id)
+
+        batch = Batch(
+            endpoint=request.endpoint,
+            input_file_id=request.input_file_id,
+            completion_window=request.completion_window,
+            metadata=request.metadata,
+            owner=owner,
+        )
+        batch.expires_at = batch.created_at + int(window.group(1)) * 3600
+        self.store.save_batch(batch, priority)
+        self.active[batch.id] = (batch, priority)
+        self.queue.put_nowait(batch.id)
+        return batch
+
+    def get(self, batch_id: str) -> Batch:
+        if batch_id in self.active:
+            return self.active[batch_id][0]
+        return self.store.load_batch(batch_id)[0]
+
+    def list_batches(self, owner: Optional[str] = None) -> List[Batch]:
+        """The batches of an owner, the most recent first."""
+        batches = [self.get(i) for i in self.store.list_batch_ids()]
+        batches = [b for b in batches if b.owner == owner]
+        return sorted(batches, key=lambda b: b.created_at, reverse=True)
+
+    def cancel(self, batch_id: str) -> Batch:
+        """Stop a batch. The running requests finish and keep their results."""
+        if batch_id not in self.active:
+            return self.store.load_batch(batch_id)[0]
+        batch, priority = self.active[batch_id]
+        if batch.status in ("validating", "in_progress"):
+            batch.status = "cancelling"
+            batch.cancelling_at = int(time.time())
+            self.store.save_batch(batch, priority)
+        return batch
+
+    async def _loop(self):
+        while True:
+            batch_id = await self.queue.get()
+            batch, priority = self.active[batch_id]
+            try:
+                await self._run(batch, priority)
+            except Exception as e:
+                batch.errors = {
+                    "object": "list",
+                    "data": [{"code": "internal_error", "message": str(e)}],
+                }
+                self._finish(batch, priority, "failed")
+            del self.active[batch_id]
+
+    def _finish(self, batch: Batch, priority: int, status: str):
+        batch.status = status
+        setattr(batch, f"{status}_at", int(time.time()))
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is not None:
+                file = self.store.get_file(file_id)
+                file.bytes = os.path.getsize(self.store.get_file_path(file_id))
+                self.store.save_file(file)
+        self.store.save_batch(batch, priority)
+
+    def _is_stopped(self, batch: Batch) -> bool:
+        return batch.status == "cancelling" or time.time() > batch.expires_at
+
+    async def _run(self, batch: Batch, priority: int):
+        if batch.status == "cancelling" and batch.in_progress_at is None:
+            self._finish(batch, priority, "cancelled")
+            return
+
+        loop = asyncio.get_running_loop()
+        requests, errors = await loop.run_in_executor(None, self._read_input, batch)
+        if errors:
+            batch.errors = {"object": "list", "data": errors}
+            self._finish(batch, priority, "failed")
+            return
+
+        if batch.output_file_id is None:
+            batch.output_file_id = self.store.create_file(
+                f"{batch.id}_output.jsonl", "batch_output", owner=batch.owner
+            ).id
+            batch.error_file_id = self.store.create_file(
+                f"{batch.id}_error.jsonl", "batch_output", owner=batch.owner
+            ).id
+        output_path = self.store.get_file_path(batch.output_file_id)
+        error_path = self.store.get_file_path(batch.error_file_id)
+        completed = read_custom_ids(output_path)
+        failed = read_custom_ids(error_path)
+        done = set(completed) | set(failed)
+        pending = sorted(
+            [r for r in requests if r["custom_id"] not in done], key=get_schedule_key
+        )
+        batch.request_counts = BatchRequestCounts(
+            total=len(requests), completed=len(completed), failed=len(failed)
+        )
+        if batch.status == "validating":
+            batch.status = "in_progress"
+            batch.in_progress_at = int(time.time())
+        self.store.save_batch(batch, priority)
+
+        semaphore = asyncio.Semaphore(self.concurrency)
+        tasks: Set[asyncio.Task] = set()
+        last_save = time.monotonic()
+        with open(output_path, "ab") as output_file, open(
+            error_path, "ab"
+        ) as error_file:
+
+            async def run_request(request: Dict):
+                nonlocal last_save
+                try:
+                    result = await self._execute(request, batch, priority)
+                finally:
+                    semaphore.release()
+                if result is None:
+                    return
+                if result["response"] is not None:
+                    success = result["response"]["status_code"] == 200
+                else:
+                    success = False
+                line = json.dumps(result, ensure_ascii=False).encode() + b"\n"
+                if success:
+                    output_file.write(line)
+                    output_file.flush()
+                    batch.request_counts.completed += 1
+                else:
+                    error_file.write(line)
+                    error_file.flush()
+                    batch.request_counts.failed += 1
+                if time.monotonic() - last_save > BATCH_SAVE_INTERVAL:
+                    last_save = time.monotonic()
+                    self.store.save_batch(batch, priority)
+
+            for request in pending:
+                await semaphore.acquire()
+                if self._is_stopped(batch):
+                    semaphore.release()
+                    break
+                task = asyncio.ensure_future(run_request(request))
+                tasks.add(task)
+                task.add_done_callback(tasks.discard)
+            if tasks:
+                await asyncio.gather(*tasks)
+
+        if batch.status == "cancelling":
+            self._finish(batch, priority, "cancelled")
+        elif time.time() > batch.expires_at:
+            self._finish(batch, priority, "expired")
+        else:
+            batch.status = "finalizing"
+            batch.finalizing_at = int(time.time())
+            self._finish(batch, priority, "completed")
+
+    def _read_input(self, batch: Batch) -> Tuple[List[Dict], List[Dict]]:
+        """The requests of a batch, and the errors of its invalid lines."""
+        requests, errors, custom_ids = [], [], set()
+        with open(self.store.get_file_path(batch.input_file_id), "rb") as f:
+            for line_no, line in enumerate(f, 1):
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                except ValueError:
+                    request = None
+                if not isinstance(request, dict):
+                    message = "The line is not a JSON object."
+                elif not isinstance(request.get("custom_id"), str):
+                    message = "The custom_id must be a string."
+                elif request["custom_id"] in custom_ids:
+                    message = f"Duplicate custom_id {request['custom_id']}."
+                elif request.get("method", "POST") != "POST":
+                    message = "The method must be POST."
+                elif request.get("url") != batch.endpoint:
+                    message = f"The url must be the endpoint {batch.endpoint}."
+                elif not isinstance(request.get("body"), dict):
+                    message = "The body must be a JSON object."
+                else:
+                    custom_ids.add(request["custom_id"])
+                    requests.append(request)
+                    continue
+                errors.append(
+                    {"code": "invalid_request", "message": message, "line": line_no}
+                )
+                if len(errors) >= MAX_BATCH_ERRORS:
+                    break
+        if not requests and not errors:
+            errors.append(
+                {"code": "empty_file", "message": "The input file has no requests."}
+            )
+        return requests, errors
+
+    async def _execute(
+        self, request: Dict, batch: Batch, priority: int
+    ) -> Optional[Dict]:
+        """
+        Run a request, and retry it while the workers are overloaded.
+
+        :returns: The line of the request in the output or the error file, or
+            None if the batch stopped before the request ran.
+        """
+        while True:
+            try:
+                status_code, body = await self.execute(
+                    request["url"], request["body"], priority, batch.id
+                )
+            except Exception as e:
+                response = None
+                error = {"code": "internal_error", "message": str(e)}
+            else:
+                if status_code == 429:
+                    await asyncio.sleep(BATCH_RETRY_INTERVAL)
+                    if self._is_stopped(batch):
+                        return None
+                    continue
+                response = {
+                    "status_code": status_code,
+                    "request_id": body.get("id", None),
+                    "body": body,
+                }
+                error = None
+            return {
+                "id": f"batch_req_{shortuuid.random()}",
+                "custom_id": request["custom_id"],
+                "response": response,
+                "error": error,
+            }
@@ -0,0 +1,436 @@
+"""
+Continuous (iteration-level) batching for the huggingface generation path.
+
+All in-flight requests of a worker are merged into one padded decode step per
+iteration. New requests are admitted between two steps and finished requests
+are retired right away, so a long generation never blocks a short one.
+
+The batched KV cache is kept in the legacy tuple format with left padding:
+each layer holds tensors of shape [batch, heads, seq_len, head_dim], and an
+attention mask of shape [batch, seq_len] marks the valid positions of each row.
+"""
+import gc
+import inspect
+import logging
+import queue
+import threading
+from typing import Dict, List, Optional
+import uuid
+
+import torch
+
+from fastchat.serve.kv_cache_utils import to_legacy_cache
+from fastchat.serve.sampler import (
+    SamplingParams,
+    compute_logprobs,
+    decode_top_logprobs,
+    sample,
+)
+from fastchat.utils import IncrementalDetokenizer, StopStringMatcher
+
+# The engine runs inside the model worker, which sets up the log handlers.
+logger = logging.getLogger("model_worker")
+
+
+def pad_cache_left(past_key_values, pad_len: int):
+    """Left-pad every tensor of a legacy cache along the sequence dimension."""
+    if pad_len == 0:
+        return past_key_values
+    padded = []
+    for layer in past_key_values:
+        padded_layer = []
+        for t in layer:
+            shape = list(t.shape)
+            shape[-2] = pad_len
+            padded_layer.append(torch.cat([t.new_zeros(shape), t], dim=-2))
+        padded.append(tuple(padded_layer))
+    return tuple(padded)
+
+
+def select_cache_rows(past_key_values, index: torch.Tensor, start: int = 0):
+    """Keep the rows in `index` and drop the first `start` sequence positions."""
+    return tuple(
+        tuple(t.index_select(0, index)[..., start:, :] for t in layer)
+        for layer in past_key_values
+    )
+
+
+def concat_cache_rows(caches: List):
+    """Concatenate legacy caches of the same sequence length along the batch."""
+    return tuple(
+        tuple(torch.cat([c[layer][j] for c in caches], dim=0) for j in range(2))
+        for layer in range(len(caches[0]))
+    )
+
+
+class Sequence:
+    """The state of one request inside the batching engine."""
+
+    def __init__(self, params: Dict, tokenizer, context_len: int, stream_interval):
+        self.request_id = params.get("request_id") or uuid.uuid4().hex
+        self.tokenizer = tokenizer
+        self.stream_interval = stream_interval
+        self.outputs = queue.Queue()
+
+        self.prompt = params["prompt"]
+        self.sampling_params = SamplingParams.from_request(params)
+        self.max_new_tokens = int(params.get("max_new_tokens", 256))
+        self.logprobs = params.get("logprobs", None)
+        self.echo = bool(params.get("echo", True))
+        self.stop_matcher = StopStringMatcher(
+            params.get("stop", None), len(self.prompt) if self.echo else 0
+        )
+        self.stop_token_ids = list(params.get("stop_token_ids", None) or [])
+        if tokenizer.eos_token_id not in self.stop_token_ids:
+            self.stop_token_ids.append(tokenizer.eos_token_id)
+        # Set when the client is gone
+        self.cancel_event = params.get("cancel_event", None)
+
+        input_ids = tokenizer(self.prompt).input_ids
+        max_src_len = context_len - self.max_new_tokens - 1
+        self.input_ids = input_ids[-max_src_len:]
+        self.input_echo_len = len(self.input_ids)
+        self.output_ids = list(self.input_ids)
+        self.token_logprobs = [None]  # The first token has no logprobs.
+        self.top_logprobs = [None]
+        self.start = 0 if self.echo else self.input_echo_len
+        self.detokenizer = IncrementalDetokenizer(tokenizer, self.start)
+        self.token_texts = []  # The decoded text of each returned token.
+        self.text_offsets = []
+        self.top_texts = []
+
+        self.step = 0
+        self.output = ""
+        self.ret_logprobs = None
+        self.finished = False
+
+    def append_token(
+        self,
+        token: int,
+        logprob: Optional[float] = None,
+        top_logprobs: Optional[Dict[int, float]] = None,
+    ):
+        """Append a sampled token and push the streaming output if needed."""
+        self.output_ids.append(token)
+        if self.logprobs is not None:
+            self.token_logprobs.append(logprob)
+            self.top_logprobs.append(top_logprobs)
+        i = self.step
+        stopped = token in self.stop_token_ids
+
+        if i % self.stream_interval == 0 or i == self.max_new_tokens - 1 or stopped:
+            stopped = self._emit(i, stopped) or stopped
+
+        if stopped:
+            self._finish(i, "stop")
+        elif i == self.max_new_tokens - 1:
+            self._finish(i, "length")
+        self.step += 1
+
+    def _emit(self, i: int, stopped: bool) -> bool:
+        self.detokenizer.update(self.output_ids)
+        output = self.detokenizer.text
+        if self.logprobs is not None:
+            for pos in range(self.start + len(self.token_texts), len(self.output_ids)):
+                self.text_offsets.append(
+                    self.text_offsets[-1] + len(self.token_texts[-1])
+                    if self.token_texts
+                    else 0
+                )
+                self.token_texts.append(self.tokenizer.decode(self.output_ids[pos]))
+                self.top_texts.append(
+                    decode_top_logprobs(self.tokenizer, self.top_logprobs[pos])
+                )
+            self.ret_logprobs = {
+                "text_offset": list(self.text_offsets),
+                "tokens": list(self.token_texts),
+                "token_logprobs": self.token_logprobs[self.start :],
+                "top_logprobs": list(self.top_texts),
+            }
+
+        pos, partial_len = self.stop_matcher.update(output)
+        if pos != -1:
+            output = output[:pos]
+            stopped = True
+        partially_stopped = partial_len > 0
+
+        self.output = output
+        # Prevent yielding partial stop sequence
+        if not partially_stopped:
+            self.outputs.put(self._make_output(i, None))
+        return stopped
+
+    def _make_output(self, i: int, finish_reason: Optional[str]) -> Dict:
+        return {
+            "text": self.output,
+            "logprobs": self.ret_logprobs,
+            "usage": {
+                "prompt_tokens": self.input_echo_len,
+                "completion_tokens": i,
+                "total_tokens": self.input_echo_len + i,
+            },
+            "finish_reason": finish_reason,
+        }
+
+    def _finish(self, i: int, finish_reason: str):
+        self.finished = True
+        self.outputs.put(self._make_output(i, finish_reason))
+        self.outputs.put(None)
+
+    def abort(self, error: Exception):
+        self.finished = True
+        self.outputs.put(error)
+
+    def is_cancelled(self) -> bool:
+        return self.cancel_event is not None and self.cancel_event.is_set()
+
+    def cancel(self):
+        self.finished = True
+        self.outputs.put(None)
+
+
+class ContinuousBatchingEngine:
+    """
+    Run all requests of a decoder-only huggingface model in one shared batch.
+
+    A background thread owns the model. Each iteration it prefills the newly
+    admitted requests one by one, merges them into the running batch and then
+    runs a single decode step for every running request.
+    """
+
+    def __init__(
+        self,
+        model,
+        tokenizer,
+        device: str,
+        context_len: int,
+        stream_interval: int = 2,
+        max_batch_size: int = 16,
+        prefix_cache=None,
+    ):
+        self.model = model
+        self.tokenizer = tokenizer
+        self.device = device
+        self.model_device = model.device if hasattr(model, "device") else device
+        self.context_len = context_len
+        self.stream_interval = stream_interval
+        self.max_batch_size = max_batch_size
+        self.prefix_cache = prefix_cache
+        self.accepts_position_ids = (
+            "position_ids" in inspect.signature(model.forward).parameters
+        )
+
+        self.waiting = queue.Queue()
+        self.running: List[Sequence] = []
+        self.past_key_values = None
+        self.attention_mask = None
+
+        self.thread = threading.Thread(target=self._loop, daemon=True)
+        self.thread.start()
+
+    def generate_stream(self, params: Dict):
+        """Submit a request and yield its outputs like `generate_stream`."""
+        seq = Sequence(params, self.tokenizer, self.context_len, self.stream_interval)
+        self.waiting.put(seq)
+        while True:
+            output = seq.outputs.get()
+            if output is None:
+                break
+            if isinstance(output, Exception):
+                raise output
+            yield output
+
+    def get_num_running(self) -> int:
+        return len(self.running)
+
+    def _loop(self):
+        while True:
+            try:
+                self._admit()
+                if self._cancel():
+                    self._retire()
+                if self.running:
+                    self._decode()
+                    self._retire()
+            except Exception as e:
+                logger.error(f"Batching engine error: {e}")
+                for seq in self.running:
+                    seq.abort(e)
+                self.running = []
+                self.past_key_values = self.attention_mask = None
+                self._clean()
+
+    def _admit(self):
+        # Block when there is nothing to decode.
+        block = not self.running
+        while len(self.running) < self.max_batch_size:
+            try:
+                seq = self.waiting.get(block=block)
+            except queue.Empty:
+                break
+            block = False
+            if seq.is_cancelled():
+                seq.cancel()
+                continue
+            try:
+                self._prefill(seq)
+            except Exception as e:
+                logger.error(f"Prefill error: {e}")
+                seq.abort(e)
+
+    def _cancel(self) -> bool:
+        """Finish the running requests whose clients are gone."""
+        cancelled = False
+        for seq in self.running:
+            if not seq.finished and seq.is_cancelled():
+                seq.cancel()
+                cancelled = True
+        return cancelled
+
+    @torch.inference_mode()
+    def _prefill(self, seq: Sequence):
+        input_ids = torch.as_tensor([seq.input_ids], device=self.model_device)
+        num_cached = 0
+        if self.prefix_cache is not None and seq.logprobs is None:
+            num_cached, cached_key_values = self.prefix_cache.lookup(seq.input_ids)
+        if num_cached > 0:
+            out = self.model(
+                input_ids=input_ids[:, num_cached:],
+                past_key_values=cached_key_values,
+                use_cache=True,
+            )
+        else:
+            out = self.model(input_ids=input_ids, use_cache=True)
+        logits = out.logits
+
+        if seq.logprobs is not None:
+            # Prefill logprobs for the prompt.
+            prompt_logprobs, prompt_top_logprobs = compute_logprobs(
+                logits[0, :-1, :],
+                input_ids[0, 1:],
+                [seq.logprobs] * (input_ids.shape[1] - 1),
+            )
+            seq.token_logprobs.extend(prompt_logprobs)
+            seq.top_logprobs.extend(prompt_top_logprobs)
+
+        self._sample([seq], logits[:, -1, :])
+        past_key_values = to_legacy_cache(out.past_key_values)
+        if seq.finished:
+            if self.prefix_cache is not None:
+                self.prefix_cache.insert(seq.output_ids, past_key_values)
+            return
+
+        attention_mask = torch.ones(
+            (1, input_ids.shape[1]), dtype=torch.long, device=self.model_device
+        )
+        if self.past_key_values is None:
+            self.past_key_values = past_key_values
+            self.attention_mask = attention_mask
+        else:
+            batch_len = self.attention_mask.shape[1]
+            seq_len = attention_mask.shape[1]
+            if seq_len < batch_len:
+                past_key_values = pad_cache_left(past_key_values, batch_len - seq_len)
+                attention_mask = torch.cat(
+                    [
+                        attention_mask.new_zeros((1, batch_len - seq_len)),
+                        attention_mask,
+                    ],
+                    dim=1,
+                )
+            elif seq_len > batch_len:
+                self.past_key_values = pad_cache_left(
+                    self.past_key_values, seq_len - batch_len
+                )
+                self.attention_mask = torch.cat(
+                    [
+                        self.attention_mask.new_zeros(
+                            (self.attention_mask.shape[0], seq_len - batch_len)
+                        ),
+                        self.attention_mask,
+                    ],
+                    dim=1,
+                )
+            self.past_key_values = concat_cache_rows(
+                [self.past_key_values, past_key_values]
+            )
+            self.attention_mask = torch.cat([self.attention_mask, attention_mask])
+        self.running.append(seq)
+
+    @torch.inference_mode()
+    def _decode(self):
+        input_ids = torch.as_tensor(
+            [[seq.output_ids[-1]] for seq in self.running], device=self.model_device
+        )
+        position_ids = self.attention_mask.sum(dim=1, keepdim=True)
+        self.attention_mask = torch.cat(
+            [self.attention_mask, self.attention_mask.new_ones((len(self.running), 1))],
+            dim=1,
+        )
+        kwargs = {}
+        if self.accepts_position_ids:
+            kwargs["position_ids"] = position_ids
+        out = self.model(
+            input_ids=input_ids,
+            attention_mask=self.attention_mask,
+            past_key_values=self.past_key_values,
+            use_cache=True,
+            **kwargs,
+        )
+        self.past_key_values = to_legacy_cache(out.past_key_values)
+        self._sample(self.running, out.logits[:, -1, :])
+
+    def _sample(self, seqs: List[Sequence], logits: torch.Tensor):
+        """Sample the next token of every sequence in one batched pass."""
+        if self.device == "mps":
+            # Switch to CPU by avoiding some bugs in mps backend.
+            logits = logits.float().to("cpu")
+        sampler_output = sample(
+            logits,
+            [seq.sampling_params for seq in seqs],
+            [seq.output_ids for seq in seqs],
+        )
+        for row, seq in enumerate(seqs):
+            seq.append_token(
+                sampler_output.tokens[row],
+                sampler_output.logprobs[row],
+                sampler_output.top_logprobs[row],
+            )
+
+    def _retire(self):
+        keep = [row for row, seq in enumerate(self.running) if not seq.finished]
+        if len(keep) == len(self.running):
+            return
+        if self.prefix_cache is not None:
+            batch_len = self.attention_mask.shape[1]
+            for row, seq in enumerate(self.running):
+                if seq.finished:
+                    # Rows are left-padded, so the valid positions are at the end.
+                    start = batch_len - int(self.attention_mask[row].sum())
+                    self.prefix_cache.insert(
+                        seq.output_ids,
+                        tuple(
+                            tuple(t[row : row + 1, ..., start:, :] for t in layer)
+                            for layer in self.past_key_values
+                        ),
+                    )
+        self.running = [self.running[row] for row in keep]
+        if not keep:
+            self.past_key_values = self.attention_mask = None
+            self._clean()
+            return
+
+        index = torch.as_tensor(keep, device=self.attention_mask.device)
+        attention_mask = self.attention_mask.index_select(0, index)
+        # Drop the leading columns that are padding for every remaining row.
+        start = int(attention_mask.any(dim=0).int().argmax())
+        self.attention_mask = attention_mask[:, start:]
+        self.past_key_values = select_cache_rows(self.past_key_values, index, start)
+
+    def _clean(self):
+        gc.collect()
+        torch.cuda.empty_cache()
+        if self.device == "xpu":
+            torch.xpu.empty_cache()
+        if self.device == "npu":
+            torch.npu.empty_cache()
@@ -1,30 +1,38 @@
 """
 A controller manages distributed workers.
 It sends worker addresses to clients.
+
+The controller runs on a single asyncio event loop. Only the event loop
+mutates the worker table, and dispatching never waits for the network.
 """
 import argparse
 import asyncio
+import bisect
 import dataclasses
 from enum import Enum, auto
+import hashlib
+import heapq
 import json
 import logging
 import os
+import random
 import time
-from typing import List, Union
-import threading
+from typing import Dict, List, Optional, Union
 
 from fastapi import FastAPI, Request
-from fastapi.responses import StreamingResponse
-import numpy as np
-import requests
+from fastapi.responses import JSONResponse, StreamingResponse
+import httpx
+from starlette.requests import ClientDisconnect
 import uvicorn
 
 from fastchat.constants import (
     CONTROLLER_HEART_BEAT_EXPIRATION,
     WORKER_API_TIMEOUT,
+    WORKER_CHANNEL_TIMEOUT,
     ErrorCode,
     SERVER_ERROR_MSG,
 )
+from fastchat.serve.worker_telemetry import MIN_WORKER_SPEED
 from fastchat.utils import build_logger
 
 
@@ -34,6 +42,10 @@ logger = build_logger("controller", "controller.log")
 class DispatchMethod(Enum):
     LOTTERY = auto()
     SHORTEST_QUEUE = auto()
+    LEAST_OUTSTANDING_TOKENS = auto()
+    POWER_OF_TWO = auto()
+    EWMA_LATENCY = auto()
+    AFFINITY = auto()
 
     @classmethod
     def from_str(cls, name):
@@ -41,6 +53,14 @@ class DispatchMethod(Enum):
             return cls.LOTTERY
         elif name == "shortest_queue":
             return cls.SHORTEST_QUEUE
+        elif name == "least_outstanding_tokens":
+            return cls.LEAST_OUTSTANDING_TOKENS
+        elif name == "power_of_two":
+            return cls.POWER_OF_TWO
+        elif name == "ewma_latency":
+            return cls.EWMA_LATENCY
+        elif name == "affinity":
+            return cls.AFFINITY
         else:
             raise ValueError(f"Invalid dispatch method")
 
@@ -48,31 +68,227 @@ class DispatchMethod(Enum):
 @dataclasses.dataclass
 class WorkerInfo:
     model_names: List[str]
-    speed: int
+    # Decode tokens/s measured by the worker, that of its peers until then
+    speed: float
     queue_length: int
     check_heart_beat: bool
     last_heart_beat: str
     multimodal: bool
+    # Telemetry reported by the worker, see fastchat/serve/worker_telemetry.py
+    outstanding_tokens: float = 0
+    avg_request_tokens: float = 0
+    ttft: float = 0
+    kv_cache_usage: float = 0
+
+
+# The assumed cost of a request before a worker reports its average
+DEFAULT_REQUEST_TOKENS = 512
+# The assumed TTFT of a worker before it reports one, in seconds
+DEFAULT_TTFT = 1.0
+# The number of points of each worker on the consistent hashing ring
+NUM_VIRTUAL_NODES = 64
+# The relative change of the speed of a worker that rebuilds the lottery
+SPEED_UPDATE_THRESHOLD = 0.1
+
 
+def stable_hash(key: str) -> int:
+    """A hash that is the same in every process, unlike `hash`."""
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "big")
 
-def heart_beat_controller(controller):
+
+async def heart_beat_controller(controller):
     while True:
-        time.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
+        await asyncio.sleep(CONTROLLER_HEART_BEAT_EXPIRATION)
         controller.remove_stale_workers_by_expiration()
 
 
+class CircuitBreaker:
+    """
+    Stops dispatching to a worker after `max_failures` consecutive failed
+    requests. After `cooldown` seconds, requests may try the worker again, and
+    the next failure opens the breaker again.
+    """
+
+    def __init__(self, max_failures: int, cooldown: float):
+        self.max_failures = max_failures
+        self.cooldown = cooldown
+        self.num_failures = 0
+        self.open_until = 0
+
+    def allow(self) -> bool:
+        return time.monotonic() >= self.open_until
+
+    def record_success(self):
+        self.num_failures = 0
+        self.open_until = 0
+
+    def record_failure(self):
+        self.num_failures += 1
+        if self.num_failures >= self.max_failures:
+            self.open_until = time.monotonic() + self.cooldown
+
+
+class ModelWorkers:
+    """The workers of one model, indexed for dispatching."""
+
+    def __init__(self):
+        # Dict[worker_name -> speed]
+        self.speeds = {}
+        self.worker_names = []
+        # Prefix sums of the speeds for a binary search in the lottery
+        self.cum_speeds = []
+        # Dict[worker_name -> queue_length / speed]
+        self.loads = {}
+        self.total_load = 0
+        # Min-heap of (load, worker_name). Every change of a load pushes a new
+        # entry, and the outdated ones are skipped lazily.
+        self.load_heap = []
+        # The consistent hashing ring, sorted by hash
+        self.ring_hashes = []
+        self.ring_workers = []
+
+    def add(self, worker_name: str, speed: float, load: float):
+        self.speeds[worker_name] = speed
+        self._rebuild_lottery()
+        self._rebuild_ring()
+        self.update_load(worker_name, load)
+
+    def remove(self, worker_name: str):
+        del self.speeds[worker_name]
+        self.total_load -= self.loads.pop(worker_name)
+        self._rebuild_lottery()
+        self._rebuild_ring()
+
+    def _rebuild_ring(self):
+        ring = sorted(
+            (stable_hash(f"{worker_name}#{i}"), worker_name)
+            for worker_name in self.speeds
+            for i in range(NUM_VIRTUAL_NODES)
+        )
+        self.ring_hashes = [h for h, _ in ring]
+        self.ring_workers = [w for _, w in ring]
+
+    def update_speed(self, worker_name: str, speed: float):
+        self.speeds[worker_name] = speed
+        self._rebuild_lottery()
+
+    def get_average_speed(self) -> float:
+        """The average speed of the workers, 0 if there are none."""
+        if not self.cum_speeds:
+            return 0.0
+        return self.cum_speeds[-1] / len(self.cum_speeds)
+
+    def _rebuild_lottery(self):
+        self.worker_names = list(self.speeds)
+        self.cum_speeds = []
+        total = 0
+        for speed in self.speeds.values():
+            total += speed
+            self.cum_speeds.append(total)
+
+    def update_load(self, worker_name: str, load: float):
+        self.total_load += load - self.loads.get(worker_name, 0)
+        self.loads[worker_name] = load
+        heapq.heappush(self.load_heap, (load, worker_name))
+        if len(self.load_heap) > 4 * len(self.loads) + 16:
+            self.load_heap = [(load, name) for name, load in self.loads.items()]
+            heapq.heapify(self.load_heap)
+
+    def pick_lottery(self) -> str:
+        if not self.cum_speeds or self.cum_speeds[-1] < 1e-4:
+            return ""
+        pt = bisect.bisect_right(self.cum_speeds, random.random() * self.cum_speeds[-1])
+        return self.worker_names[min(pt, len(self.worker_names) - 1)]
+
+    def pick_power_of_two(self) -> str:
+        """Pick the less loaded of two random workers."""
+        first, second = self.pick_lottery(), self.pick_lottery()
+        if first and self.loads[second] < self.loads[first]:
+            return second
+        return first
+
+    def pick_affinity(self, key: str, load_factor: float) -> str:
+        """
+        Consistent hashing with bounded loads: take the first worker after the
+        hash of `key` on the ring whose load stays under `load_factor` times
+        the average, so a hot key spills over to the next workers.
+
+        Reference: Mirrokni et al. Consistent Hashing with Bounded Loads.
+        https://arxiv.org/abs/1608.01350
+        """
+        if not self.ring_hashes:
+            return ""
+        # The least loaded worker is always under the bound.
+        bound = load_factor * (self.total_load + 1) / len(self.loads)
+        start = bisect.bisect(self.ring_hashes, stable_hash(key))
+        for i in range(len(self.ring_workers)):
+            worker_name = self.ring_workers[(start + i) % len(self.ring_workers)]
+            if self.loads[worker_name] < bound:
+                return worker_name
+        return self.pick_least_loaded()
+
+    def pick_least_loaded(self) -> str:
+        while self.load_heap:
+            load, worker_name = self.load_heap[0]
+            if self.loads.get(worker_name) == load:
+                return worker_name
+            heapq.heappop(self.load_heap)
+        return ""
+
+
 class Controller:
-    def __init__(self, dispatch_method: str):
+    def __init__(
+        self,
+        dispatch_method: str,
+        affinity_load_factor: float = 1.25,
+        max_attempts: int = 3,
+        hedge_delay: Optional[float] = None,
+        breaker_failures: int = 3,
+        breaker_cooldown: float = 30.0,
+        api_server_addresses: Optional[List[str]] = None,
+        api_server_key: Optional[str] = None,
+    ):
         # Dict[str -> WorkerInfo]
         self.worker_info = {}
+        # Dict[model_name -> ModelWorkers]
+        self.model_workers = {}
         self.dispatch_method = DispatchMethod.from_str(dispatch_method)
-
-        self.heart_beat_thread = threading.Thread(
-            target=heart_beat_controller, args=(self,)
+        self.affinity_load_factor = affinity_load_factor
+
+        # Proxying
+        self.max_attempts = max_attempts
+        self.hedge_delay = hedge_delay
+        self.breaker_failures = breaker_failures
+        self.breaker_cooldown = breaker_cooldown
+        # Dict[worker_name -> CircuitBreaker]
+        self.breakers = {}
+        # Dict[worker_name -> id of the open channel of the worker]
+        self.channels = {}
+        self.num_channels = 0
+
+        # The OpenAI API servers whose model caches are invalidated when
+        # workers register or are removed
+        self.api_server_addresses = api_server_addresses or []
+        self.api_server_key = api_server_key
+        self.notify_tasks = set()
+
+        self.client = httpx.AsyncClient(
+            limits=httpx.Limits(max_connections=1024, max_keepalive_connections=256)
         )
-        self.heart_beat_thread.start()
+        # Serializes refreshes. It is created in `start` on the event loop.
+        self.refresh_lock = None
+        self.heart_beat_task = None
 
-    def register_worker(
+    def start(self):
+        self.refresh_lock = asyncio.Lock()
+        self.heart_beat_task = asyncio.create_task(heart_beat_controller(self))
+
+    async def close(self):
+        if self.heart_beat_task is not None:
+            self.heart_beat_task.cancel()
+        await self.client.aclose()
+
+    async def register_worker(
         self,
         worker_name: str,
         check_heart_beat: bool,
@@ -85,11 +301,26 @@ class Controller:
             logger.info(f"Register an existing worker: {worker_name}")
 
         if not worker_status:
-            worker_status = self.get_worker_status(worker_name)
+            worker_status = await self.get_worker_status(worker_name)
         if not worker_status:
             return False
 
-        self.worker_info[worker_name] = WorkerInfo(
+        self._add_worker(worker_name, check_heart_beat, worker_status, multimodal)
+        # A worker that registers again may serve other models or context lengths.
+        self._notify_api_servers(worker_name)
+        logger.info(f"Register done: {worker_name}, {worker_status}")
+        return True
+
+    def _add_worker(
+        self,
+        worker_name: str,
+        check_heart_beat: bool,
+        worker_status: dict,
+        multimodal: bool,
+    ):
+        if worker_name in self.worker_info:
+            self.remove_worker(worker_name, notify=False)
+        w_info = WorkerInfo(
             worker_status["model_names"],
             worker_status["speed"],
             worker_status["queue_length"],
@@ -97,14 +328,54 @@ class Controller:
             time.time(),
             multimodal,
         )
-
-        logger.info(f"Register done: {worker_name}, {worker_status}")
-        return True
-
-    def get_worker_status(self, worker_name: str):
+        telemetry = worker_status.get("telemetry", None)
+        self._apply_telemetry(w_info, telemetry)
+        if telemetry and not telemetry.get("speed", 0):
+            # A worker that has not decoded yet is assumed to be as fast as
+            # its peers, so that the lottery does not starve it.
+            peers = [
+                self.model_workers[model_name].get_average_speed()
+                for model_name in w_info.model_names
+                if model_name in self.model_workers
+            ]
+            w_info.speed = max(peers + [w_info.speed, MIN_WORKER_SPEED])
+        self.worker_info[worker_name] = w_info
+        load = self._get_load(w_info)
+        for model_name in w_info.model_names:
+            if model_name not in self.model_workers:
+                self.model_workers[model_name] = ModelWorkers()
+            self.model_workers[model_name].add(worker_name, w_info.speed, load)
+
+    def _apply_telemetry(self, w_info: WorkerInfo, telemetry: Optional[dict]):
+        if not telemetry:
+            return
+        w_info.outstanding_tokens = telemetry["outstanding_tokens"]
+        w_info.avg_request_tokens = telemetry["avg_request_tokens"]
+        w_info.ttft = telemetry["ttft"]
+        w_info.kv_cache_usage = telemetry["kv_cache_usage"]
+        if telemetry.get("speed", 0) > 0:
+            w_info.speed = max(telemetry["speed"], MIN_WORKER_SPEED)
+
+    def _get_load(self, w_info: WorkerInfo) -> float:
+        """The load of a worker under the dispatch method, lower is better."""
+        if self.dispatch_method in (
+            DispatchMethod.LOTTERY,
+            DispatchMethod.SHORTEST_QUEUE,
+            DispatchMethod.AFFINITY,
+        ):
+            return w_info.queue_length / w_info.speed
+        # Avoid workers whose KV cache is almost full, they would preempt.
+        kv_penalty = 1 / max(1 - w_info.kv_cache_usage, 0.05)
+        if self.dispatch_method == DispatchMethod.EWMA_LATENCY:
+            # Peak EWMA: the expected latency grows with the requests in flight.
+            ttft = w_info.ttft or DEFAULT_TTFT
+            return ttft * (w_info.queue_length + 1) * kv_penalty
+        return w_info.outstanding_tokens / w_info.speed * kv_penalty
+
+    async def get_worker_status(self, worker_name: str):
         try:
-            r = requests.post(worker_name + "/worker_get_status", timeout=5)
-        except requests.exceptions.RequestException as e:
+            r = await self.client.post(worker_name + "/worker_get_status", timeout=5)
+        except httpx.HTTPError as e:
             logger.error(f"Get status fails: {worker_name}, {e}")
             return None
 
@@ -114,26 +385,66 @@ class Controller:
 
         return r.json()
 
-    def remove_worker(self, worker_name: str):
-        del self.worker_info[worker_name]
-
-    def refresh_all_workers(self):
-        old_info = dict(self.worker_info)
-        self.worker_info = {}
-
-        for w_name, w_info in old_info.items():
-            if not self.register_worker(
-                w_name, w_info.check_heart_beat, None, w_info.multimodal
-            ):
-                logger.info(f"Remove stale worker: {w_name}")
+    def remove_worker(self, worker_name: str, notify: bool = True):
+        w_info = self.worker_info.pop(worker_name)
+        for model_name in w_info.model_names:
+            model_workers = self.model_workers[model_name]
+            model_workers.remove(worker_name)
+            if not model_workers.speeds:
+                del self.model_workers[model_name]
+        if notify:
+            self._notify_api_servers(worker_name)
+
+    def _notify_api_servers(self, worker_name: str):
+        """Invalidate the cached model list and worker metadata of the API servers."""
+        if not self.api_server_addresses:
+            return
+        task = asyncio.ensure_future(self._invalidate_model_caches(worker_name))
+        self.notify_tasks.add(task)
+        task.add_done_callback(self.notify_tasks.discard)
+
+    async def _invalidate_model_caches(self, worker_name: str):
+        headers = {}
+        if self.api_server_key is not None:
+            headers["Authorization"] = f"Bearer {self.api_server_key}"
+
+        async def notify(api_server_address: str):
+            try:
+                r = await self.client.post(
+                    api_server_address + "/api/v1/invalidate_model_cache",
+                    json={"worker_address": worker_name},
+                    headers=headers,
+                    timeout=5,
+                )
+                r.raise_for_status()
+            except httpx.HTTPError as e:
+                # The entries of the API server expire after its TTL anyway.
+                logger.error(f"Invalidate fails: {api_server_address}, {e}")
+
+        await asyncio.gather(*[notify(a) for a in self.api_server_addresses])
+
+    async def refresh_all_workers(self):
+        async with self.refresh_lock:
+            old_info = dict(self.worker_info)
+            # Poll all workers concurrently. Routing keeps using the old table
+            # until the results are in.
+            statuses = await asyncio.gather(
+                *[self.get_worker_status(w_name) for w_name in old_info]
+            )
+            for (w_name, w_info), status in zip(old_info.items(), statuses):
+                if self.worker_info.get(w_name) is not w_info:
+                    # Re-registered or removed in the meantime.
+                    continue
+                if status:
+                    self._add_worker(
+                        w_name, w_info.check_heart_beat, status, w_info.multimodal
+                    )
+                else:
+                    logger.info(f"Remove stale worker: {w_name}")
+                    self.remove_worker(w_name)
 
     def list_models(self):
-        model_names = set()
-
-        for w_name, w_info in self.worker_info.items():
-            model_names.update(w_info.model_names)
-
-        return list(model_names)
+        return list(self.model_workers)
 
     def list_multimodal_models(self):
         model_names = set()
@@ -153,58 +464,81 @@ class Controller:
 
         return list(model_names)
 
-    def get_worker_address(self, model_name: str):
-        if self.dispatch_method == DispatchMethod.LOTTERY:
-            worker_names = []
-            worker_speeds = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_speeds.append(w_info.speed)
-            worker_speeds = np.array(worker_speeds, dtype=np.float32)
-            norm = np.sum(worker_speeds)
-            if norm < 1e-4:
-                return ""
-            worker_speeds = worker_speeds / norm
-            if True:  # Directly return address
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
-                return worker_name
-
-            # Check status before returning
-            while True:
-                pt = np.random.choice(np.arange(len(worker_names)), p=worker_speeds)
-                worker_name = worker_names[pt]
+    def get_worker_address(
+        self, model_name: str, affinity_key: Optional[str] = None, exclude=()
+    ):
+        """
+        :param affinity_key: Identifies a session (e.g., a user or conversation
+            id). The affinity dispatch method sends the requests of a session
+            to the same worker, so they reuse its prefix cache.
+        :param exclude: Workers that must not be picked, e.g., failed attempts.
+        """
+        model_workers = self.model_workers.get(model_name)
+        if model_workers is None:
+            return ""
 
-                if self.get_worker_status(worker_name):
-                    break
-                else:
-                    self.remove_worker(worker_name)
-                    worker_speeds[pt] = 0
-                    norm = np.sum(worker_speeds)
-                    if norm < 1e-4:
-                        return ""
-                    worker_speeds = worker_speeds / norm
-                    continue
-            return worker_name
-        elif self.dispatch_method == DispatchMethod.SHORTEST_QUEUE:
-            worker_names = []
-            worker_qlen = []
-            for w_name, w_info in self.worker_info.items():
-                if model_name in w_info.model_names:
-                    worker_names.append(w_name)
-                    worker_qlen.append(w_info.queue_length / w_info.speed)
-            if len(worker_names) == 0:
-                return ""
-            min_index = np.argmin(worker_qlen)
-            w_name = worker_names[min_index]
-            self.worker_info[w_name].queue_length += 1
-            logger.info(
-                f"names: {worker_names}, queue_lens: {worker_qlen}, ret: {w_name}"
+        if self.dispatch_method == DispatchMethod.LOTTERY:
+            w_name = model_workers.pick_lottery()
+        elif self.dispatch_method == DispatchMethod.AFFINITY and affinity_key:
+            w_name = model_workers.pick_affinity(
+                affinity_key, self.affinity_load_factor
             )
-            return w_name
+        elif self.dispatch_method == DispatchMethod.POWER_OF_TWO:
+            w_name = model_workers.pick_power_of_two()
         else:
-            raise ValueError(f"Invalid dispatch method: {self.dispatch_method}")
+            w_name = model_workers.pick_least_loaded()
+
+        if w_name and not self.is_available(w_name, exclude):
+            # Fall back to the least loaded available worker.
+            candidates = [
+                w for w in model_workers.loads if self.is_available(w, exclude)
+            ]
+            w_name = min(candidates, key=model_workers.loads.get, default="")
+
+        if w_name and self.dispatch_method != DispatchMethod.LOTTERY:
+            # Count the request until the worker reports its next telemetry.
+            w_info = self.worker_info[w_name]
+            w_info.queue_length += 1
+            w_info.outstanding_tokens += (
+                w_info.avg_request_tokens or DEFAULT_REQUEST_TOKENS
+            )
+            self._update_load(w_name)
+            logger.info(f"model: {model_name}, ret: {w_name}")
+        return w_name
+
+    def is_available(self, worker_name: str, exclude=()) -> bool:
+        breaker = self.breakers.get(worker_name)
+        return worker_name not in exclude and (breaker is None or breaker.allow())
+
+    def record_success(self, worker_name: str):
+        if worker_name in self.breakers:
+            self.breakers[worker_name].record_success()
+
+    def record_failure(self, worker_name: str):
+        if worker_name not in self.breakers:
+            self.breakers[worker_name] = CircuitBreaker(
+                self.breaker_failures, self.breaker_cooldown
+            )
+        self.breakers[worker_name].record_failure()
+
+    def _pick_proxy_worker(self, params, tried) -> str:
+        """The worker of the next attempt, the caller's choice comes first."""
+        preferred = params.get("worker_address", None)
+        if not tried and preferred in self.worker_info and self.is_available(preferred):
+            return preferred
+        return self.get_worker_address(
+            params["model"], params.get("affinity_key", None), tried
+        )
+
+    def _update_load(self, worker_name: str):
+        w_info = self.worker_info[worker_name]
+        load = self._get_load(w_info)
+        for model_name in w_info.model_names:
+            model_workers = self.model_workers[model_name]
+            old_speed = model_workers.speeds[worker_name]
+            if abs(w_info.speed - old_speed) > SPEED_UPDATE_THRESHOLD * old_speed:
+                model_workers.update_speed(worker_name, w_info.speed)
+            model_workers.update_load(worker_name, load)
 
     def receive_heart_beat(self, worker_name: str, queue_length: int):
         if worker_name not in self.worker_info:
@@ -213,9 +547,71 @@ class Controller:
 
         self.worker_info[worker_name].queue_length = queue_length
         self.worker_info[worker_name].last_heart_beat = time.time()
+        self._update_load(worker_name)
         logger.info(f"Receive heart beat. {worker_name}")
         return True
 
+    def receive_telemetry(self, worker_name: str, queue_length: int, telemetry: dict):
+        if worker_name not in self.worker_info:
+            return False
+
+        w_info = self.worker_info[worker_name]
+        w_info.queue_length = queue_length
+        w_info.last_heart_beat = time.time()
+        self._apply_telemetry(w_info, telemetry)
+        self._update_load(worker_name)
+        return True
+
+    async def handle_worker_channel(self, stream):
+        """
+        Receive the load updates of a worker over a long-lived streaming POST
+        of newline-delimited JSON messages. The worker pushes a message when a
+        request starts or finishes and pings every WORKER_TELEMETRY_INTERVAL
+        seconds. When the channel breaks or goes silent for
+        WORKER_CHANNEL_TIMEOUT seconds, the worker is removed right away
+        instead of after CONTROLLER_HEART_BEAT_EXPIRATION.
+        """
+        self.num_channels += 1
+        channel_id = self.num_channels
+        worker_name = None
+        buffer = b""
+        chunks = stream.__aiter__()
+        try:
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(
+                        chunks.__anext__(), timeout=WORKER_CHANNEL_TIMEOUT
+                    )
+                except StopAsyncIteration:
+                    break
+                buffer += chunk
+                *lines, buffer = buffer.split(b"\n")
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    msg = json.loads(line)
+                    if worker_name is None:
+                        worker_name = msg["worker_name"]
+                        self.channels[worker_name] = channel_id
+                        logger.info(f"Open worker channel: {worker_name}")
+                    if not self.receive_telemetry(
+                        worker_name, msg["queue_length"], msg["telemetry"]
+                    ):
+                        # Close the channel so that the worker registers again.
+                        logger.info(f"Receive unknown channel. {worker_name}")
+                        return
+        except asyncio.TimeoutError:
+            logger.info(f"Worker channel timeout: {worker_name}")
+        except ClientDisconnect:
+            pass
+        finally:
+            # A reconnected worker may already own a newer channel.
+            if worker_name is not None and self.channels.get(worker_name) == channel_id:
+                del self.channels[worker_name]
+                logger.info(f"Close worker channel: {worker_name}")
+                if worker_name in self.worker_info:
+                    self.remove_worker(worker_name)
+
     def remove_stale_workers_by_expiration(self):
         expire = time.time() - CONTROLLER_HEART_BEAT_EXPIRATION
         to_delete = []
@@ -244,51 +640,162 @@ class Controller:
 
     # Let the controller act as a worker to achieve hierarchical
     # management. This can be used to connect isolated sub networks.
-    def worker_api_get_status(self):
+    async def worker_api_get_status(self):
         model_names = set()
+        model_paths = {}
         speed = 0
         queue_length = 0
 
-        for w_name in self.worker_info:
-            worker_status = self.get_worker_status(w_name)
+        statuses = await asyncio.gather(
+            *[self.get_worker_status(w_name) for w_name in self.worker_info]
+        )
+        for worker_status in statuses:
             if worker_status is not None:
                 model_names.update(worker_status["model_names"])
+                model_paths.update(worker_status.get("model_paths", {}))
                 speed += worker_status["speed"]
                 queue_length += worker_status["queue_length"]
 
         model_names = sorted(list(model_names))
         return {
             "model_names": model_names,
+            "model_paths": model_paths,
             "speed": speed,
             "queue_length": queue_length,
         }
 
-    def worker_api_generate_stream(self, params):
-        worker_addr = self.get_worker_address(params["model"])
-        if not worker_addr:
+    async def worker_api_generate_stream(self, params):
+        """
+        Proxy a streaming request. Until the first chunk is sent, a failed
+        attempt is retried on another worker.
+        """
+        tried = set()
+        worker_addr = None
+        overloaded = None
+        while len(tried) < self.max_attempts:
+            worker_addr = self._pick_proxy_worker(params, tried)
+            if not worker_addr:
+                break
+            tried.add(worker_addr)
+            started = False
+            try:
+                async with self.client.stream(
+                    "POST",
+                    worker_addr + "/worker_generate_stream",
+                    json=params,
+                    timeout=WORKER_API_TIMEOUT,
+                ) as response:
+                    if response.status_code == 429:
+                        # The queue of the worker is full, try another one.
+                        overloaded = await response.aread()
+                        continue
+                    response.raise_for_status()
+                    buffer = b""
+                    async for raw_chunk in response.aiter_raw():
+                        buffer += raw_chunk
+                        while (chunk_end := buffer.find(b"\0")) >= 0:
+                            chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+                            if chunk:
+                                started = True
+                                yield chunk + b"\0"
+                self.record_success(worker_addr)
+                return
+            except httpx.HTTPError as e:
+                self.record_failure(worker_addr)
+                if started:
+                    yield self.handle_worker_timeout(worker_addr)
+                    return
+                logger.info(f"worker failed: {worker_addr}, {e}. Retry.")
+
+        if not tried:
             yield self.handle_no_worker(params)
+        elif overloaded is not None:
+            yield overloaded + b"\0"
+        else:
+            yield self.handle_worker_timeout(worker_addr)
 
+    async def _post_generate(self, worker_addr: str, params):
+        r = await self.client.post(
+            worker_addr + "/worker_generate", json=params, timeout=WORKER_API_TIMEOUT
+        )
+        if r.status_code != 429:
+            r.raise_for_status()
+        return r.json()
+
+    async def worker_api_generate(self, params):
+        """
+        Proxy a non-streaming request. A failed attempt is retried on another
+        worker. With a hedge delay, an attempt that has not answered within the
+        delay is duplicated on another worker, and the first response wins.
+        """
+        tried = set()
+        overloaded = None
+        # Dict[asyncio.Task -> worker_addr]
+        pending = {}
         try:
-            response = requests.post(
-                worker_addr + "/worker_generate_stream",
-                json=params,
-                stream=True,
-                timeout=WORKER_API_TIMEOUT,
-            )
-            for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-                if chunk:
-                    yield chunk + b"\0"
-        except requests.exceptions.RequestException as e:
-            yield self.handle_worker_timeout(worker_addr)
+            while True:
+                if len(tried) < self.max_attempts:
+                    worker_addr = self._pick_proxy_worker(params, tried)
+                    if worker_addr:
+                        tried.add(worker_addr)
+                        task = asyncio.create_task(
+                            self._post_generate(worker_addr, params)
+                        )
+                        pending[task] = worker_addr
+                if not pending:
+                    break
+
+                can_hedge = (
+                    self.hedge_delay is not None and len(tried) < self.max_attempts
+                )
+                done, _ = await asyncio.wait(
+                    pending,
+                    timeout=self.hedge_delay if can_hedge else None,
+                    return_when=asyncio.FIRST_COMPLETED,
+                )
+                for task in done:
+                    worker_addr = pending.pop(task)
+                    if task.exception() is None:
+                        ret = task.result()
+                        if ret.get("error_code") == ErrorCode.ENGINE_OVERLOADED:
+                            # The queue of the worker is full, try another one.
+                            overloaded = ret
+                            continue
+                        self.record_success(worker_addr)
+                        return ret
+                    self.record_failure(worker_addr)
+                    logger.info(f"worker failed: {worker_addr}, {task.exception()}")
+        finally:
+            for task in pending:
+                task.cancel()
+
+        if overloaded is not None:
+            return overloaded
+        error_code = (
+            ErrorCode.CONTROLLER_WORKER_TIMEOUT
+            if tried
+            else ErrorCode.CONTROLLER_NO_WORKER
+        )
+        return {"text": SERVER_ERROR_MSG, "error_code": error_code}
 
 
 app = FastAPI()
 
 
+@app.on_event("startup")
+async def startup_controller():
+    controller.start()
+
+
+@app.on_event("shutdown")
+async def shutdown_controller():
+    await controller.close()
+
+
 @app.post("/register_worker")
 async def register_worker(request: Request):
     data = await request.json()
-    controller.register_worker(
+    await controller.register_worker(
         data["worker_name"],
         data["check_heart_beat"],
         data.get("worker_status", None),
@@ -298,7 +805,7 @@ async def register_worker(request: Request):
 
 @app.post("/refresh_all_workers")
 async def refresh_all_workers():
-    models = controller.refresh_all_workers()
+    models = await controller.refresh_all_workers()
 
 
 @app.post("/list_models")
@@ -322,7 +829,7 @@ async def list_language_models():
 @app.post("/get_worker_address")
 async def get_worker_address(request: Request):
     data = await request.json()
-    addr = controller.get_worker_address(data["model"])
+    addr = controller.get_worker_address(data["model"], data.get("affinity_key"))
     return {"address": addr}
 
 
@@ -333,6 +840,22 @@ async def receive_heart_beat(request: Request):
     return {"exist": exist}
 
 
+@app.post("/receive_telemetry")
+async def receive_telemetry(request: Request):
+    data = await request.json()
+    exist = controller.receive_telemetry(
+        data["worker_name"], data["queue_length"], data["telemetry"]
+    )
+    return {"exist": exist}
+
+
+@app.post("/worker_channel")
+async def worker_channel(request: Request):
+    await controller.handle_worker_channel(request.stream())
+    # Drop the connection, the worker may still be sending.
+    return JSONResponse({}, headers={"Connection": "close"})
+
+
 @app.post("/worker_generate_stream")
 async def worker_api_generate_stream(request: Request):
     params = await request.json()
@@ -340,9 +863,15 @@ async def worker_api_generate_stream(request: Request):
     return StreamingResponse(generator)
 
 
+@app.post("/worker_generate")
+async def worker_api_generate(request: Request):
+    params = await request.json()
+    return await controller.worker_api_generate(params)
+
+
 @app.post("/worker_get_status")
 async def worker_api_get_status(request: Request):
-    return controller.worker_api_get_status()
+    return await controller.worker_api_get_status()
 
 
 @app.get("/test_connection")
@@ -357,9 +886,23 @@ def create_controller():
     parser.add_argument(
         "--dispatch-method",
         type=str,
-        choices=["lottery", "shortest_queue"],
+        choices=[
+            "lottery",
+            "shortest_queue",
+            "least_outstanding_tokens",
+            "power_of_two",
+            "ewma_latency",
+            "affinity",
+        ],
         default="shortest_queue",
     )
+    parser.add_argument(
+        "--affinity-load-factor",
+        type=float,
+        default=1.25,
+        help="The affinity dispatch method sends a session to another worker "
+        "once its worker has this many times the average load.",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -367,10 +910,58 @@ def create_controller():
         default=False,
         help="Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.",
     )
+    parser.add_argument(
+        "--max-attempts",
+        type=int,
+        default=3,
+        help="The number of workers a proxied request may try.",
+    )
+    parser.add_argument(
+        "--hedge-delay",
+        type=float,
+        default=None,
+        help="Seconds before a proxied non-streaming request is duplicated on "
+        "another worker. Disabled by default.",
+    )
+    parser.add_argument(
+        "--breaker-failures",
+        type=int,
+        default=3,
+        help="Consecutive failures of a worker before it stops receiving requests.",
+    )
+    parser.add_argument(
+        "--breaker-cooldown",
+        type=float,
+        default=30.0,
+        help="Seconds before a worker with an open circuit breaker is tried again.",
+    )
+    parser.add_argument(
+        "--api-server-addresses",
+        type=lambda s: s.split(","),
+        default=None,
+        help="Comma separated addresses of OpenAI API servers, e.g., "
+        "http://localhost:8000. Their cached model lists are invalidated when "
+        "workers register or are removed.",
+    )
+    parser.add_argument(
+        "--api-server-key",
+        type=str,
+        default=None,
+        help="The API key for the API servers, if they are started with --api-keys.",
+    )
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
-    controller = Controller(args.dispatch_method)
+    controller = Controller(
+        args.dispatch_method,
+        args.affinity_load_factor,
+        max_attempts=args.max_attempts,
+        hedge_delay=args.hedge_delay,
+        breaker_failures=args.breaker_failures,
+        breaker_cooldown=args.breaker_cooldown,
+        api_server_addresses=args.api_server_addresses,
+        api_server_key=args.api_server_key,
+    )
     return args, controller
 
 
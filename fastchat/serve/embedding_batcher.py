@@ -0,0 +1,166 @@
+"""
+Dynamic micro-batching of the embedding requests of a model worker.
+
+Concurrent requests are collected for a few milliseconds and embedded
+together, so that many small requests share one forward pass. The normalized
+embeddings of the texts seen recently can be kept in an LRU cache keyed by
+the hash of the text, so that the same chunk is not embedded twice.
+"""
+from collections import OrderedDict
+from concurrent.futures import Future
+import hashlib
+import queue
+import threading
+import time
+from typing import Callable, List, Optional, Tuple
+
+import torch
+
+
+class EmbeddingCache:
+    def __init__(self, max_size: int):
+        """
+        :param max_size: The maximum number of cached embeddings.
+        """
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        # OrderedDict[text hash -> (embedding, token_num)], the most recently
+        # used ones at the end.
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def __repr__(self):
+        return (
+            f"EmbeddingCache(size={len(self.entries)}/{self.max_size}, "
+            f"hits={self.hits}, misses={self.misses})"
+        )
+
+    @staticmethod
+    def get_key(text: str) -> bytes:
+        return hashlib.sha1(text.encode("utf-8")).digest()
+
+    def get(self, key: bytes) -> Optional[Tuple[torch.Tensor, int]]:
+        with self.lock:
+            entry = self.entries.get(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(self, key: bytes, embedding: torch.Tensor, token_num: int):
+        with self.lock:
+            self.entries[key] = (embedding, token_num)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+
+
+class EmbeddingJob:
+    def __init__(self, inputs: List[str]):
+        self.inputs = inputs
+        self.future = Future()
+
+
+class EmbeddingBatcher:
+    def __init__(
+        self,
+        embed_func: Callable[[List[str]], Tuple[torch.Tensor, List[int]]],
+        max_batch_size: int = 32,
+        max_wait: float = 0.005,
+        cache_size: int = 0,
+    ):
+        """
+        :param embed_func: Embeds a list of texts, returns the normalized
+            embeddings of shape [len(texts), dim] and the token count of each text.
+        :param max_batch_size: Stop collecting requests at this many texts.
+        :param max_wait: Seconds to wait for more requests after the first one.
+        :param cache_size: The number of cached embeddings, 0 disables the cache.
+        """
+        self.embed_func = embed_func
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.cache = EmbeddingCache(cache_size) if cache_size > 0 else None
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.lock = threading.Lock()
+
+    def embed(self, inputs: List[str]) -> Tuple[torch.Tensor, List[int]]:
+        """Embed the texts of one request together with the concurrent ones."""
+        embeddings = [None] * len(inputs)
+        token_nums = [0] * len(inputs)
+        # Dict[text hash -> indices of the texts to embed]
+        misses = OrderedDict()
+        for i, text in enumerate(inputs):
+            key = EmbeddingCache.get_key(text)
+            entry = self.cache.get(key) if self.cache is not None else None
+            if entry is not None:
+                embeddings[i], token_nums[i] = entry
+            else:
+                misses.setdefault(key, []).append(i)
+
+        if misses:
+            miss_inputs = [inputs[indices[0]] for indices in misses.values()]
+            miss_embeddings, miss_token_nums = self._submit(miss_inputs)
+            for (key, indices), embedding, token_num in zip(
+                misses.items(), miss_embeddings, miss_token_nums
+            ):
+                if self.cache is not None:
+                    self.cache.put(key, embedding.clone(), token_num)
+                for i in indices:
+                    embeddings[i], token_nums[i] = embedding, token_num
+
+        return torch.stack(embeddings), token_nums
+
+    def _submit(self, inputs: List[str]) -> Tuple[torch.Tensor, List[int]]:
+        if self.max_wait <= 0:
+            embeddings, token_nums = self.embed_func(inputs)
+            return embeddings.cpu(), token_nums
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(
+                    target=self._loop, name="embedding_batcher", daemon=True
+                )
+                self.thread.start()
+        job = EmbeddingJob(inputs)
+        self.jobs.put(job)
+        return job.future.result()
+
+    def _loop(self):
+        pending = None
+        while True:
+            jobs = [pending or self.jobs.get()]
+            pending = None
+            num_inputs = len(jobs[0].inputs)
+            deadline = time.monotonic() + self.max_wait
+            while num_inputs < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    job = self.jobs.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                if num_inputs + len(job.inputs) > self.max_batch_size:
+                    pending = job
+                    break
+                jobs.append(job)
+                num_inputs += len(job.inputs)
+            self._run(jobs)
+
+    def _run(self, jobs: List[EmbeddingJob]):
+        inputs = [text for job in jobs for text in job.inputs]
+        try:
+            embeddings, token_nums = self.embed_func(inputs)
+            embeddings = embeddings.cpu()
+        except Exception as e:
+            for job in jobs:
+                job.future.set_exception(e)
+            return
+        start = 0
+        for job in jobs:
+            end = start + len(job.inputs)
+            job.future.set_result((embeddings[start:end], token_nums[start:end]))
+            start = end
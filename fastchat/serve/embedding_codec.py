@@ -0,0 +1,68 @@
+"""
+The binary format of the embeddings sent by a model worker to the API server.
+
+A fixed header (magic, dtype, rows, dimension, token count) is followed by the
+row-major little-endian buffer of the embeddings. The API server base64-encodes
+the rows of the buffer for the clients without converting them to Python
+floats and back.
+"""
+import base64
+import struct
+from typing import List, Tuple
+
+import numpy as np
+
+EMBEDDING_MAGIC = b"FCEB"
+# magic, dtype code, rows, dimension, token count
+EMBEDDING_HEADER = struct.Struct("<4sBIIQ")
+EMBEDDING_DTYPES = {
+    "float32": np.dtype("<f4"),
+    "float16": np.dtype("<f2"),
+    "int8": np.dtype("i1"),
+}
+EMBEDDING_DTYPE_CODES = list(EMBEDDING_DTYPES)
+
+
+def cast_embeddings(embeddings: np.ndarray, dtype: str) -> np.ndarray:
+    """Cast normalized embeddings, int8 maps [-1, 1] to [-127, 127]."""
+    if dtype not in EMBEDDING_DTYPES:
+        raise ValueError(
+            f"Unsupported embedding dtype {dtype}, "
+            f"expected one of {EMBEDDING_DTYPE_CODES}."
+        )
+    if dtype == "int8":
+        embeddings = np.clip(np.rint(embeddings * 127), -127, 127)
+    return embeddings.astype(EMBEDDING_DTYPES[dtype])
+
+
+def encode_embeddings(
+    embeddings: np.ndarray, token_num: int, dtype: str = "float32"
+) -> bytes:
+    array = np.ascontiguousarray(cast_embeddings(embeddings, dtype))
+    rows, dim = array.shape
+    header = EMBEDDING_HEADER.pack(
+        EMBEDDING_MAGIC, EMBEDDING_DTYPE_CODES.index(dtype), rows, dim, token_num
+    )
+    return header + array.tobytes()
+
+
+def is_binary_embeddings(data: bytes) -> bool:
+    return data[: len(EMBEDDING_MAGIC)] == EMBEDDING_MAGIC
+
+
+def decode_embeddings(data: bytes) -> Tuple[np.ndarray, int]:
+    """Return a read-only view of the embeddings in `data` and the token count."""
+    _, code, rows, dim, token_num = EMBEDDING_HEADER.unpack_from(data)
+    array = np.frombuffer(
+        data,
+        dtype=EMBEDDING_DTYPES[EMBEDDING_DTYPE_CODES[code]],
+        count=rows * dim,
+        offset=EMBEDDING_HEADER.size,
+    )
+    return array.reshape(rows, dim), token_num
+
+
+def embeddings_to_base64(embeddings: np.ndarray) -> List[str]:
+    """Encode each row, `np.frombuffer(base64.b64decode(s), dtype)` decodes it."""
+    embeddings = np.ascontiguousarray(embeddings)
+    return [base64.b64encode(row).decode("utf-8") for row in embeddings]
@@ -52,6 +52,7 @@ disable_btn = gr.Button(interactive=False)
 invisible_btn = gr.Button(interactive=False, visible=False)
 
 controller_url = None
+use_controller_proxy = False
 enable_moderation = False
 
 acknowledgment_md = """
@@ -116,10 +117,11 @@ class State:
         return base
 
 
-def set_global_vars(controller_url_, enable_moderation_):
-    global controller_url, enable_moderation
+def set_global_vars(controller_url_, enable_moderation_, use_controller_proxy_=False):
+    global controller_url, enable_moderation, use_controller_proxy
     controller_url = controller_url_
     enable_moderation = enable_moderation_
+    use_controller_proxy = use_controller_proxy_
 
 
 def get_conv_log_filename():
@@ -311,6 +313,7 @@ def model_worker_stream_iter(
     top_p,
     max_new_tokens,
     images,
+    proxy_url=None,
 ):
     # Make requests
     gen_params = {
@@ -330,18 +333,24 @@ def model_worker_stream_iter(
     if len(images) > 0:
         gen_params["images"] = images
 
-    # Stream output
-    response = requests.post(
+    if proxy_url is not None:
+        # The proxy tries worker_addr first and fails over to other workers.
+        gen_params["worker_address"] = worker_addr
+        worker_addr = proxy_url
+
+    # Stream output. Closing the iterator closes the connection, which stops
+    # the generation on the worker.
+    with requests.post(
         worker_addr + "/worker_generate_stream",
         headers=headers,
         json=gen_params,
         stream=True,
         timeout=WORKER_API_TIMEOUT,
-    )
-    for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
-        if chunk:
-            data = json.loads(chunk.decode())
-            yield data
+    ) as response:
+        for chunk in response.iter_lines(decode_unicode=False, delimiter=b"\0"):
+            if chunk:
+                data = json.loads(chunk.decode())
+                yield data
 
 
 def is_limit_reached(model_name, ip):
@@ -396,7 +405,8 @@ def bot_response(
     if model_api_dict is None:
         # Query worker address
         ret = requests.post(
-            controller_url + "/get_worker_address", json={"model": model_name}
+            controller_url + "/get_worker_address",
+            json={"model": model_name, "affinity_key": state.conv_id},
         )
         worker_addr = ret.json()["address"]
         logger.info(f"model_name: {model_name}, worker_addr: {worker_addr}")
@@ -435,6 +445,7 @@ def bot_response(
             top_p,
             max_new_tokens,
             images,
+            proxy_url=controller_url if use_controller_proxy else None,
         )
     else:
         stream_iter = get_api_provider_stream_iter(
@@ -495,6 +506,9 @@ def bot_response(
             enable_btn,
         )
         return
+    finally:
+        # Stop the generation if the user left before the end.
+        stream_iter.close()
 
     finish_tstamp = time.time()
     logger.info(f"{output}")
@@ -860,11 +874,16 @@ if __name__ == "__main__":
         type=str,
         help="Sets the gradio root path, eg /abc/def. Useful when running behind a reverse-proxy or at a custom URL path prefix",
     )
+    parser.add_argument(
+        "--use-controller-proxy",
+        action="store_true",
+        help="Stream through the controller, which fails over to another worker",
+    )
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
     # Set global variables
-    set_global_vars(args.controller_url, args.moderate)
+    set_global_vars(args.controller_url, args.moderate, args.use_controller_proxy)
     models, all_models = get_model_list(
         args.controller_url, args.register_api_endpoint_file, False
     )
@@ -235,11 +235,16 @@ if __name__ == "__main__":
         help="the Google Analytics ID",
         default=None,
     )
+    parser.add_argument(
+        "--use-controller-proxy",
+        action="store_true",
+        help="Stream through the controller, which fails over to another worker",
+    )
     args = parser.parse_args()
     logger.info(f"args: {args}")
 
     # Set global variables
-    set_global_vars(args.controller_url, args.moderate)
+    set_global_vars(args.controller_url, args.moderate, args.use_controller_proxy)
     set_global_vars_named(args.moderate)
     set_global_vars_anony(args.moderate)
     models, all_models = get_model_list(
@@ -22,7 +22,6 @@ Register models in a JSON file with the following format:
 "model_path", "api_base", "token", and "context_length" are necessary, while others are optional.
 """
 import argparse
-import asyncio
 import json
 import uuid
 import os
@@ -35,8 +34,13 @@ from fastapi.responses import JSONResponse, StreamingResponse
 from huggingface_hub import InferenceClient
 
 from fastchat.constants import SERVER_ERROR_MSG, ErrorCode
+from fastchat.serve.admission import (
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
 from fastchat.serve.base_model_worker import BaseModelWorker
-from fastchat.utils import build_logger
+from fastchat.utils import StopStringMatcher, build_logger
 
 worker_id = str(uuid.uuid4())[:8]
 logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
@@ -44,6 +48,7 @@ logger = build_logger("model_worker", f"model_worker_{worker_id}.log")
 workers = []
 worker_map = {}
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 
 
 # reference to
@@ -80,13 +85,6 @@ def get_gen_kwargs(
     return gen_kwargs
 
 
-def could_be_stop(text, stop):
-    for s in stop:
-        if any(text.endswith(s[:i]) for i in range(1, len(s) + 1)):
-            return True
-    return False
-
-
 class HuggingfaceApiWorker(BaseModelWorker):
     def __init__(
         self,
@@ -161,17 +159,18 @@ class HuggingfaceApiWorker(BaseModelWorker):
 
             reason = None
             text = ""
+            stop_matcher = StopStringMatcher(stop)
             for chunk in res:
                 if chunk.token.special:
                     continue
                 text += chunk.token.text
 
-                s = next((x for x in stop if text.endswith(x)), None)
-                if s is not None:
-                    text = text[: -len(s)]
+                pos, partial_len = stop_matcher.update(text)
+                if pos != -1:
+                    text = text[:pos]
                     reason = "stop"
                     break
-                if could_be_stop(text, stop):
+                if partial_len > 0:
                     continue
                 if (
                     chunk.details is not None
@@ -203,13 +202,13 @@ class HuggingfaceApiWorker(BaseModelWorker):
 
 
 def release_worker_semaphore(worker):
-    worker.semaphore.release()
+    worker.admission_queue.release()
+    worker.push_load()
 
 
-def acquire_worker_semaphore(worker):
-    if worker.semaphore is None:
-        worker.semaphore = asyncio.Semaphore(worker.limit_worker_concurrency)
-    return worker.semaphore.acquire()
+def acquire_worker_semaphore(worker, params):
+    worker.push_load()
+    return worker.admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks(worker):
@@ -222,7 +221,7 @@ def create_background_tasks(worker):
 async def api_generate_stream(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
-    await acquire_worker_semaphore(worker)
+    await acquire_worker_semaphore(worker, params)
     generator = worker.generate_stream_gate(params)
     background_tasks = create_background_tasks(worker)
     return StreamingResponse(generator, background=background_tasks)
@@ -232,9 +231,11 @@ async def api_generate_stream(request: Request):
 async def api_generate(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
-    await acquire_worker_semaphore(worker)
-    output = worker.generate_gate(params)
-    release_worker_semaphore(worker)
+    await acquire_worker_semaphore(worker, params)
+    try:
+        output = await worker.run_in_executor(worker.generate_gate, params)
+    finally:
+        release_worker_semaphore(worker)
     return JSONResponse(output)
 
 
@@ -242,7 +243,7 @@ async def api_generate(request: Request):
 async def api_get_embeddings(request: Request):
     params = await request.json()
     worker = worker_map[params["model"]]
-    await acquire_worker_semaphore(worker)
+    await acquire_worker_semaphore(worker, params)
     embedding = worker.get_embeddings(params)
     release_worker_semaphore(worker)
     return JSONResponse(content=embedding)
@@ -6,7 +6,7 @@ import math
 import os
 import sys
 import time
-from typing import Iterable, Optional, Dict
+from typing import Optional, Dict, List
 import warnings
 
 import psutil
@@ -39,7 +39,18 @@ from fastchat.modules.awq import AWQConfig
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
-from fastchat.utils import is_partial_stop, is_sentence_complete, get_context_length
+from fastchat.serve.sampler import (
+    SamplingParams,
+    compute_logprobs,
+    decode_top_logprobs,
+    sample,
+)
+from fastchat.utils import (
+    IncrementalDetokenizer,
+    StopStringMatcher,
+    is_sentence_complete,
+    get_context_length,
+)
 
 
 def prepare_logits_processor(
@@ -67,6 +78,8 @@ def generate_stream(
     context_len: int,
     stream_interval: int = 2,
     judge_sent_end: bool = False,
+    prefix_cache=None,
+    kv_cache=None,
 ):
     if hasattr(model, "device"):
         device = model.device
@@ -74,21 +87,17 @@ def generate_stream(
     # Read parameters
     prompt = params["prompt"]
     len_prompt = len(prompt)
-    temperature = float(params.get("temperature", 1.0))
-    repetition_penalty = float(params.get("repetition_penalty", 1.0))
-    top_p = float(params.get("top_p", 1.0))
-    top_k = int(params.get("top_k", -1))  # -1 means disable
     max_new_tokens = int(params.get("max_new_tokens", 256))
-    logprobs = params.get("logprobs", None)  # FIXME: Support logprobs>1.
+    logprobs = params.get("logprobs", None)  # The number of top logprobs
     echo = bool(params.get("echo", True))
     stop_str = params.get("stop", None)
     stop_token_ids = params.get("stop_token_ids", None) or []
     if tokenizer.eos_token_id not in stop_token_ids:
         stop_token_ids.append(tokenizer.eos_token_id)
+    # Set when the client is gone
+    cancel_event = params.get("cancel_event", None)
 
-    logits_processor = prepare_logits_processor(
-        temperature, repetition_penalty, top_p, top_k
-    )
+    sampling_params = SamplingParams.from_request(params)
     input_ids = tokenizer(prompt).input_ids
 
     if model.config.is_encoder_decoder:
@@ -114,206 +123,272 @@ def generate_stream(
     else:
         start_ids = torch.as_tensor([input_ids], device=device)
 
+    # Reuse the KV cache of the longest cached prompt prefix. The prompt
+    # logprobs need the logits of every prompt token, so skip it for them.
+    num_cached, cached_key_values = 0, None
+    if prefix_cache is not None and logprobs is None:
+        num_cached, cached_key_values = prefix_cache.lookup(input_ids)
+
+    # Keep the KV cache in the shared paged pool between decoding steps.
+    paged_seq = None
+    if kv_cache is not None and not model.config.is_encoder_decoder:
+        paged_seq = kv_cache.add_sequence()
+
     past_key_values = out = None
     token_logprobs = [None]  # The first token has no logprobs.
+    top_logprobs = [None]
+    detokenizer = IncrementalDetokenizer(tokenizer, 0 if echo else input_echo_len)
+    stop_matcher = StopStringMatcher(stop_str, len_prompt if echo else 0)
+    token_texts = []  # The decoded text of each returned token for logprobs.
+    text_offsets = []
+    top_texts = []
     sent_interrupt = False
     finish_reason = None
     stopped = False
-    for i in range(max_new_tokens):
-        if i == 0:  # prefill
-            if model.config.is_encoder_decoder:
-                out = model.decoder(
-                    input_ids=start_ids,
-                    encoder_hidden_states=encoder_output,
-                    use_cache=True,
-                )
-                logits = model.lm_head(out[0])
-            else:
-                out = model(input_ids=start_ids, use_cache=True)
-                logits = out.logits
-            past_key_values = out.past_key_values
-
-            if logprobs is not None:
-                # Prefull logprobs for the prompt.
-                shift_input_ids = start_ids[..., 1:].contiguous()
-                shift_logits = logits[..., :-1, :].contiguous()
-                shift_logits = torch.log_softmax(shift_logits, dim=-1).tolist()
-                for label_id, logit in zip(
-                    shift_input_ids[0].tolist(), shift_logits[0]
-                ):
-                    token_logprobs.append(logit[label_id])
-        else:  # decoding
-            if model.config.is_encoder_decoder:
-                out = model.decoder(
-                    input_ids=torch.as_tensor(
-                        [[token] if not sent_interrupt else output_ids],
-                        device=device,
-                    ),
-                    encoder_hidden_states=encoder_output,
-                    use_cache=True,
-                    past_key_values=past_key_values if not sent_interrupt else None,
-                )
-                sent_interrupt = False
-
-                logits = model.lm_head(out[0])
-            else:
-                out = model(
-                    input_ids=torch.as_tensor(
-                        [[token] if not sent_interrupt else output_ids],
-                        device=device,
-                    ),
-                    use_cache=True,
-                    past_key_values=past_key_values if not sent_interrupt else None,
-                )
-                sent_interrupt = False
-                logits = out.logits
-            past_key_values = out.past_key_values
-
-        if logits_processor:
-            if repetition_penalty > 1.0:
-                tmp_output_ids = torch.as_tensor([output_ids], device=logits.device)
-            else:
-                tmp_output_ids = None
-            last_token_logits = logits_processor(tmp_output_ids, logits[:, -1, :])[0]
-        else:
-            last_token_logits = logits[0, -1, :]
-
-        if device == "mps":
-            # Switch to CPU by avoiding some bugs in mps backend.
-            last_token_logits = last_token_logits.float().to("cpu")
-
-        if temperature < 1e-5 or top_p < 1e-8:  # greedy
-            _, indices = torch.topk(last_token_logits, 2)
-            tokens = [int(index) for index in indices.tolist()]
-        else:
-            probs = torch.softmax(last_token_logits, dim=-1)
-            indices = torch.multinomial(probs, num_samples=2)
-            tokens = [int(token) for token in indices.tolist()]
-        token = tokens[0]
-        output_ids.append(token)
-        if logprobs is not None:
-            # Cannot use last_token_logits because logprobs is based on raw logits.
-            token_logprobs.append(
-                torch.log_softmax(logits[0, -1, :], dim=-1)[token].tolist()
+    try:
+        for i in range(max_new_tokens):
+            if i == 0:  # prefill
+                if model.config.is_encoder_decoder:
+                    out = model.decoder(
+                        input_ids=start_ids,
+                        encoder_hidden_states=encoder_output,
+                        use_cache=True,
+                    )
+                    logits = model.lm_head(out[0])
+                elif num_cached > 0:
+                    out = model(
+                        input_ids=start_ids[:, num_cached:],
+                        past_key_values=cached_key_values,
+                        use_cache=True,
+                    )
+                    logits = out.logits
+                else:
+                    out = model(input_ids=start_ids, use_cache=True)
+                    logits = out.logits
+                past_key_values = out.past_key_values
+                cached_key_values = None
+
+                if logprobs is not None:
+                    # Prefull logprobs for the prompt.
+                    prompt_logprobs, prompt_top_logprobs = compute_logprobs(
+                        logits[0, :-1, :],
+                        start_ids[0, 1:],
+                        [logprobs] * (start_ids.shape[1] - 1),
+                    )
+                    token_logprobs.extend(prompt_logprobs)
+                    top_logprobs.extend(prompt_top_logprobs)
+            else:  # decoding
+                if model.config.is_encoder_decoder:
+                    out = model.decoder(
+                        input_ids=torch.as_tensor(
+                            [[token] if not sent_interrupt else output_ids],
+                            device=device,
+                        ),
+                        encoder_hidden_states=encoder_output,
+                        use_cache=True,
+                        past_key_values=past_key_values if not sent_interrupt else None,
+                    )
+                    sent_interrupt = False
+
+                    logits = model.lm_head(out[0])
+                else:
+                    if paged_seq is not None:
+                        out = paged_forward(
+                            model,
+                            paged_seq,
+                            output_ids,
+                            device,
+                            sent_interrupt,
+                            cancel_event,
+                        )
+                        if out is None:
+                            # The client is gone while waiting for memory.
+                            finish_reason = "abort"
+                            break
+                    else:
+                        out = model(
+                            input_ids=torch.as_tensor(
+                                [[token] if not sent_interrupt else output_ids],
+                                device=device,
+                            ),
+                            use_cache=True,
+                            past_key_values=(
+                                past_key_values if not sent_interrupt else None
+                            ),
+                        )
+                    sent_interrupt = False
+                    logits = out.logits
+                past_key_values = out.past_key_values
+
+            if paged_seq is not None:
+                paged_seq.store(past_key_values)
+                past_key_values = out = None
+
+            last_token_logits = logits[:, -1, :]
+            if device == "mps":
+                # Switch to CPU by avoiding some bugs in mps backend.
+                last_token_logits = last_token_logits.float().to("cpu")
+
+            # Keep a second candidate to replace a premature stop token.
+            sampler_output = sample(
+                last_token_logits,
+                [sampling_params],
+                [output_ids],
+                num_candidates=2 if judge_sent_end else 1,
             )
+            tokens = sampler_output.candidates[0]
+            token = tokens[0]
+            output_ids.append(token)
+            if logprobs is not None:
+                # The logprobs are based on raw logits.
+                token_logprobs.append(sampler_output.logprobs[0])
+                top_logprobs.append(sampler_output.top_logprobs[0])
 
-        if token in stop_token_ids:
-            stopped = True
-        else:
-            stopped = False
-
-        # Yield the output tokens
-        if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
-            if echo:
-                tmp_output_ids = output_ids
-                rfind_start = len_prompt
+            if token in stop_token_ids:
+                stopped = True
             else:
-                tmp_output_ids = output_ids[input_echo_len:]
-                rfind_start = 0
-
-            output = tokenizer.decode(
-                tmp_output_ids,
-                skip_special_tokens=True,
-                spaces_between_special_tokens=False,
-                clean_up_tokenization_spaces=True,
-            )
-            ret_logprobs = None
-            if logprobs is not None:
-                ret_logprobs = {
-                    "text_offset": [],
-                    "tokens": [
-                        tokenizer.decode(token)
-                        for token in (
-                            output_ids if echo else output_ids[input_echo_len:]
-                        )
-                    ],
-                    "token_logprobs": token_logprobs
-                    if echo
-                    else token_logprobs[input_echo_len:],
-                    "top_logprobs": [{}]
-                    * len(token_logprobs if echo else token_logprobs[input_echo_len:]),
-                }
-                # Compute text_offset
-                curr_pos = 0
-                for text in ret_logprobs["tokens"]:
-                    ret_logprobs["text_offset"].append(curr_pos)
-                    curr_pos += len(text)
-
-            # TODO: For the issue of incomplete sentences interrupting output, apply a patch and others can also modify it to a more elegant way
-            if judge_sent_end and stopped and not is_sentence_complete(output):
-                if len(tokens) > 1:
-                    token = tokens[1]
-                    output_ids[-1] = token
-                else:
-                    output_ids.pop()
                 stopped = False
-                sent_interrupt = True
-
-            partially_stopped = False
-            if stop_str:
-                if isinstance(stop_str, str):
-                    pos = output.rfind(stop_str, rfind_start)
-                    if pos != -1:
-                        output = output[:pos]
-                        stopped = True
+
+            # Yield the output tokens
+            if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                start = 0 if echo else input_echo_len
+
+                detokenizer.update(output_ids)
+                output = detokenizer.text
+                ret_logprobs = None
+                if logprobs is not None:
+                    # Only decode the tokens that are new since the last emit.
+                    for pos in range(start + len(token_texts), len(output_ids)):
+                        text_offsets.append(
+                            text_offsets[-1] + len(token_texts[-1])
+                            if token_texts
+                            else 0
+                        )
+                        token_texts.append(tokenizer.decode(output_ids[pos]))
+                        top_texts.append(
+                            decode_top_logprobs(tokenizer, top_logprobs[pos])
+                        )
+                    ret_logprobs = {
+                        "text_offset": list(text_offsets),
+                        "tokens": list(token_texts),
+                        "token_logprobs": token_logprobs[start:],
+                        "top_logprobs": list(top_texts),
+                    }
+
+                # TODO: For the issue of incomplete sentences interrupting output, apply a patch and others can also modify it to a more elegant way
+                if judge_sent_end and stopped and not is_sentence_complete(output):
+                    if len(tokens) > 1:
+                        token = tokens[1]
+                        output_ids[-1] = token
                     else:
-                        partially_stopped = is_partial_stop(output, stop_str)
-                elif isinstance(stop_str, Iterable):
-                    for each_stop in stop_str:
-                        pos = output.rfind(each_stop, rfind_start)
-                        if pos != -1:
-                            output = output[:pos]
-                            stopped = True
-                            break
-                        else:
-                            partially_stopped = is_partial_stop(output, each_stop)
-                            if partially_stopped:
-                                break
-                else:
-                    raise ValueError("Invalid stop field type.")
-
-            # Prevent yielding partial stop sequence
-            if not partially_stopped:
-                yield {
-                    "text": output,
-                    "logprobs": ret_logprobs,
-                    "usage": {
-                        "prompt_tokens": input_echo_len,
-                        "completion_tokens": i,
-                        "total_tokens": input_echo_len + i,
-                    },
-                    "finish_reason": None,
-                }
+                        output_ids.pop()
+                    stopped = False
+                    sent_interrupt = True
+                    # The last token has been replaced, so decode again from scratch.
+                    detokenizer = IncrementalDetokenizer(tokenizer, start)
+                    stop_matcher.reset()
+                    token_texts, text_offsets, top_texts = [], [], []
+
+                pos, partial_len = stop_matcher.update(output)
+                if pos != -1:
+                    output = output[:pos]
+                    stopped = True
+                partially_stopped = partial_len > 0
+
+                # Prevent yielding partial stop sequence
+                if not partially_stopped:
+                    yield {
+                        "text": output,
+                        "logprobs": ret_logprobs,
+                        "usage": {
+                            "prompt_tokens": input_echo_len,
+                            "completion_tokens": i,
+                            "total_tokens": input_echo_len + i,
+                        },
+                        "finish_reason": None,
+                    }
+
+            if stopped:
+                break
+            if cancel_event is not None and cancel_event.is_set():
+                finish_reason = "abort"
+                break
+
+        # Finish stream event, which contains finish reason
+        else:
+            finish_reason = "length"
 
         if stopped:
-            break
+            finish_reason = "stop"
+
+        yield {
+            "text": output,
+            "logprobs": ret_logprobs,
+            "usage": {
+                "prompt_tokens": input_echo_len,
+                "completion_tokens": i,
+                "total_tokens": input_echo_len + i,
+            },
+            "finish_reason": finish_reason,
+        }
 
-    # Finish stream event, which contains finish reason
-    else:
-        finish_reason = "length"
-
-    if stopped:
-        finish_reason = "stop"
-
-    yield {
-        "text": output,
-        "logprobs": ret_logprobs,
-        "usage": {
-            "prompt_tokens": input_echo_len,
-            "completion_tokens": i,
-            "total_tokens": input_echo_len + i,
-        },
-        "finish_reason": finish_reason,
-    }
-
-    # Clean
-    del past_key_values, out
-    gc.collect()
-    torch.cuda.empty_cache()
-    if device == "xpu":
-        torch.xpu.empty_cache()
-    if device == "npu":
-        torch.npu.empty_cache()
+        if prefix_cache is not None and not model.config.is_encoder_decoder:
+            if paged_seq is not None:
+                past_key_values = paged_seq.load(cancel_event)
+            if past_key_values is not None:
+                prefix_cache.insert(output_ids, past_key_values)
+    finally:
+        # Also runs when the generator is closed early because the client is
+        # gone, so that the blocks of the paged KV cache are released.
+        if paged_seq is not None:
+            paged_seq.free()
+
+        # Clean
+        past_key_values = out = None
+        gc.collect()
+        torch.cuda.empty_cache()
+        if device == "xpu":
+            torch.xpu.empty_cache()
+        if device == "npu":
+            torch.npu.empty_cache()
+
+
+def paged_forward(
+    model,
+    paged_seq,
+    output_ids: List[int],
+    device: str,
+    recompute: bool,
+    cancel_event=None,
+):
+    """
+    Run a decoding step on the KV cache of a sequence of the paged KV cache.
+
+    The KV cache is recomputed from `output_ids` when it was dropped. A CUDA OOM
+    error preempts the sequence, and the step runs again once other sequences
+    have released memory.
+
+    :returns: The output of the model, or None if `cancel_event` was set while
+        waiting for memory.
+    """
+    while True:
+        past_key_values = None if recompute else paged_seq.load(cancel_event)
+        if cancel_event is not None and cancel_event.is_set():
+            return None
+        input_ids = [output_ids[-1:]] if past_key_values is not None else [output_ids]
+        try:
+            return model(
+                input_ids=torch.as_tensor(input_ids, device=device),
+                use_cache=True,
+                past_key_values=past_key_values,
+            )
+        except torch.cuda.OutOfMemoryError:
+            if not paged_seq.preempt():
+                raise
+        # The activations of the failed step are only released here.
+        past_key_values = None
+        gc.collect()
+        torch.cuda.empty_cache()
 
 
 class ChatIO(abc.ABC):
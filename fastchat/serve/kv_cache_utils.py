@@ -0,0 +1,8 @@
+"""Helpers for the KV caches returned by huggingface models."""
+
+
+def to_legacy_cache(past_key_values):
+    """Convert a `transformers.Cache` object into the legacy tuple format."""
+    if hasattr(past_key_values, "to_legacy_cache"):
+        past_key_values = past_key_values.to_legacy_cache()
+    return tuple(tuple(t for t in layer) for layer in past_key_values)
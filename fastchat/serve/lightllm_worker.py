@@ -18,6 +18,11 @@ from typing import List
 from fastapi import FastAPI, Request, BackgroundTasks
 from fastapi.responses import StreamingResponse, JSONResponse
 
+from fastchat.serve.admission import (
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
 from fastchat.serve.base_model_worker import BaseModelWorker
 from fastchat.serve.model_worker import (
     logger,
@@ -33,9 +38,10 @@ from lightllm.server.req_id_generator import ReqIDGenerator
 
 from lightllm.utils.net_utils import alloc_can_use_network_port
 from lightllm.utils.start_utils import start_submodule_processes
-from fastchat.utils import get_context_length, is_partial_stop
+from fastchat.utils import StopStringMatcher, get_context_length
 
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 g_id_gen = ReqIDGenerator()
 
 
@@ -137,14 +143,14 @@ class LightLLMWorker(BaseModelWorker):
         completion_tokens = 0
         text_outputs = ""
         cumulative_logprob = 0.0
+        stop_matcher = StopStringMatcher(stop)
 
         async for request_output, metadata, finish_status in results_generator:
             text_outputs += request_output
             completion_tokens += 1
 
-            partial_stop = any(is_partial_stop(text_outputs, i) for i in stop)
             # prevent yielding partial stop sequence
-            if partial_stop:
+            if stop_matcher.update(text_outputs)[1] > 0:
                 continue
 
             if type(finish_status) is bool:  # compatibility with old version
@@ -192,13 +198,13 @@ class LightLLMWorker(BaseModelWorker):
 
 
 def release_worker_semaphore():
-    worker.semaphore.release()
+    worker.admission_queue.release()
+    worker.push_load()
 
 
-def acquire_worker_semaphore():
-    if worker.semaphore is None:
-        worker.semaphore = asyncio.Semaphore(worker.limit_worker_concurrency)
-    return worker.semaphore.acquire()
+def acquire_worker_semaphore(params):
+    worker.push_load()
+    return worker.admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks(request_id):
@@ -214,7 +220,7 @@ def create_background_tasks(request_id):
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     request_id = g_id_gen.generate_id()
     params["request_id"] = request_id
     params["request"] = request
@@ -226,7 +232,7 @@ async def api_generate_stream(request: Request):
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     request_id = g_id_gen.generate_id()
     params["request_id"] = request_id
     params["request"] = request
@@ -11,7 +11,6 @@ pip install mlx-lm
 """
 
 import argparse
-import asyncio
 import atexit
 import json
 from typing import List
@@ -22,6 +21,11 @@ from fastapi.concurrency import run_in_threadpool
 from fastapi.responses import StreamingResponse, JSONResponse
 import uvicorn
 
+from fastchat.serve.admission import (
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
 from fastchat.serve.base_model_worker import BaseModelWorker
 from fastchat.serve.model_worker import (
     logger,
@@ -34,6 +38,7 @@ from mlx_lm import load, generate
 from mlx_lm.utils import generate_step
 
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 
 
 class MLXWorker(BaseModelWorker):
@@ -169,13 +174,13 @@ class MLXWorker(BaseModelWorker):
 
 
 def release_worker_semaphore():
-    worker.semaphore.release()
+    worker.admission_queue.release()
+    worker.push_load()
 
 
-def acquire_worker_semaphore():
-    if worker.semaphore is None:
-        worker.semaphore = asyncio.Semaphore(worker.limit_worker_concurrency)
-    return worker.semaphore.acquire()
+def acquire_worker_semaphore(params):
+    worker.push_load()
+    return worker.admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks(request_id):
@@ -191,7 +196,7 @@ def create_background_tasks(request_id):
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     request_id = uuid.uuid4()
     params["request_id"] = str(request_id)
     generator = worker.generate_stream(params)
@@ -202,7 +207,7 @@ async def api_generate_stream(request: Request):
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     request_id = uuid.uuid4()
     params["request_id"] = str(request_id)
     output = await worker.generate(params)
@@ -2,7 +2,7 @@
 A model worker that executes the model.
 """
 import argparse
-import base64
+import bisect
 import gc
 import json
 import os
@@ -11,7 +11,7 @@ import uuid
 
 import torch
 import torch.nn.functional as F
-from transformers import set_seed
+from transformers import PreTrainedTokenizerBase, set_seed
 import uvicorn
 
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
@@ -25,7 +25,20 @@ from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
 from fastchat.modules.gptq import GptqConfig
 from fastchat.serve.base_model_worker import BaseModelWorker, app
+from fastchat.serve.continuous_batching import ContinuousBatchingEngine
+from fastchat.serve.embedding_batcher import EmbeddingBatcher
+from fastchat.serve.embedding_codec import (
+    cast_embeddings,
+    embeddings_to_base64,
+    encode_embeddings,
+)
+from fastchat.serve.inference import generate_stream
+from fastchat.serve.paged_kv_cache import PagedKVCache
+from fastchat.serve.parallel_sampling import generate_stream_parallel, get_num_choices
+from fastchat.serve.prefix_cache import PrefixCache
+from fastchat.serve.speculative_decoding import generate_stream_speculative
 from fastchat.utils import (
+    StreamDelta,
     build_logger,
     get_context_length,
     str_to_torch_dtype,
@@ -59,7 +72,17 @@ class ModelWorker(BaseModelWorker):
         stream_interval: int = 2,
         conv_template: Optional[str] = None,
         embed_in_truncate: bool = False,
+        embed_batch_size: int = 32,
+        embed_batch_tokens: int = 16384,
+        embed_batch_wait_ms: float = 5,
+        embed_cache_size: int = 0,
         seed: Optional[int] = None,
+        continuous_batching: bool = False,
+        prefix_cache_gb: float = 0,
+        paged_kv_cache_gb: float = 0,
+        kv_swap_space_gb: float = 4,
+        draft_model_path: Optional[str] = None,
+        num_speculative_tokens: int = 5,
         debug: bool = False,
         **kwargs,
     ):
@@ -74,6 +97,7 @@ class ModelWorker(BaseModelWorker):
         )
 
         logger.info(f"Loading the model {self.model_names} on worker {worker_id} ...")
+        self.revision = revision or "main"
         self.model, self.tokenizer = load_model(
             model_path,
             revision=revision,
@@ -96,11 +120,175 @@ class ModelWorker(BaseModelWorker):
         self.generate_stream_func = get_generate_stream_function(self.model, model_path)
         self.stream_interval = stream_interval
         self.embed_in_truncate = embed_in_truncate
+        self.embed_batch_size = embed_batch_size
+        self.embed_batch_tokens = embed_batch_tokens
+        self.embed_batcher = EmbeddingBatcher(
+            self.__embed_batch,
+            max_batch_size=embed_batch_size,
+            max_wait=embed_batch_wait_ms / 1000,
+            cache_size=embed_cache_size,
+        )
         self.seed = seed
 
+        # Continuous batching, prefix caching and the paged KV cache are built
+        # on the default generate_stream of decoder-only models.
+        is_default_decoder = (
+            self.generate_stream_func is generate_stream
+            and not self.model.config.is_encoder_decoder
+        )
+        if (
+            continuous_batching or prefix_cache_gb > 0 or paged_kv_cache_gb > 0
+        ) and not is_default_decoder:
+            logger.warning(
+                "Continuous batching, prefix caching and the paged KV cache only "
+                "support decoder-only models that use the default generate_stream. "
+                "Disable them."
+            )
+            continuous_batching, prefix_cache_gb, paged_kv_cache_gb = False, 0, 0
+        if continuous_batching and paged_kv_cache_gb > 0:
+            logger.warning(
+                "The paged KV cache is not used by continuous batching. Disable it."
+            )
+            paged_kv_cache_gb = 0
+
+        self.generate_stream_kwargs = {}
+        self.draft_model = None
+        if draft_model_path is not None:
+            if not is_default_decoder:
+                raise ValueError(
+                    "Speculative decoding only supports decoder-only models that "
+                    "use the default generate_stream."
+                )
+            if continuous_batching or prefix_cache_gb > 0 or paged_kv_cache_gb > 0:
+                logger.warning(
+                    "Continuous batching, prefix caching and the paged KV cache "
+                    "are not used by speculative decoding. Disable them."
+                )
+                continuous_batching, prefix_cache_gb, paged_kv_cache_gb = False, 0, 0
+
+            logger.info(f"Loading the draft model {draft_model_path} ...")
+            self.draft_model, draft_tokenizer = load_model(
+                draft_model_path,
+                device=device,
+                num_gpus=1,
+                max_gpu_memory=max_gpu_memory,
+                dtype=dtype,
+                debug=debug,
+            )
+            if draft_tokenizer.get_vocab() != self.tokenizer.get_vocab():
+                raise ValueError(
+                    "The draft model must use the same tokenizer as the target model."
+                )
+            self.generate_stream_func = generate_stream_speculative
+            self.generate_stream_kwargs = {
+                "draft_model": self.draft_model,
+                "num_speculative_tokens": num_speculative_tokens,
+            }
+
+        self.prefix_cache = None
+        if prefix_cache_gb > 0:
+            self.prefix_cache = PrefixCache(int(prefix_cache_gb * 1024**3))
+            self.generate_stream_kwargs["prefix_cache"] = self.prefix_cache
+            self.warm_prefix_cache()
+
+        self.kv_cache = None
+        if paged_kv_cache_gb > 0:
+            self.kv_cache = PagedKVCache(
+                int(paged_kv_cache_gb * 1024**3),
+                max_swap_bytes=int(kv_swap_space_gb * 1024**3),
+            )
+            self.generate_stream_kwargs["kv_cache"] = self.kv_cache
+
+        # Several choices of a prompt share one prefill and decode as a batch.
+        # That loop runs outside the batching engine, the paged KV cache and
+        # the draft model, so with any of them the choices are generated one
+        # after another through them, and the API server sends one request
+        # per choice to let the engine batch them.
+        self.parallel_sampling = (
+            is_default_decoder
+            and not continuous_batching
+            and self.kv_cache is None
+            and self.draft_model is None
+        )
+
+        self.batching_engine = None
+        if continuous_batching:
+            self.batching_engine = ContinuousBatchingEngine(
+                self.model,
+                self.tokenizer,
+                device,
+                self.context_len,
+                stream_interval=stream_interval,
+                max_batch_size=limit_worker_concurrency,
+                prefix_cache=self.prefix_cache,
+            )
+
+        # The memory of the weights on the GPUs of the model's shards, the rest
+        # of these GPUs holds activations and the KV cache.
+        params = (
+            self.model.parameters() if isinstance(self.model, torch.nn.Module) else []
+        )
+        self.cuda_devices = sorted(
+            {p.device.index for p in params if p.device.type == "cuda"}
+        )
+        self.weights_memory = None
+        if self.cuda_devices:
+            self.weights_memory = sum(
+                torch.cuda.memory_allocated(d) for d in self.cuda_devices
+            )
+
         if not no_register:
             self.init_heart_beat()
 
+    @torch.inference_mode()
+    def warm_prefix_cache(self):
+        """Cache the system prompt of the conversation template."""
+        conv = self.conv.copy()
+        input_ids = self.tokenizer(conv.get_prompt()).input_ids
+        try:
+            out = self.model(
+                input_ids=torch.as_tensor([input_ids], device=self.model.device),
+                use_cache=True,
+            )
+        except (ValueError, RuntimeError) as e:
+            logger.warning(f"Failed to warm up the prefix cache: {e}")
+            return
+        self.prefix_cache.insert(input_ids, out.past_key_values)
+
+    def get_status(self):
+        status = super().get_status()
+        if self.prefix_cache is not None:
+            status["prefix_cache"] = self.prefix_cache.get_status()
+        if self.kv_cache is not None:
+            status["kv_cache"] = self.kv_cache.get_status()
+        # Whether the `n` choices of a request share one prefill.
+        status["parallel_sampling"] = self.parallel_sampling
+        # How the API server loads the same tokenizer to count prompt tokens
+        if isinstance(self.tokenizer, PreTrainedTokenizerBase):
+            status["tokenizer"] = {
+                "use_fast": self.tokenizer.is_fast,
+                "trust_remote_code": not type(self.tokenizer).__module__.startswith(
+                    "transformers."
+                ),
+                "revision": self.revision,
+            }
+        return status
+
+    def get_kv_cache_usage(self) -> float:
+        if self.kv_cache is not None:
+            return self.kv_cache.get_status()["utilization"]
+        if self.weights_memory is not None:
+            total = sum(
+                torch.cuda.get_device_properties(d).total_memory
+                for d in self.cuda_devices
+            )
+            used = (
+                sum(torch.cuda.memory_allocated(d) for d in self.cuda_devices)
+                - self.weights_memory
+            )
+            return max(used, 0) / max(total - self.weights_memory, 1)
+        return 0.0
+
     def generate_stream_gate(self, params):
         if self.device == "npu":
             import torch_npu
@@ -111,24 +299,41 @@ class ModelWorker(BaseModelWorker):
         try:
             if self.seed is not None:
                 set_seed(self.seed)
-            for output in self.generate_stream_func(
-                self.model,
-                self.tokenizer,
-                params,
-                self.device,
-                self.context_len,
-                self.stream_interval,
-            ):
+            n, best_of = get_num_choices(params)
+            if best_of > n and not self.parallel_sampling:
+                ret = {
+                    "text": "best_of needs parallel sampling, which this worker "
+                    "does not run with its model, continuous batching, the "
+                    "paged KV cache or a draft model.",
+                    "error_code": ErrorCode.PARAM_OUT_OF_RANGE,
+                }
+                yield json.dumps(ret).encode() + b"\0"
+                return
+            if best_of > 1:
+                output_stream = self.generate_stream_choices(params)
+            else:
+                output_stream = self.generate_stream_single(params)
+            # Send only the new text if the client asks for deltas.
+            stream_deltas = {} if params.get("stream_delta") else None
+            for output in output_stream:
                 ret = {
                     "text": output["text"],
                     "error_code": 0,
                 }
+                if "index" in output:
+                    ret["index"] = output["index"]
                 if "usage" in output:
                     ret["usage"] = output["usage"]
                 if "finish_reason" in output:
                     ret["finish_reason"] = output["finish_reason"]
                 if "logprobs" in output:
                     ret["logprobs"] = output["logprobs"]
+                if stream_deltas is not None:
+                    index = output.get("index", 0)
+                    if index not in stream_deltas:
+                        stream_deltas[index] = StreamDelta()
+                    ret = stream_deltas[index].update(ret)
+                    ret["delta"] = True
                 yield json.dumps(ret).encode() + b"\0"
         except torch.cuda.OutOfMemoryError as e:
             ret = {
@@ -143,20 +348,94 @@ class ModelWorker(BaseModelWorker):
             }
             yield json.dumps(ret).encode() + b"\0"
 
+    def generate_stream_single(self, params):
+        if self.batching_engine is not None:
+            return self.batching_engine.generate_stream(params)
+        return self.generate_stream_func(
+            self.model,
+            self.tokenizer,
+            params,
+            self.device,
+            self.context_len,
+            self.stream_interval,
+            **self.generate_stream_kwargs,
+        )
+
+    def generate_stream_choices(self, params):
+        """Generate the `n` choices of a request in one stream of indexed outputs."""
+        if self.parallel_sampling:
+            yield from generate_stream_parallel(
+                self.model,
+                self.tokenizer,
+                params,
+                self.device,
+                self.context_len,
+                self.stream_interval,
+                prefix_cache=self.prefix_cache,
+            )
+            return
+
+        # Otherwise the choices are generated one after another, so that they
+        # count toward the admission of the batching engine and the memory of
+        # the paged KV cache. generate_stream_gate rejects best_of here.
+        n, _ = get_num_choices(params)
+        seed = params.get("seed", None)
+        completion_tokens = 0
+        for index in range(n):
+            choice_params = {**params, "seed": None if seed is None else seed + index}
+            usage = {}
+            for output in self.generate_stream_single(choice_params):
+                usage = output.get("usage", None) or usage
+                output = {**output, "index": index}
+                if usage:
+                    output["usage"] = {
+                        **usage,
+                        "completion_tokens": completion_tokens
+                        + usage["completion_tokens"],
+                        "total_tokens": usage["total_tokens"] + completion_tokens,
+                    }
+                yield output
+            completion_tokens += usage.get("completion_tokens", 0)
+
     def generate_gate(self, params):
+        if max(get_num_choices(params)) > 1:
+            choices = {}
+            for x in self.generate_stream_gate(params):
+                ret = json.loads(x[:-1].decode())
+                if ret["error_code"] != 0:
+                    return ret
+                choices[ret["index"]] = ret
+            return {
+                "error_code": 0,
+                "choices": [
+                    {
+                        "index": index,
+                        "text": choices[index]["text"],
+                        "logprobs": choices[index].get("logprobs", None),
+                        "finish_reason": choices[index].get("finish_reason", None),
+                    }
+                    for index in sorted(choices)
+                ],
+                "usage": ret.get("usage", None),
+            }
+
         for x in self.generate_stream_gate(params):
             pass
         return json.loads(x[:-1].decode())
 
     def __process_embed_chunk(self, input_ids, attention_mask, **model_type_dict):
         if model_type_dict.get("is_bert"):
-            model_output = self.model(input_ids)
+            model_output = self.model(input_ids, attention_mask=attention_mask.long())
             if model_type_dict.get("is_robert"):
                 data = model_output.last_hidden_state
             else:
                 data = model_output[0]
         elif model_type_dict.get("is_t5"):
-            model_output = self.model(input_ids, decoder_input_ids=input_ids)
+            model_output = self.model(
+                input_ids,
+                attention_mask=attention_mask.long(),
+                decoder_input_ids=input_ids,
+            )
             data = model_output.encoder_last_hidden_state
         else:
             model_output = self.model(input_ids, output_hidden_states=True)
@@ -171,122 +450,162 @@ class ModelWorker(BaseModelWorker):
             mask = attention_mask.unsqueeze(-1).expand(data.size()).float()
             masked_embeddings = data * mask
             sum_embeddings = torch.sum(masked_embeddings, dim=1)
-        token_num = torch.sum(attention_mask).item()
+        token_num = torch.sum(attention_mask, dim=1)
 
         return sum_embeddings, token_num
 
-    def __encode_base64(self, embeddings: torch.Tensor) -> List[str]:
-        embeddings = embeddings.cpu()
-        return [
-            base64.b64encode(e.numpy().tobytes()).decode("utf-8") for e in embeddings
-        ]
-
     @torch.inference_mode()
-    def get_embeddings(self, params):
-        self.call_ct += 1
-
-        try:
-            tokenizer = self.tokenizer
-            ret = {"embedding": [], "token_num": 0}
-
-            model_type_dict = {
-                "is_llama": "llama" in str(type(self.model)),
-                "is_t5": "t5" in str(type(self.model)),
-                "is_chatglm": "chatglm" in str(type(self.model)),
-                "is_bert": "bert" in str(type(self.model)),
-                "is_robert": "robert" in str(type(self.model)),
-            }
+    def __embed_batch(self, inputs: List[str]):
+        """
+        Embed texts in buckets of similar token lengths, keep the order of `inputs`.
+
+        A bucket holds at most `embed_batch_size` texts and `embed_batch_tokens`
+        padded tokens per forward pass, so that one long text does not pad
+        the short ones to its length.
+        """
+        if self.embed_in_truncate:
+            encoding = self.tokenizer.batch_encode_plus(
+                inputs, truncation="longest_first", max_length=self.context_len
+            )
+        else:
+            encoding = self.tokenizer.batch_encode_plus(inputs)
+        all_input_ids = encoding["input_ids"]
+
+        order = sorted(range(len(inputs)), key=lambda i: len(all_input_ids[i]))
+        buckets = []
+        for i in order:
+            # The new text is the longest one of its bucket.
+            width = min(len(all_input_ids[i]), self.context_len)
+            if (
+                not buckets
+                or len(buckets[-1]) >= self.embed_batch_size
+                or (len(buckets[-1]) + 1) * width > self.embed_batch_tokens
+            ):
+                buckets.append([])
+            buckets[-1].append(i)
+
+        embeddings = [None] * len(inputs)
+        token_nums = [0] * len(inputs)
+        for bucket in buckets:
+            bucket_embeddings, bucket_token_nums = self.__embed_bucket(
+                [all_input_ids[i] for i in bucket]
+            )
+            for i, embedding, token_num in zip(
+                bucket, bucket_embeddings, bucket_token_nums.tolist()
+            ):
+                embeddings[i], token_nums[i] = embedding, token_num
 
-            if self.embed_in_truncate:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"],
-                    padding=True,
-                    truncation="longest_first",
-                    return_tensors="pt",
-                    max_length=self.context_len,
+        gc.collect()
+        torch.cuda.empty_cache()
+        if self.device == "xpu":
+            torch.xpu.empty_cache()
+        if self.device == "npu":
+            torch.npu.empty_cache()
+        return torch.stack(embeddings), token_nums
+
+    def __embed_bucket(self, all_input_ids: List[List[int]]):
+        """Embed tokenized texts sorted by length."""
+        tokenizer = self.tokenizer
+
+        model_type_dict = {
+            "is_llama": "llama" in str(type(self.model)),
+            "is_t5": "t5" in str(type(self.model)),
+            "is_chatglm": "chatglm" in str(type(self.model)),
+            "is_bert": "bert" in str(type(self.model)),
+            "is_robert": "robert" in str(type(self.model)),
+        }
+        use_cls_pooling = getattr(self.model, "use_cls_pooling", False)
+
+        lengths = [len(ids) for ids in all_input_ids]
+        input_ids = torch.full(
+            (len(all_input_ids), lengths[-1]), tokenizer.pad_token_id, dtype=torch.long
+        )
+        for i, ids in enumerate(all_input_ids):
+            input_ids[i, : len(ids)] = torch.as_tensor(ids)
+        input_ids = input_ids.to(self.device)
+        attention_mask = torch.arange(
+            input_ids.size(1), device=self.device
+        ) < torch.as_tensor(lengths, device=self.device).unsqueeze(-1)
+
+        if self.embed_in_truncate:
+            embedding, token_num = self.__process_embed_chunk(
+                input_ids, attention_mask, **model_type_dict
+            )
+            if not use_cls_pooling:
+                embedding = embedding / token_num.unsqueeze(-1)
+            normalized_embeddings = F.normalize(embedding, p=2, dim=1)
+            return normalized_embeddings, token_num
+
+        sum_embeddings = None
+        all_token_num = torch.zeros(
+            len(all_input_ids), dtype=torch.long, device=self.device
+        )
+        for i in range(0, input_ids.size(1), self.context_len):
+            # Only the longest texts extend past the start of this chunk.
+            first = bisect.bisect_right(lengths, i)
+            chunk_input_ids = input_ids[first:, i : i + self.context_len]
+            chunk_attention_mask = attention_mask[first:, i : i + self.context_len]
+
+            # add cls token and mask to get cls embedding
+            if use_cls_pooling:
+                cls_tokens = (
+                    torch.zeros(
+                        (chunk_input_ids.size(0), 1),
+                        dtype=chunk_input_ids.dtype,
+                        device=chunk_input_ids.device,
+                    )
+                    + tokenizer.cls_token_id
                 )
-            else:
-                encoding = tokenizer.batch_encode_plus(
-                    params["input"], padding=True, return_tensors="pt"
+                chunk_input_ids = torch.cat([cls_tokens, chunk_input_ids], dim=-1)
+                mask = torch.ones(
+                    (chunk_attention_mask.size(0), 1),
+                    dtype=chunk_attention_mask.dtype,
+                    device=chunk_attention_mask.device,
                 )
-            input_ids = encoding["input_ids"].to(self.device)
-            attention_mask = input_ids != tokenizer.pad_token_id
-
-            base64_encode = params.get("encoding_format", None)
+                chunk_attention_mask = torch.cat([mask, chunk_attention_mask], dim=-1)
 
-            if self.embed_in_truncate:
-                embedding, token_num = self.__process_embed_chunk(
-                    input_ids, attention_mask, **model_type_dict
+            chunk_embeddings, token_num = self.__process_embed_chunk(
+                chunk_input_ids, chunk_attention_mask, **model_type_dict
+            )
+            if use_cls_pooling:
+                chunk_embeddings = chunk_embeddings * token_num.unsqueeze(-1)
+            if sum_embeddings is None:
+                sum_embeddings = chunk_embeddings.new_zeros(
+                    (len(all_input_ids), chunk_embeddings.size(-1))
                 )
-                if (
-                    not hasattr(self.model, "use_cls_pooling")
-                    or not self.model.use_cls_pooling
-                ):
-                    embedding = embedding / token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
-                ret["token_num"] = token_num
-            else:
-                all_embeddings = []
-                all_token_num = 0
-                for i in range(0, input_ids.size(1), self.context_len):
-                    chunk_input_ids = input_ids[:, i : i + self.context_len]
-                    chunk_attention_mask = attention_mask[:, i : i + self.context_len]
-
-                    # add cls token and mask to get cls embedding
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        cls_tokens = (
-                            torch.zeros(
-                                (chunk_input_ids.size(0), 1),
-                                dtype=chunk_input_ids.dtype,
-                                device=chunk_input_ids.device,
-                            )
-                            + tokenizer.cls_token_id
-                        )
-                        chunk_input_ids = torch.cat(
-                            [cls_tokens, chunk_input_ids], dim=-1
-                        )
-                        mask = torch.ones(
-                            (chunk_attention_mask.size(0), 1),
-                            dtype=chunk_attention_mask.dtype,
-                            device=chunk_attention_mask.device,
-                        )
-                        chunk_attention_mask = torch.cat(
-                            [mask, chunk_attention_mask], dim=-1
-                        )
-
-                    chunk_embeddings, token_num = self.__process_embed_chunk(
-                        chunk_input_ids, chunk_attention_mask, **model_type_dict
-                    )
-                    if (
-                        hasattr(self.model, "use_cls_pooling")
-                        and self.model.use_cls_pooling
-                    ):
-                        all_embeddings.append(chunk_embeddings * token_num)
-                    else:
-                        all_embeddings.append(chunk_embeddings)
-                    all_token_num += token_num
+            sum_embeddings[first:] += chunk_embeddings
+            all_token_num[first:] += token_num
+
+        embedding = sum_embeddings / all_token_num.unsqueeze(-1)
+        normalized_embeddings = F.normalize(embedding, p=2, dim=1)
+        return normalized_embeddings, all_token_num
 
-                all_embeddings_tensor = torch.stack(all_embeddings)
-                embedding = torch.sum(all_embeddings_tensor, dim=0) / all_token_num
-                normalized_embeddings = F.normalize(embedding, p=2, dim=1)
+    def get_embeddings(self, params):
+        """
+        Return the embeddings as JSON, or as bytes in the format of
+        `encode_embeddings` if `params["binary"]` is set.
+        """
+        self.call_ct += 1
 
-                ret["token_num"] = all_token_num
+        try:
+            ret = {"embedding": [], "token_num": 0}
+            normalized_embeddings, token_nums = self.embed_batcher.embed(
+                params["input"]
+            )
+            ret["token_num"] = sum(token_nums)
+
+            dtype = params.get("embedding_dtype", None) or "float32"
+            embeddings = normalized_embeddings.float().numpy()
+            if params.get("binary", False):
+                return encode_embeddings(embeddings, ret["token_num"], dtype)
 
+            embeddings = cast_embeddings(embeddings, dtype)
+            base64_encode = params.get("encoding_format", None)
             if base64_encode == "base64":
-                out_embeddings = self.__encode_base64(normalized_embeddings)
+                out_embeddings = embeddings_to_base64(embeddings)
             else:
-                out_embeddings = normalized_embeddings.tolist()
+                out_embeddings = embeddings.tolist()
             ret["embedding"] = out_embeddings
-
-            gc.collect()
-            torch.cuda.empty_cache()
-            if self.device == "xpu":
-                torch.xpu.empty_cache()
-            if self.device == "npu":
-                torch.npu.empty_cache()
         except torch.cuda.OutOfMemoryError as e:
             ret = {
                 "text": f"{SERVER_ERROR_MSG}\n\n({e})",
@@ -318,6 +637,33 @@ def create_model_worker():
         "--conv-template", type=str, default=None, help="Conversation prompt template."
     )
     parser.add_argument("--embed-in-truncate", action="store_true")
+    parser.add_argument(
+        "--embed-batch-size",
+        type=int,
+        default=32,
+        help="The maximum number of texts in one forward pass of the embedding model.",
+    )
+    parser.add_argument(
+        "--embed-batch-tokens",
+        type=int,
+        default=16384,
+        help="The maximum number of padded tokens in one forward pass of the "
+        "embedding model. Texts are grouped by length to waste less on padding.",
+    )
+    parser.add_argument(
+        "--embed-batch-wait-ms",
+        type=float,
+        default=5,
+        help="Milliseconds to wait for concurrent embedding requests to batch "
+        "them together. 0 disables the batching across requests.",
+    )
+    parser.add_argument(
+        "--embed-cache-size",
+        type=int,
+        default=0,
+        help="The number of normalized embeddings cached by the hash of their "
+        "text. 0 disables the embedding cache.",
+    )
     parser.add_argument(
         "--limit-worker-concurrency",
         type=int,
@@ -325,6 +671,47 @@ def create_model_worker():
         help="Limit the model concurrency to prevent OOM.",
     )
     parser.add_argument("--stream-interval", type=int, default=2)
+    parser.add_argument(
+        "--continuous-batching",
+        action="store_true",
+        help="Merge concurrent requests into one batched decode step. "
+        "--limit-worker-concurrency is used as the maximum batch size.",
+    )
+    parser.add_argument(
+        "--prefix-cache-gb",
+        type=float,
+        default=0,
+        help="The memory budget in GiB for reusing the KV cache of shared prompt "
+        "prefixes across requests. 0 disables the prefix cache.",
+    )
+    parser.add_argument(
+        "--paged-kv-cache-gb",
+        type=float,
+        default=0,
+        help="The memory in GiB of a block pool shared by the KV caches of all "
+        "requests. Idle requests are swapped out when it is full. "
+        "0 disables the paged KV cache.",
+    )
+    parser.add_argument(
+        "--kv-swap-space-gb",
+        type=float,
+        default=4,
+        help="The CPU memory in GiB for KV caches swapped out of the paged KV "
+        "cache. Beyond it, swapped out KV caches are recomputed.",
+    )
+    parser.add_argument(
+        "--draft-model-path",
+        type=str,
+        default=None,
+        help="The path to a small draft model for speculative decoding. "
+        "It must share the tokenizer of the target model.",
+    )
+    parser.add_argument(
+        "--num-speculative-tokens",
+        type=int,
+        default=5,
+        help="The number of tokens proposed by the draft model per step.",
+    )
     parser.add_argument("--no-register", action="store_true")
     parser.add_argument(
         "--seed",
@@ -404,7 +791,17 @@ def create_model_worker():
         stream_interval=args.stream_interval,
         conv_template=args.conv_template,
         embed_in_truncate=args.embed_in_truncate,
+        embed_batch_size=args.embed_batch_size,
+        embed_batch_tokens=args.embed_batch_tokens,
+        embed_batch_wait_ms=args.embed_batch_wait_ms,
+        embed_cache_size=args.embed_cache_size,
         seed=args.seed,
+        continuous_batching=args.continuous_batching,
+        prefix_cache_gb=args.prefix_cache_gb,
+        paged_kv_cache_gb=args.paged_kv_cache_gb,
+        kv_swap_space_gb=args.kv_swap_space_gb,
+        draft_model_path=args.draft_model_path,
+        num_speculative_tokens=args.num_speculative_tokens,
         debug=args.debug,
     )
     return args, worker
@@ -12,7 +12,6 @@ We recommend using this with multiple Peft models (with `peft` in the name)
 where all Peft models are trained on the exact same base model.
 """
 import argparse
-import asyncio
 import dataclasses
 import logging
 import json
@@ -23,7 +22,7 @@ import threading
 import uuid
 
 from fastapi import FastAPI, Request, BackgroundTasks
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import Response, StreamingResponse, JSONResponse
 import requests
 
 try:
@@ -56,9 +55,15 @@ from fastchat.model.model_codet5p import generate_stream_codet5p
 from fastchat.modules.gptq import GptqConfig
 from fastchat.modules.exllama import ExllamaConfig
 from fastchat.modules.xfastertransformer import XftConfig
+from fastchat.serve.admission import (
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
+from fastchat.serve.base_model_worker import stream_until_disconnect
 from fastchat.serve.inference import generate_stream
 from fastchat.serve.model_worker import ModelWorker, worker_id, logger
-from fastchat.utils import build_logger, pretty_print_semaphore, get_context_length
+from fastchat.utils import build_logger, get_context_length
 
 
 # We store both the underlying workers and a mapping from their model names to
@@ -67,20 +72,17 @@ from fastchat.utils import build_logger, pretty_print_semaphore, get_context_len
 workers = []
 worker_map = {}
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 
 
 def release_worker_semaphore():
-    workers[0].semaphore.release()
+    workers[0].admission_queue.release()
+    workers[0].push_load()
 
 
-def acquire_worker_semaphore():
-    if workers[0].semaphore is None:
-        # Share the same semaphore for all workers because
-        # all workers share the same GPU.
-        semaphore = asyncio.Semaphore(workers[0].limit_worker_concurrency)
-        for w in workers:
-            w.semaphore = semaphore
-    return workers[0].semaphore.acquire()
+def acquire_worker_semaphore(params):
+    workers[0].push_load()
+    return workers[0].admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks():
@@ -97,39 +99,50 @@ def create_background_tasks():
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     worker = worker_map[params["model"]]
+    params["cancel_event"] = cancel_event = threading.Event()
     generator = worker.generate_stream_gate(params)
-    background_tasks = create_background_tasks()
-    return StreamingResponse(generator, background=background_tasks)
+    return StreamingResponse(
+        stream_until_disconnect(
+            worker, generator, cancel_event, release_worker_semaphore
+        )
+    )
 
 
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     worker = worker_map[params["model"]]
-    output = worker.generate_gate(params)
-    release_worker_semaphore()
+    try:
+        output = await worker.run_in_executor(worker.generate_gate, params)
+    finally:
+        release_worker_semaphore()
     return JSONResponse(output)
 
 
 @app.post("/worker_get_embeddings")
 async def api_get_embeddings(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     worker = worker_map[params["model"]]
-    embedding = worker.get_embeddings(params)
-    background_tasks = create_background_tasks()
-    return JSONResponse(content=embedding, background=background_tasks)
+    try:
+        embedding = await worker.run_in_executor(worker.get_embeddings, params)
+    finally:
+        release_worker_semaphore()
+    if isinstance(embedding, bytes):
+        return Response(content=embedding, media_type="application/octet-stream")
+    return JSONResponse(content=embedding)
 
 
 @app.post("/worker_get_status")
 async def api_get_status(request: Request):
     return {
         "model_names": [m for w in workers for m in w.model_names],
+        "model_paths": {m: w.model_path for w in workers for m in w.model_names},
         "speed": 1,
-        "queue_length": sum([w.get_queue_length() for w in workers]),
+        "queue_length": workers[0].get_queue_length(),
     }
 
 
@@ -264,6 +277,11 @@ def create_multi_model_worker():
             stream_interval=args.stream_interval,
             conv_template=conv_template,
         )
+        if workers:
+            # Share the same queue and threads for all workers because
+            # all workers share the same GPU.
+            w.admission_queue = workers[0].admission_queue
+            w.executor = workers[0].executor
         workers.append(w)
         for model_name in model_names:
             worker_map[model_name] = w
@@ -276,7 +294,7 @@ def create_multi_model_worker():
         "worker_status": {
             "model_names": [m for w in workers for m in w.model_names],
             "speed": 1,
-            "queue_length": sum([w.get_queue_length() for w in workers]),
+            "queue_length": workers[0].get_queue_length(),
         },
     }
     r = requests.post(url, json=data)
@@ -3,29 +3,37 @@
 - Chat Completions. (Reference: https://platform.openai.com/docs/api-reference/chat)
 - Completions. (Reference: https://platform.openai.com/docs/api-reference/completions)
 - Embeddings. (Reference: https://platform.openai.com/docs/api-reference/embeddings)
+- Batches. (Reference: https://platform.openai.com/docs/api-reference/batch)
 
 Usage:
 python3 -m fastchat.serve.openai_api_server
 """
 import asyncio
 import argparse
+from concurrent.futures import ThreadPoolExecutor
+import contextvars
+import hashlib
 import json
 import os
-from typing import Generator, Optional, Union, Dict, List, Any
+import threading
+import time
+from typing import Any, Callable, Dict, Generator, List, Optional, Tuple, Union
 
 import aiohttp
 import fastapi
 from fastapi import Depends, HTTPException
 from fastapi.exceptions import RequestValidationError
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import StreamingResponse, JSONResponse
+from fastapi.responses import FileResponse, StreamingResponse, JSONResponse
 from fastapi.security.http import HTTPAuthorizationCredentials, HTTPBearer
 import httpx
+import numpy as np
 
 try:
     from pydantic.v1 import BaseSettings
 except ImportError:
     from pydantic import BaseSettings
+from pydantic import BaseModel, ValidationError
 import shortuuid
 import tiktoken
 import uvicorn
@@ -37,6 +45,9 @@ from fastchat.constants import (
 )
 from fastchat.conversation import Conversation, SeparatorStyle
 from fastchat.protocol.openai_api_protocol import (
+    Batch,
+    BatchList,
+    BatchRequest,
     ChatCompletionRequest,
     ChatCompletionResponse,
     ChatCompletionResponseStreamChoice,
@@ -52,6 +63,7 @@ from fastchat.protocol.openai_api_protocol import (
     EmbeddingsRequest,
     EmbeddingsResponse,
     ErrorResponse,
+    FileObject,
     LogProbs,
     ModelCard,
     ModelList,
@@ -60,33 +72,84 @@ from fastchat.protocol.openai_api_protocol import (
 )
 from fastchat.protocol.api_protocol import (
     APIChatCompletionRequest,
+    APIInvalidateModelCacheRequest,
+    APIInvalidateModelCacheResponse,
     APITokenCheckRequest,
     APITokenCheckResponse,
     APITokenCheckResponseItem,
 )
-from fastchat.utils import build_logger
+from fastchat.serve.batch_runner import BatchRunner, BatchStore, get_owner
+from fastchat.serve.embedding_codec import (
+    EMBEDDING_DTYPES,
+    decode_embeddings,
+    embeddings_to_base64,
+    is_binary_embeddings,
+)
+from fastchat.serve.response_cache import ResponseCache, get_response_cache_key
+from fastchat.utils import StreamDelta, build_logger
 
 logger = build_logger("openai_api_server", "openai_api_server.log")
 
-conv_template_map = {}
-
 fetch_timeout = aiohttp.ClientTimeout(total=3 * 3600)
+# The length of the prompt prefix that identifies the session of a completion
+AFFINITY_PREFIX_CHARS = 1024
+# Seconds before loading a tokenizer that failed to load is tried again
+TOKENIZER_RETRY_INTERVAL = 300.0
+# The `from_pretrained` arguments of tokenizers taken from the workers
+TOKENIZER_SETTINGS = {"use_fast": bool, "revision": str}
+# Stands for the text of a stream chunk in the precompiled SSE events
+SSE_PLACEHOLDER = "__fastchat_sse_text__"
+
+# Long-lived clients shared by all requests, so that the connections to the
+# controller and the workers are kept alive and reused.
+aiohttp_session: Optional[aiohttp.ClientSession] = None
+httpx_client: Optional[httpx.AsyncClient] = None
+
+
+def get_aiohttp_session() -> aiohttp.ClientSession:
+    global aiohttp_session
+    if aiohttp_session is None or aiohttp_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=app_settings.max_connections,
+            limit_per_host=app_settings.max_connections_per_host,
+            keepalive_timeout=app_settings.keepalive_expiry,
+        )
+        aiohttp_session = aiohttp.ClientSession(
+            connector=connector, timeout=fetch_timeout
+        )
+    return aiohttp_session
+
+
+def get_httpx_client() -> httpx.AsyncClient:
+    global httpx_client
+    if httpx_client is None or httpx_client.is_closed:
+        limits = httpx.Limits(
+            max_connections=app_settings.max_connections,
+            max_keepalive_connections=app_settings.max_keepalive_connections,
+            keepalive_expiry=app_settings.keepalive_expiry,
+        )
+        httpx_client = httpx.AsyncClient(limits=limits, timeout=WORKER_API_TIMEOUT)
+    return httpx_client
 
 
 async def fetch_remote(url, pload=None, name=None):
-    async with aiohttp.ClientSession(timeout=fetch_timeout) as session:
-        async with session.post(url, json=pload) as response:
-            chunks = []
-            if response.status != 200:
-                ret = {
-                    "text": f"{response.reason}",
-                    "error_code": ErrorCode.INTERNAL_ERROR,
-                }
-                return json.dumps(ret)
-
-            async for chunk, _ in response.content.iter_chunks():
-                chunks.append(chunk)
-        output = b"".join(chunks)
+    session = get_aiohttp_session()
+    async with session.post(url, json=pload) as response:
+        chunks = []
+        if response.status == 429:
+            # The worker rejects the request, its body tells why.
+            output = await response.read()
+            return json.loads(output) if name is not None else output
+        if response.status != 200:
+            ret = {
+                "text": f"{response.reason}",
+                "error_code": ErrorCode.INTERNAL_ERROR,
+            }
+            return json.dumps(ret)
+
+        async for chunk, _ in response.content.iter_chunks():
+            chunks.append(chunk)
+    output = b"".join(chunks)
 
     if name is not None:
         res = json.loads(output)
@@ -97,18 +160,311 @@ async def fetch_remote(url, pload=None, name=None):
     return output
 
 
+class ModelRegistry:
+    """
+    An in-process cache of the model list of the controller and of the context
+    length and conversation template of each worker.
+
+    Entries expire after `ttl` seconds and are invalidated by the controller
+    when workers register or are removed, if it is started with
+    --api-server-addresses. Concurrent misses of the same key share one fetch.
+    """
+
+    def __init__(self, ttl: float = 60.0):
+        self.ttl = ttl
+        # Dict[key -> (fetch time, value)]
+        self.entries = {}
+        # Dict[key -> asyncio.Task] of the fetches in flight
+        self.pending = {}
+
+    async def get(self, key, fetch, max_age: Optional[float] = None):
+        """
+        Return the cached value of `key` or fetch it with `fetch()`.
+
+        :param max_age: Refetch the value if it is older than this. Defaults to ttl.
+        """
+        max_age = self.ttl if max_age is None else min(max_age, self.ttl)
+        entry = self.entries.get(key)
+        if entry is not None and time.monotonic() - entry[0] < max_age:
+            return entry[1]
+
+        task = self.pending.get(key)
+        if task is None:
+            task = asyncio.ensure_future(self._fetch(key, fetch))
+            self.pending[key] = task
+            task.add_done_callback(lambda _: self.pending.pop(key, None))
+        # A cancelled request must not cancel the fetch of the others.
+        return await asyncio.shield(task)
+
+    async def _fetch(self, key, fetch):
+        fetch_time = time.monotonic()
+        value = await fetch()
+        # fetch_remote returns the error response as a JSON string.
+        if not isinstance(value, str):
+            self.entries[key] = (fetch_time, value)
+        return value
+
+    def invalidate(
+        self, worker_address: Optional[str] = None, model: Optional[str] = None
+    ) -> int:
+        """
+        Drop the cached entries of a worker and/or a model, or all entries.
+        The model list is dropped on every invalidation.
+
+        :returns: The number of dropped entries.
+        """
+        keys = [
+            key
+            for key in self.entries
+            if key == ("models",)
+            or (
+                (worker_address is None or key[1] == worker_address)
+                and (model is None or len(key) == 2 or key[2] == model)
+            )
+        ]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    async def get_models(self, max_age: Optional[float] = None) -> List[str]:
+        controller_address = app_settings.controller_address
+        return await self.get(
+            ("models",),
+            lambda: fetch_remote(controller_address + "/list_models", None, "models"),
+            max_age,
+        )
+
+    async def get_context_len(self, worker_addr: str, model_name: str) -> int:
+        return await self.get(
+            ("context_len", worker_addr, model_name),
+            lambda: fetch_remote(
+                worker_addr + "/model_details", {"model": model_name}, "context_length"
+            ),
+        )
+
+    async def get_conv(self, worker_addr: str, model_name: str) -> Dict:
+        return await self.get(
+            ("conv", worker_addr, model_name),
+            lambda: fetch_remote(
+                worker_addr + "/worker_get_conv_template", {"model": model_name}, "conv"
+            ),
+        )
+
+    async def get_worker_status(self, worker_addr: str) -> Optional[Dict]:
+        """The status of a worker, for the static fields like its model paths."""
+        status = await self.get(
+            ("status", worker_addr),
+            lambda: fetch_remote(worker_addr + "/worker_get_status", {}, ""),
+        )
+        if not isinstance(status, dict):
+            return None
+        return status
+
+    async def get_model_path(self, worker_addr: str, model_name: str) -> Optional[str]:
+        status = await self.get_worker_status(worker_addr)
+        if status is None:
+            return None
+        return status.get("model_paths", {}).get(model_name)
+
+    async def get_tokenizer_settings(self, worker_addr: str) -> Optional[Dict]:
+        """How the worker loaded its tokenizer, None if it cannot be loaded alike."""
+        status = await self.get_worker_status(worker_addr)
+        if status is None:
+            return None
+        return status.get("tokenizer", None)
+
+    async def supports_parallel_sampling(self, worker_addr: str) -> bool:
+        """Whether a worker generates the `n` choices of a request in one request."""
+        status = await self.get_worker_status(worker_addr)
+        return status is not None and bool(status.get("parallel_sampling", False))
+
+
+class TokenizerCache:
+    """
+    The tokenizers of the served models, keyed by model path and the
+    tokenizer settings reported by the worker, for counting prompt tokens
+    without a round-trip to the worker.
+
+    Tokenizers are loaded in the background, and encoding runs in a thread
+    pool. Until a tokenizer is loaded, or if it cannot be loaded on this host,
+    `count` returns None and the caller asks the worker instead. A failed load
+    is tried again after TOKENIZER_RETRY_INTERVAL seconds.
+
+    Only the settings in TOKENIZER_SETTINGS are taken from the workers. Remote
+    code is only run if the API server allows it with `trust_remote_code`.
+    """
+
+    def __init__(self, num_threads: int = 4, trust_remote_code: bool = False):
+        self.executor = ThreadPoolExecutor(
+            max_workers=num_threads, thread_name_prefix="tokenizer"
+        )
+        self.trust_remote_code = trust_remote_code
+        # Guards the state below, which the loading threads update.
+        self.lock = threading.Lock()
+        # Dict[key -> tokenizer], the key is (model_path, settings)
+        self.tokenizers = {}
+        # Dict[key -> time of the failed load]
+        self.failures = {}
+        # Fast tokenizers must not be used by two threads at once.
+        self.locks = {}
+        self.loading = set()
+
+    def _load(self, key):
+        model_path, settings = key
+        tokenizer = None
+        try:
+            from transformers import AutoTokenizer
+
+            tokenizer = AutoTokenizer.from_pretrained(
+                model_path, trust_remote_code=self.trust_remote_code, **dict(settings)
+            )
+            logger.info(f"Loaded the tokenizer of {model_path} for token counting.")
+        except (OSError, ValueError, ImportError) as e:
+            # The files or the packages of the tokenizer are not on this host.
+            logger.warning(f"Count the tokens of {model_path} on its worker: {e}")
+        except Exception:
+            logger.exception(f"Failed to load the tokenizer of {model_path}.")
+        with self.lock:
+            if tokenizer is None:
+                self.failures[key] = time.monotonic()
+            else:
+                self.locks[key] = threading.Lock()
+                self.tokenizers[key] = tokenizer
+                self.failures.pop(key, None)
+            self.loading.discard(key)
+
+    def _encode(self, key, prompts: List[str]) -> List[int]:
+        with self.locks[key]:
+            input_ids = self.tokenizers[key](prompts).input_ids
+        return [len(ids) for ids in input_ids]
+
+    async def count(
+        self, model_path: str, settings: Dict, prompts: List[str]
+    ) -> Optional[List[int]]:
+        """
+        Count the tokens of a batch of prompts, or None if not available.
+
+        :param settings: The `from_pretrained` arguments of the worker's tokenizer.
+        """
+        if settings.get("trust_remote_code", False) and not self.trust_remote_code:
+            return None
+        settings = {
+            name: settings[name]
+            for name, types in TOKENIZER_SETTINGS.items()
+            if isinstance(settings.get(name, None), types)
+        }
+        key = (model_path, tuple(sorted(settings.items())))
+        with self.lock:
+            if key not in self.tokenizers:
+                failure_time = self.failures.get(key, None)
+                if key not in self.loading and (
+                    failure_time is None
+                    or time.monotonic() - failure_time > TOKENIZER_RETRY_INTERVAL
+                ):
+                    self.loading.add(key)
+                    self.executor.submit(self._load, key)
+                return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, self._encode, key, prompts)
+
+
 class AppSettings(BaseSettings):
     # The address of the model controller.
     controller_address: str = "http://localhost:21001"
     api_keys: Optional[List[str]] = None
+    # The queue priority of the requests of each API key, lower goes first.
+    api_key_priorities: Dict[str, int] = {}
+    # Connection pool limits of the clients to the controller and the workers.
+    max_connections: int = 1024
+    max_connections_per_host: int = 256
+    max_keepalive_connections: int = 256
+    keepalive_expiry: float = 60.0
+    # Seconds before the cached model list and worker metadata expire.
+    model_registry_ttl: float = 60.0
+    # Count prompt tokens with local copies of the tokenizers of the workers.
+    local_tokenizer: bool = True
+    tokenizer_threads: int = 4
+    # Run the code of the model repositories to load their tokenizers.
+    tokenizer_trust_remote_code: bool = False
+    # Send generation requests through the controller for failover.
+    controller_proxy: bool = False
+    # The number of embedding batches of one request sent to workers at once.
+    embedding_concurrency: int = 16
+    # The directory of the files and the state of the batch API, None disables it.
+    batch_dir: Optional[str] = None
+    # The lowest queue priority of the requests of batches, and how many of
+    # them run at once.
+    batch_priority: int = 10
+    batch_concurrency: int = 8
+    # The number of deterministic responses cached in memory, and the SQLite
+    # database of the on-disk tier of the cache. Both disabled by default.
+    response_cache_size: int = 0
+    response_cache_db: Optional[str] = None
+    response_cache_max_db_size: int = 1000000
+    # Seconds before a cached response expires, None keeps it.
+    response_cache_ttl: Optional[float] = None
 
 
 app_settings = AppSettings()
+model_registry = ModelRegistry(app_settings.model_registry_ttl)
+tokenizer_cache = None
+batch_runner: Optional[BatchRunner] = None
+response_cache: Optional[ResponseCache] = None
+# The queue parameters of the batch request run by the current task
+batch_queue_params = contextvars.ContextVar("batch_queue_params", default=None)
 app = fastapi.FastAPI()
 headers = {"User-Agent": "FastChat API Server"}
 get_bearer_token = HTTPBearer(auto_error=False)
 
 
+@app.on_event("startup")
+async def startup_http_clients():
+    get_aiohttp_session()
+    get_httpx_client()
+
+
+@app.on_event("startup")
+async def startup_batch_runner():
+    global batch_runner
+    if app_settings.batch_dir is not None:
+        batch_runner = BatchRunner(
+            BatchStore(app_settings.batch_dir),
+            execute_batch_request,
+            app_settings.batch_concurrency,
+        )
+        batch_runner.start()
+
+
+@app.on_event("startup")
+async def startup_response_cache():
+    global response_cache
+    if app_settings.response_cache_size > 0 or app_settings.response_cache_db:
+        response_cache = ResponseCache(
+            app_settings.response_cache_size,
+            app_settings.response_cache_db,
+            app_settings.response_cache_max_db_size,
+            app_settings.response_cache_ttl,
+        )
+
+
+@app.on_event("shutdown")
+async def shutdown_batch_runner():
+    # The unfinished batches resume at the next start.
+    if batch_runner is not None:
+        batch_runner.stop()
+
+
+@app.on_event("shutdown")
+async def shutdown_http_clients():
+    global aiohttp_session, httpx_client
+    if aiohttp_session is not None:
+        await aiohttp_session.close()
+        aiohttp_session = None
+    if httpx_client is not None:
+        await httpx_client.aclose()
+        httpx_client = None
+
+
 async def check_api_key(
     auth: Optional[HTTPAuthorizationCredentials] = Depends(get_bearer_token),
 ) -> str:
@@ -132,21 +488,67 @@ async def check_api_key(
 
 
 def create_error_response(code: int, message: str) -> JSONResponse:
+    status_code = 400
+    if code in (
+        ErrorCode.RATE_LIMIT,
+        ErrorCode.QUOTA_EXCEEDED,
+        ErrorCode.ENGINE_OVERLOADED,
+    ):
+        status_code = 429
     return JSONResponse(
-        ErrorResponse(message=message, code=code).dict(), status_code=400
+        ErrorResponse(message=message, code=code).dict(), status_code=status_code
     )
 
 
+def get_cache_key(endpoint: str, request) -> Optional[str]:
+    """The key of a request in the response cache, None if it is not cached."""
+    if response_cache is None:
+        return None
+    return get_response_cache_key(endpoint, request)
+
+
+async def put_cached_response(
+    cache_key: str, response: Union[ChatCompletionResponse, CompletionResponse]
+):
+    # Aborted and failed responses are not cached.
+    if all(c.finish_reason in ("stop", "length") for c in response.choices):
+        await response_cache.put(cache_key, response.dict(include={"choices", "usage"}))
+
+
 @app.exception_handler(RequestValidationError)
 async def validation_exception_handler(request, exc):
     return create_error_response(ErrorCode.VALIDATION_TYPE_ERROR, str(exc))
 
 
+def get_queue_params(
+    raw_request: fastapi.Request, api_key: Optional[str]
+) -> Dict[str, Any]:
+    """
+    The priority and the tenant of a request in the queue of the worker. The
+    tenants share a worker fairly, and lower priorities are served first.
+
+    The tenant is the API key, or the client address without API keys. The
+    `user` field of the request is chosen by the client, so it is not used.
+    """
+    queue_params = batch_queue_params.get()
+    if queue_params is not None:
+        return dict(queue_params)
+    tenant = get_owner(api_key)
+    if tenant is None and raw_request.client is not None:
+        tenant = raw_request.client.host
+    return {
+        "priority": app_settings.api_key_priorities.get(api_key, 0),
+        "tenant": tenant,
+    }
+
+
 async def check_model(request) -> Optional[JSONResponse]:
-    controller_address = app_settings.controller_address
     ret = None
 
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
+    models = await model_registry.get_models()
+    if request.model not in models:
+        # The model may have been registered after the list was cached.
+        models = await model_registry.get_models(max_age=1.0)
     if request.model not in models:
         ret = create_error_response(
             ErrorCode.INVALID_MODEL,
@@ -161,14 +563,8 @@ async def check_length(request, prompt, max_tokens, worker_addr):
     ):  # model worker not support max_tokens=None
         max_tokens = 1024 * 1024
 
-    context_len = await fetch_remote(
-        worker_addr + "/model_details", {"model": request.model}, "context_length"
-    )
-    token_num = await fetch_remote(
-        worker_addr + "/count_token",
-        {"model": request.model, "prompt": prompt},
-        "count",
-    )
+    context_len = await model_registry.get_context_len(worker_addr, request.model)
+    token_num = (await count_prompt_tokens(worker_addr, request.model, [prompt]))[0]
     length = min(max_tokens, context_len - token_num)
 
     if length <= 0:
@@ -180,6 +576,36 @@ async def check_length(request, prompt, max_tokens, worker_addr):
     return length, None
 
 
+async def count_prompt_tokens(
+    worker_addr: str, model_name: str, prompts: List[str]
+) -> List[int]:
+    """Count the tokens of each prompt, locally if the tokenizer is available."""
+    global tokenizer_cache
+    counts = None
+    if app_settings.local_tokenizer:
+        model_path = await model_registry.get_model_path(worker_addr, model_name)
+        settings = await model_registry.get_tokenizer_settings(worker_addr)
+        if model_path is not None and settings is not None:
+            if tokenizer_cache is None:
+                tokenizer_cache = TokenizerCache(
+                    app_settings.tokenizer_threads,
+                    app_settings.tokenizer_trust_remote_code,
+                )
+            counts = await tokenizer_cache.count(model_path, settings, prompts)
+    if counts is None:
+        counts = await asyncio.gather(
+            *[
+                fetch_remote(
+                    worker_addr + "/count_token",
+                    {"model": model_name, "prompt": prompt},
+                    "count",
+                )
+                for prompt in prompts
+            ]
+        )
+    return list(counts)
+
+
 def check_requests(request) -> Optional[JSONResponse]:
     # Check all params
     if request.max_tokens is not None and request.max_tokens <= 0:
@@ -257,6 +683,23 @@ def create_openai_logprobs(logprob_dict):
     return LogProbs(**logprob_dict) if logprob_dict is not None else None
 
 
+def add_usage(usage: UsageInfo, task_usage: Dict[str, Any]):
+    """Add the usage of a worker output, weighting the acceptance rates by tokens."""
+    task_usage = UsageInfo.parse_obj(task_usage)
+    if task_usage.acceptance_rate is not None:
+        if usage.acceptance_rate is None:
+            usage.acceptance_rate = task_usage.acceptance_rate
+        else:
+            num_tokens = usage.completion_tokens + task_usage.completion_tokens
+            usage.acceptance_rate = (
+                usage.acceptance_rate * usage.completion_tokens
+                + task_usage.acceptance_rate * task_usage.completion_tokens
+            ) / max(num_tokens, 1)
+    usage.prompt_tokens += task_usage.prompt_tokens
+    usage.completion_tokens += task_usage.completion_tokens
+    usage.total_tokens += task_usage.total_tokens
+
+
 def _add_to_set(s, new_stop):
     if not s:
         return
@@ -280,6 +723,7 @@ async def get_gen_params(
     echo: Optional[bool],
     logprobs: Optional[int] = None,
     stop: Optional[Union[str, List[str]]],
+    seed: Optional[int] = None,
     best_of: Optional[int] = None,
     use_beam_search: Optional[bool] = None,
 ) -> Dict[str, Any]:
@@ -350,6 +794,8 @@ async def get_gen_params(
     if len(images) > 0:
         gen_params["images"] = images
 
+    if seed is not None:
+        gen_params["seed"] = seed
     if best_of is not None:
         gen_params.update({"best_of": best_of})
     if use_beam_search is not None:
@@ -365,17 +811,42 @@ async def get_gen_params(
     return gen_params
 
 
-async def get_worker_address(model_name: str) -> str:
+def get_affinity_key(request) -> str:
+    """
+    Identify the session of a request for the affinity dispatch of the controller.
+    Without a `user`, the start of the conversation stands in for the session,
+    because it stays the same across the turns.
+    """
+    if request.user:
+        return request.user
+    if hasattr(request, "messages"):
+        prefix = request.messages
+        if not isinstance(prefix, str):
+            # The system message and the first user message
+            end = next((i for i, m in enumerate(prefix) if m.get("role") == "user"), 0)
+            prefix = prefix[: end + 1]
+    else:
+        prefix = request.prompt
+        if isinstance(prefix, list):
+            prefix = prefix[0] if prefix else ""
+        prefix = prefix[:AFFINITY_PREFIX_CHARS]
+    return hashlib.sha1(json.dumps(prefix, default=str).encode()).hexdigest()
+
+
+async def get_worker_address(model_name: str, affinity_key: str = None) -> str:
     """
     Get worker address based on the requested model
 
     :param model_name: The worker's model name
+    :param affinity_key: The session of the request for the affinity dispatch
     :return: Worker address from the controller
     :raises: :class:`ValueError`: No available worker for requested model
     """
     controller_address = app_settings.controller_address
     worker_addr = await fetch_remote(
-        controller_address + "/get_worker_address", {"model": model_name}, "address"
+        controller_address + "/get_worker_address",
+        {"model": model_name, "affinity_key": affinity_key},
+        "address",
     )
 
     # No available worker
@@ -386,22 +857,14 @@ async def get_worker_address(model_name: str) -> str:
 
 
 async def get_conv(model_name: str, worker_addr: str):
-    conv_template = conv_template_map.get((worker_addr, model_name))
-    if conv_template is None:
-        conv_template = await fetch_remote(
-            worker_addr + "/worker_get_conv_template", {"model": model_name}, "conv"
-        )
-        conv_template_map[(worker_addr, model_name)] = conv_template
-    return conv_template
+    return await model_registry.get_conv(worker_addr, model_name)
 
 
 @app.get("/v1/models", dependencies=[Depends(check_api_key)])
 async def show_available_models():
-    controller_address = app_settings.controller_address
-    ret = await fetch_remote(controller_address + "/refresh_all_workers")
-    models = await fetch_remote(controller_address + "/list_models", None, "models")
+    # The controller drops dead workers by itself, so the cached list is enough.
+    models = sorted(await model_registry.get_models())
 
-    models.sort()
     # TODO: return real model permission details
     model_cards = []
     for m in models:
@@ -409,8 +872,12 @@ async def show_available_models():
     return ModelList(data=model_cards)
 
 
-@app.post("/v1/chat/completions", dependencies=[Depends(check_api_key)])
-async def create_chat_completion(request: ChatCompletionRequest):
+@app.post("/v1/chat/completions")
+async def create_chat_completion(
+    request: ChatCompletionRequest,
+    raw_request: fastapi.Request,
+    api_key: Optional[str] = Depends(check_api_key),
+):
     """Creates a completion for the chat message"""
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
@@ -419,7 +886,17 @@ async def create_chat_completion(request: ChatCompletionRequest):
     if error_check_ret is not None:
         return error_check_ret
 
-    worker_addr = await get_worker_address(request.model)
+    cache_key = get_cache_key("/v1/chat/completions", request)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            response = ChatCompletionResponse(model=request.model, **cached)
+            if request.stream:
+                generator = cached_chat_completion_stream_generator(response)
+                return StreamingResponse(generator, media_type="text/event-stream")
+            return response
+
+    worker_addr = await get_worker_address(request.model, get_affinity_key(request))
 
     gen_params = await get_gen_params(
         request.model,
@@ -433,6 +910,7 @@ async def create_chat_completion(request: ChatCompletionRequest):
         max_tokens=request.max_tokens,
         echo=False,
         stop=request.stop,
+        seed=request.seed,
     )
 
     max_new_tokens, error_check_ret = await check_length(
@@ -446,27 +924,21 @@ async def create_chat_completion(request: ChatCompletionRequest):
         return error_check_ret
 
     gen_params["max_new_tokens"] = max_new_tokens
+    gen_params.update(get_queue_params(raw_request, api_key))
 
     if request.stream:
         generator = chat_completion_stream_generator(
-            request.model, gen_params, request.n, worker_addr
+            request.model, gen_params, request.n, worker_addr, cache_key
         )
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
-        chat_completions.append(content)
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await generate_choices(gen_params, worker_addr, request.n)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
     for i, content in enumerate(all_tasks):
-        if isinstance(content, str):
-            content = json.loads(content)
-
         if content["error_code"] != 0:
             return create_error_response(content["error_code"], content["text"])
         choices.append(
@@ -477,15 +949,32 @@ async def create_chat_completion(request: ChatCompletionRequest):
             )
         )
         if "usage" in content:
-            task_usage = UsageInfo.parse_obj(content["usage"])
-            for usage_key, usage_value in task_usage.dict().items():
-                setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+            add_usage(usage, content["usage"])
 
-    return ChatCompletionResponse(model=request.model, choices=choices, usage=usage)
+    response = ChatCompletionResponse(model=request.model, choices=choices, usage=usage)
+    if cache_key is not None:
+        await put_cached_response(cache_key, response)
+    return response
+
+
+def compile_sse_chunk(make_chunk: Callable[[str], BaseModel]) -> Callable[[str], str]:
+    """
+    Render the SSE event of a stream chunk once with a placeholder text and
+    return a function that renders it with other texts by concatenation,
+    which costs O(len(text)) instead of a pydantic model per token.
+    """
+    data = make_chunk(SSE_PLACEHOLDER).json(exclude_unset=True, ensure_ascii=False)
+    prefix, suffix = data.split(json.dumps(SSE_PLACEHOLDER), 1)
+    prefix, suffix = "data: " + prefix, suffix + "\n\n"
+    return lambda text: prefix + json.dumps(text, ensure_ascii=False) + suffix
 
 
 async def chat_completion_stream_generator(
-    model_name: str, gen_params: Dict[str, Any], n: int, worker_addr: str
+    model_name: str,
+    gen_params: Dict[str, Any],
+    n: int,
+    worker_addr: str,
+    cache_key: Optional[str] = None,
 ) -> Generator[str, Any, None]:
     """
     Event stream format:
@@ -493,32 +982,63 @@ async def chat_completion_stream_generator(
     """
     id = f"chatcmpl-{shortuuid.random()}"
     finish_stream_events = []
-    for i in range(n):
-        # First chunk with role
-        choice_data = ChatCompletionResponseStreamChoice(
-            index=i,
-            delta=DeltaMessage(role="assistant"),
-            finish_reason=None,
-        )
-        chunk = ChatCompletionStreamResponse(
-            id=id, choices=[choice_data], model=model_name
-        )
-        yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+    # The text, finish reason and usage of the choices for the response cache
+    texts = {i: [] for i in range(n)}
+    finish_reasons = {}
+    usage = UsageInfo()
+    # A worker with parallel sampling streams all choices in one request.
+    if n > 1 and await model_registry.supports_parallel_sampling(worker_addr):
+        streams = [({**gen_params, "n": n}, list(range(n)))]
+    else:
+        streams = [(dict(gen_params), [i]) for i in range(n)]
+    # The choices that already got their first chunk with the role
+    started = set()
+    for payload, indices in streams:
+        encoders = {}
+        for i in indices:
+            if i not in started:
+                # First chunk with role
+                started.add(i)
+                choice_data = ChatCompletionResponseStreamChoice(
+                    index=i,
+                    delta=DeltaMessage(role="assistant"),
+                    finish_reason=None,
+                )
+                chunk = ChatCompletionStreamResponse(
+                    id=id, choices=[choice_data], model=model_name
+                )
+                yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
 
-        previous_text = ""
-        async for content in generate_completion_stream(gen_params, worker_addr):
+            encoders[i] = compile_sse_chunk(
+                lambda text: ChatCompletionStreamResponse(
+                    id=id,
+                    choices=[
+                        ChatCompletionResponseStreamChoice(
+                            index=i,
+                            delta=DeltaMessage(content=text),
+                            finish_reason=None,
+                        )
+                    ],
+                    model=model_name,
+                )
+            )
+        # The usage of the last output of a stream covers all of its choices.
+        stream_usage = None
+        async for content in generate_completion_stream(payload, worker_addr):
             if content["error_code"] != 0:
                 yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
                 yield "data: [DONE]\n\n"
                 return
-            decoded_unicode = content["text"].replace("\ufffd", "")
-            delta_text = decoded_unicode[len(previous_text) :]
-            previous_text = (
-                decoded_unicode
-                if len(decoded_unicode) > len(previous_text)
-                else previous_text
-            )
+            i = content.get("index", indices[0])
+            delta_text = content["text"]
+            texts[i].append(delta_text)
+            if delta_text and content.get("finish_reason", None) is None:
+                yield encoders[i](delta_text)
+                continue
 
+            stream_usage = content.get("usage", None) or stream_usage
+            if content.get("finish_reason", None) is not None:
+                finish_reasons[i] = content["finish_reason"]
             if len(delta_text) == 0:
                 delta_text = None
             choice_data = ChatCompletionResponseStreamChoice(
@@ -534,14 +1054,75 @@ async def chat_completion_stream_generator(
                     finish_stream_events.append(chunk)
                 continue
             yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+        if stream_usage is not None:
+            add_usage(usage, stream_usage)
+        # A worker the controller proxy failed over to may ignore `n`, then
+        # the choices it did not generate get one request each.
+        if len(indices) > 1:
+            streams.extend(
+                (dict(gen_params), [i]) for i in indices if i not in finish_reasons
+            )
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.json(exclude_none=True, ensure_ascii=False)}\n\n"
     yield "data: [DONE]\n\n"
 
+    if cache_key is not None and len(finish_reasons) == n:
+        choices = [
+            ChatCompletionResponseChoice(
+                index=i,
+                message=ChatMessage(role="assistant", content="".join(texts[i])),
+                finish_reason=finish_reasons[i],
+            )
+            for i in range(n)
+        ]
+        response = ChatCompletionResponse(
+            model=model_name, choices=choices, usage=usage
+        )
+        await put_cached_response(cache_key, response)
+
 
-@app.post("/v1/completions", dependencies=[Depends(check_api_key)])
-async def create_completion(request: CompletionRequest):
+async def cached_chat_completion_stream_generator(
+    response: ChatCompletionResponse,
+) -> Generator[str, Any, None]:
+    """Replay a cached response in the events of a stream."""
+    finish_stream_events = []
+    for choice in response.choices:
+        for delta in [
+            DeltaMessage(role="assistant"),
+            DeltaMessage(content=choice.message.content),
+        ]:
+            chunk = ChatCompletionStreamResponse(
+                id=response.id,
+                choices=[
+                    ChatCompletionResponseStreamChoice(
+                        index=choice.index, delta=delta, finish_reason=None
+                    )
+                ],
+                model=response.model,
+            )
+            yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+        choice_data = ChatCompletionResponseStreamChoice(
+            index=choice.index,
+            delta=DeltaMessage(),
+            finish_reason=choice.finish_reason,
+        )
+        finish_stream_events.append(
+            ChatCompletionStreamResponse(
+                id=response.id, choices=[choice_data], model=response.model
+            )
+        )
+    for finish_chunk in finish_stream_events:
+        yield f"data: {finish_chunk.json(exclude_none=True, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/v1/completions")
+async def create_completion(
+    request: CompletionRequest,
+    raw_request: fastapi.Request,
+    api_key: Optional[str] = Depends(check_api_key),
+):
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
         return error_check_ret
@@ -551,7 +1132,17 @@ async def create_completion(request: CompletionRequest):
 
     request.prompt = process_input(request.model, request.prompt)
 
-    worker_addr = await get_worker_address(request.model)
+    cache_key = get_cache_key("/v1/completions", request)
+    if cache_key is not None:
+        cached = await response_cache.get(cache_key)
+        if cached is not None:
+            response = CompletionResponse(model=request.model, **cached)
+            if request.stream:
+                generator = cached_completion_stream_generator(response)
+                return StreamingResponse(generator, media_type="text/event-stream")
+            return response
+
+    worker_addr = await get_worker_address(request.model, get_affinity_key(request))
     for text in request.prompt:
         max_tokens, error_check_ret = await check_length(
             request, text, request.max_tokens, worker_addr
@@ -562,9 +1153,14 @@ async def create_completion(request: CompletionRequest):
         if isinstance(max_tokens, int) and max_tokens < request.max_tokens:
             request.max_tokens = max_tokens
 
+    queue_params = get_queue_params(raw_request, api_key)
     if request.stream:
+        # The streams of several prompts have no distinct indexes, and the
+        # logprobs of a stream are not collected.
+        if len(request.prompt) > 1 or request.logprobs is not None:
+            cache_key = None
         generator = generate_completion_stream_generator(
-            request, request.n, worker_addr
+            request, request.n, worker_addr, queue_params, cache_key
         )
         return StreamingResponse(generator, media_type="text/event-stream")
     else:
@@ -583,19 +1179,20 @@ async def create_completion(request: CompletionRequest):
                 logprobs=request.logprobs,
                 echo=request.echo,
                 stop=request.stop,
+                seed=request.seed,
                 best_of=request.best_of,
                 use_beam_search=request.use_beam_search,
             )
-            for i in range(request.n):
-                content = asyncio.create_task(
-                    generate_completion(gen_params, worker_addr)
-                )
-                text_completions.append(content)
+            gen_params.update(queue_params)
+            text_completions.append(
+                generate_choices(gen_params, worker_addr, request.n, request.best_of)
+            )
 
         try:
             all_tasks = await asyncio.gather(*text_completions)
         except Exception as e:
             return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
+        all_tasks = [content for outputs in all_tasks for content in outputs]
 
         choices = []
         usage = UsageInfo()
@@ -610,50 +1207,94 @@ async def create_completion(request: CompletionRequest):
                     finish_reason=content.get("finish_reason", "stop"),
                 )
             )
-            task_usage = UsageInfo.parse_obj(content["usage"])
-            for usage_key, usage_value in task_usage.dict().items():
-                setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+            if "usage" in content:
+                add_usage(usage, content["usage"])
 
-        return CompletionResponse(
+        response = CompletionResponse(
             model=request.model, choices=choices, usage=UsageInfo.parse_obj(usage)
         )
+        if cache_key is not None:
+            await put_cached_response(cache_key, response)
+        return response
 
 
 async def generate_completion_stream_generator(
-    request: CompletionRequest, n: int, worker_addr: str
+    request: CompletionRequest,
+    n: int,
+    worker_addr: str,
+    queue_params: Dict[str, Any],
+    cache_key: Optional[str] = None,
 ):
     model_name = request.model
     id = f"cmpl-{shortuuid.random()}"
     finish_stream_events = []
+    # The text, finish reason and usage of the choices for the response cache
+    texts = {i: [] for i in range(n)}
+    finish_reasons = {}
+    usage = UsageInfo()
+    parallel = n > 1 and await model_registry.supports_parallel_sampling(worker_addr)
     for text in request.prompt:
-        for i in range(n):
-            previous_text = ""
-            gen_params = await get_gen_params(
-                request.model,
-                worker_addr,
-                text,
-                temperature=request.temperature,
-                top_p=request.top_p,
-                top_k=request.top_k,
-                presence_penalty=request.presence_penalty,
-                frequency_penalty=request.frequency_penalty,
-                max_tokens=request.max_tokens,
-                logprobs=request.logprobs,
-                echo=request.echo,
-                stop=request.stop,
-            )
-            async for content in generate_completion_stream(gen_params, worker_addr):
+        gen_params = await get_gen_params(
+            request.model,
+            worker_addr,
+            text,
+            temperature=request.temperature,
+            top_p=request.top_p,
+            top_k=request.top_k,
+            presence_penalty=request.presence_penalty,
+            frequency_penalty=request.frequency_penalty,
+            max_tokens=request.max_tokens,
+            logprobs=request.logprobs,
+            echo=request.echo,
+            stop=request.stop,
+            seed=request.seed,
+        )
+        gen_params.update(queue_params)
+        # A worker with parallel sampling streams all choices in one request.
+        if parallel:
+            streams = [({**gen_params, "n": n}, list(range(n)))]
+        else:
+            streams = [(dict(gen_params), [i]) for i in range(n)]
+        for payload, indices in streams:
+            encoders = {
+                i: compile_sse_chunk(
+                    lambda text: CompletionStreamResponse(
+                        id=id,
+                        object="text_completion",
+                        choices=[
+                            CompletionResponseStreamChoice(
+                                index=i, text=text, logprobs=None, finish_reason=None
+                            )
+                        ],
+                        model=model_name,
+                    )
+                )
+                for i in indices
+            }
+            # The usage of the last output of a stream covers all of its choices.
+            stream_usage = None
+            # The choices of this prompt that the stream finished
+            finished = set()
+            async for content in generate_completion_stream(payload, worker_addr):
                 if content["error_code"] != 0:
                     yield f"data: {json.dumps(content, ensure_ascii=False)}\n\n"
                     yield "data: [DONE]\n\n"
                     return
-                decoded_unicode = content["text"].replace("\ufffd", "")
-                delta_text = decoded_unicode[len(previous_text) :]
-                previous_text = (
-                    decoded_unicode
-                    if len(decoded_unicode) > len(previous_text)
-                    else previous_text
-                )
+                i = content.get("index", indices[0])
+                delta_text = content["text"]
+                texts[i].append(delta_text)
+                if (
+                    delta_text
+                    and content.get("logprobs", None) is None
+                    and content.get("finish_reason", None) is None
+                ):
+                    yield encoders[i](delta_text)
+                    continue
+
+                stream_usage = content.get("usage", None) or stream_usage
+                if content.get("finish_reason", None) is not None:
+                    finish_reasons[i] = content["finish_reason"]
+                    finished.add(i)
                 # todo: index is not apparent
                 choice_data = CompletionResponseStreamChoice(
                     index=i,
@@ -667,46 +1308,173 @@ async def generate_completion_stream_generator(
                     choices=[choice_data],
                     model=model_name,
                 )
-                if len(delta_text) == 0:
-                    if content.get("finish_reason", None) is not None:
+                if content.get("finish_reason", None) is not None:
+                    if len(delta_text) == 0:
                         finish_stream_events.append(chunk)
+                        continue
+                elif len(delta_text) == 0 and not (
+                    choice_data.logprobs and choice_data.logprobs.tokens
+                ):
+                    # Nothing new, keep chunks with logprobs of new tokens.
                     continue
                 yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+            if stream_usage is not None:
+                add_usage(usage, stream_usage)
+            # A worker the controller proxy failed over to may ignore `n`,
+            # then the choices it did not generate get one request each.
+            if len(indices) > 1:
+                streams.extend(
+                    (dict(gen_params), [i]) for i in indices if i not in finished
+                )
     # There is not "content" field in the last delta message, so exclude_none to exclude field "content".
     for finish_chunk in finish_stream_events:
         yield f"data: {finish_chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
     yield "data: [DONE]\n\n"
 
+    if cache_key is not None and len(finish_reasons) == n:
+        choices = [
+            CompletionResponseChoice(
+                index=i,
+                text="".join(texts[i]),
+                logprobs=None,
+                finish_reason=finish_reasons[i],
+            )
+            for i in range(n)
+        ]
+        response = CompletionResponse(model=model_name, choices=choices, usage=usage)
+        await put_cached_response(cache_key, response)
+
+
+async def cached_completion_stream_generator(response: CompletionResponse):
+    """Replay a cached response in the events of a stream."""
+    finish_stream_events = []
+    for choice in response.choices:
+        for text, logprobs, finish_reason in [
+            (choice.text, choice.logprobs, None),
+            ("", None, choice.finish_reason),
+        ]:
+            chunk = CompletionStreamResponse(
+                id=response.id,
+                object="text_completion",
+                choices=[
+                    CompletionResponseStreamChoice(
+                        index=choice.index,
+                        text=text,
+                        logprobs=logprobs,
+                        finish_reason=finish_reason,
+                    )
+                ],
+                model=response.model,
+            )
+            if finish_reason is None:
+                yield f"data: {chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+            else:
+                finish_stream_events.append(chunk)
+    for finish_chunk in finish_stream_events:
+        yield f"data: {finish_chunk.json(exclude_unset=True, ensure_ascii=False)}\n\n"
+    yield "data: [DONE]\n\n"
+
+
+def get_generate_address(payload: Dict[str, Any], worker_addr: str) -> str:
+    """
+    In the controller proxy mode, generation requests go through the controller,
+    which tries `worker_addr` first and fails over to other workers.
+    """
+    if app_settings.controller_proxy:
+        payload["worker_address"] = worker_addr
+        return app_settings.controller_address
+    return worker_addr
+
 
 async def generate_completion_stream(payload: Dict[str, Any], worker_addr: str):
-    controller_address = app_settings.controller_address
-    async with httpx.AsyncClient() as client:
-        delimiter = b"\0"
-        async with client.stream(
-            "POST",
-            worker_addr + "/worker_generate_stream",
-            headers=headers,
-            json=payload,
-            timeout=WORKER_API_TIMEOUT,
-        ) as response:
-            # content = await response.aread()
-            buffer = b""
-            async for raw_chunk in response.aiter_raw():
-                buffer += raw_chunk
-                while (chunk_end := buffer.find(delimiter)) >= 0:
-                    chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
-                    if not chunk:
-                        continue
-                    yield json.loads(chunk.decode())
+    """Yield the outputs of a worker, with only the new text in each of them."""
+    client = get_httpx_client()
+    delimiter = b"\0"
+    payload["stream_delta"] = True
+    # For the workers that send the whole text every time, by choice index
+    stream_deltas = {}
+    async with client.stream(
+        "POST",
+        get_generate_address(payload, worker_addr) + "/worker_generate_stream",
+        headers=headers,
+        json=payload,
+        timeout=WORKER_API_TIMEOUT,
+    ) as response:
+        if response.status_code == 429:
+            yield json.loads(await response.aread())
+            return
+        # content = await response.aread()
+        buffer = b""
+        async for raw_chunk in response.aiter_raw():
+            buffer += raw_chunk
+            while (chunk_end := buffer.find(delimiter)) >= 0:
+                chunk, buffer = buffer[:chunk_end], buffer[chunk_end + 1 :]
+                if not chunk:
+                    continue
+                content = json.loads(chunk)
+                if content.get("error_code", 0) == 0 and not content.get("delta"):
+                    stream_delta = stream_deltas.setdefault(
+                        content.get("index", 0), StreamDelta()
+                    )
+                    content = stream_delta.update(content)
+                yield content
 
 
 async def generate_completion(payload: Dict[str, Any], worker_addr: str):
-    return await fetch_remote(worker_addr + "/worker_generate", payload, "")
+    return await fetch_remote(
+        get_generate_address(payload, worker_addr) + "/worker_generate", payload, ""
+    )
+
+
+async def generate_choices(
+    payload: Dict[str, Any], worker_addr: str, n: int, best_of: Optional[int] = None
+) -> List[Dict[str, Any]]:
+    """
+    Generate `n` choices of one prompt. A worker with parallel sampling
+    prefills the prompt once and returns all choices in one response, the
+    other workers get one request per choice. So do the choices that a
+    worker failed over to by the controller proxy did not generate.
+
+    :returns: The outputs of the choices, or a list with the error output.
+        The usage of all choices is summed over the outputs that have one.
+    """
+    if max(n, best_of or 1) > 1 and await model_registry.supports_parallel_sampling(
+        worker_addr
+    ):
+        content = await generate_completion({**payload, "n": n}, worker_addr)
+        if isinstance(content, str):
+            content = json.loads(content)
+        if content["error_code"] != 0:
+            return [content]
+        if "choices" not in content:
+            # The worker ignored `n` and generated the first choice only.
+            outputs = await asyncio.gather(
+                *[generate_completion(payload, worker_addr) for _ in range(n - 1)]
+            )
+            return [content] + [
+                json.loads(o) if isinstance(o, str) else o for o in outputs
+            ]
+        outputs = [
+            {**choice, "error_code": 0}
+            for choice in sorted(content["choices"], key=lambda c: c["index"])
+        ]
+        outputs[0]["usage"] = content["usage"]
+        return outputs
+
+    outputs = await asyncio.gather(
+        *[generate_completion(payload, worker_addr) for _ in range(n)]
+    )
+    return [json.loads(o) if isinstance(o, str) else o for o in outputs]
 
 
-@app.post("/v1/embeddings", dependencies=[Depends(check_api_key)])
-@app.post("/v1/engines/{model_name}/embeddings", dependencies=[Depends(check_api_key)])
-async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
+@app.post("/v1/embeddings")
+@app.post("/v1/engines/{model_name}/embeddings")
+async def create_embeddings(
+    request: EmbeddingsRequest,
+    raw_request: fastapi.Request,
+    model_name: str = None,
+    api_key: Optional[str] = Depends(check_api_key),
+):
     """Creates embeddings for the text"""
     if request.model is None:
         request.model = model_name
@@ -715,6 +1483,12 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
         return error_check_ret
 
     request.input = process_input(request.model, request.input)
+    request.embedding_dtype = request.embedding_dtype or "float32"
+    if request.embedding_dtype not in EMBEDDING_DTYPES:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE,
+            f"{request.embedding_dtype} is not one of {list(EMBEDDING_DTYPES)} - 'embedding_dtype'",
+        )
 
     data = []
     token_num = 0
@@ -723,26 +1497,44 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
         request.input[i : min(i + batch_size, len(request.input))]
         for i in range(0, len(request.input), batch_size)
     ]
-    for num_batch, batch in enumerate(batches):
+    # The batches go to different workers in parallel.
+    semaphore = asyncio.Semaphore(app_settings.embedding_concurrency)
+
+    async def get_batch_embedding(batch):
         payload = {
             "model": request.model,
             "input": batch,
             "encoding_format": request.encoding_format,
+            "embedding_dtype": request.embedding_dtype,
+            "binary": True,
+            **get_queue_params(raw_request, api_key),
         }
-        embedding = await get_embedding(payload)
+        async with semaphore:
+            return await get_embedding(payload)
+
+    batch_embeddings = await asyncio.gather(*[get_batch_embedding(b) for b in batches])
+    for num_batch, embedding in enumerate(batch_embeddings):
         if "error_code" in embedding and embedding["error_code"] != 0:
             return create_error_response(embedding["error_code"], embedding["text"])
+        embeddings = embedding["embedding"]
+        if isinstance(embeddings, np.ndarray):
+            if request.encoding_format == "base64":
+                embeddings = embeddings_to_base64(embeddings)
+            else:
+                embeddings = embeddings.tolist()
         data += [
             {
                 "object": "embedding",
                 "embedding": emb,
                 "index": num_batch * batch_size + i,
             }
-            for i, emb in enumerate(embedding["embedding"])
+            for i, emb in enumerate(embeddings)
         ]
         token_num += embedding["token_num"]
-    return EmbeddingsResponse(
-        data=data,
+    # pydantic would validate and copy every float of the data, so only the
+    # envelope goes through the response model.
+    response = EmbeddingsResponse(
+        data=[],
         model=request.model,
         usage=UsageInfo(
             prompt_tokens=token_num,
@@ -750,42 +1542,230 @@ async def create_embeddings(request: EmbeddingsRequest, model_name: str = None):
             completion_tokens=None,
         ),
     ).dict(exclude_none=True)
+    response["data"] = data
+    return JSONResponse(response)
 
 
 async def get_embedding(payload: Dict[str, Any]):
-    controller_address = app_settings.controller_address
+    """
+    Get the embeddings from a worker. Workers that support the binary format
+    return them as a numpy array, the others as JSON.
+    """
     model_name = payload["model"]
     worker_addr = await get_worker_address(model_name)
 
     embedding = await fetch_remote(worker_addr + "/worker_get_embeddings", payload)
+    if is_binary_embeddings(embedding):
+        embeddings, token_num = decode_embeddings(embedding)
+        return {"embedding": embeddings, "token_num": token_num}
     return json.loads(embedding)
 
 
+async def execute_batch_request(
+    url: str, body: Dict[str, Any], priority: int, tenant: str
+) -> Tuple[int, Dict[str, Any]]:
+    """Run a request of a batch with the queue parameters of the batch."""
+    token = batch_queue_params.set({"priority": priority, "tenant": tenant})
+    # The queue parameters replace the ones of the raw request and the API key.
+    try:
+        if url == "/v1/chat/completions":
+            request = ChatCompletionRequest.parse_obj({**body, "stream": False})
+            response = await create_chat_completion(request, None, None)
+        else:
+            request = CompletionRequest.parse_obj({**body, "stream": False})
+            response = await create_completion(request, None, None)
+    except ValidationError as e:
+        error = ErrorResponse(message=str(e), code=ErrorCode.VALIDATION_TYPE_ERROR)
+        return 400, error.dict()
+    finally:
+        batch_queue_params.reset(token)
+    if isinstance(response, JSONResponse):
+        return response.status_code, json.loads(response.body)
+    return 200, response.dict()
+
+
+def check_batch_api() -> Optional[JSONResponse]:
+    if batch_runner is None:
+        return create_error_response(
+            ErrorCode.INTERNAL_ERROR,
+            "The batch API is disabled, start the server with --batch-dir.",
+        )
+    return None
+
+
+def get_own_file(file_id: str, api_key: Optional[str]) -> FileObject:
+    """A file of the caller, the files of other API keys do not exist for it."""
+    file = batch_runner.store.get_file(file_id)
+    if file.owner != get_owner(api_key):
+        raise KeyError(file_id)
+    return file
+
+
+def get_own_batch(batch_id: str, api_key: Optional[str]) -> Batch:
+    batch = batch_runner.get(batch_id)
+    if batch.owner != get_owner(api_key):
+        raise KeyError(batch_id)
+    return batch
+
+
+@app.post("/v1/files")
+async def create_file(
+    request: fastapi.Request,
+    purpose: str = "batch",
+    filename: str = "input.jsonl",
+    api_key: Optional[str] = Depends(check_api_key),
+):
+    """
+    Uploads a JSONL file as the raw request body, e.g.,
+    `curl --data-binary @input.jsonl "localhost:8000/v1/files?purpose=batch"`.
+    """
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    return batch_runner.store.create_file(
+        filename, purpose, await request.body(), get_owner(api_key)
+    )
+
+
+@app.get("/v1/files/{file_id}")
+async def retrieve_file(file_id: str, api_key: Optional[str] = Depends(check_api_key)):
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        return get_own_file(file_id, api_key)
+    except KeyError:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE, f"No file with id {file_id}"
+        )
+
+
+@app.get("/v1/files/{file_id}/content")
+async def retrieve_file_content(
+    file_id: str, api_key: Optional[str] = Depends(check_api_key)
+):
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        file = get_own_file(file_id, api_key)
+    except KeyError:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE, f"No file with id {file_id}"
+        )
+    return FileResponse(
+        batch_runner.store.get_file_path(file_id),
+        media_type="application/jsonl",
+        filename=file.filename,
+    )
+
+
+@app.post("/v1/batches")
+async def create_batch(
+    request: BatchRequest, api_key: Optional[str] = Depends(check_api_key)
+):
+    """Creates a batch of requests that run at a low priority"""
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    priority = max(
+        app_settings.api_key_priorities.get(api_key, 0), app_settings.batch_priority
+    )
+    try:
+        return batch_runner.create(request, priority, get_owner(api_key))
+    except KeyError:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE, f"No file with id {request.input_file_id}"
+        )
+    except ValueError as e:
+        return create_error_response(ErrorCode.PARAM_OUT_OF_RANGE, str(e))
+
+
+@app.get("/v1/batches")
+async def list_batches(
+    limit: int = 20,
+    after: Optional[str] = None,
+    api_key: Optional[str] = Depends(check_api_key),
+):
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    batches = batch_runner.list_batches(get_owner(api_key))
+    if after is not None:
+        ids = [b.id for b in batches]
+        batches = batches[ids.index(after) + 1 :] if after in ids else []
+    return BatchList(data=batches[:limit], has_more=len(batches) > limit)
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(
+    batch_id: str, api_key: Optional[str] = Depends(check_api_key)
+):
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        return get_own_batch(batch_id, api_key)
+    except KeyError:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE, f"No batch with id {batch_id}"
+        )
+
+
+@app.post("/v1/batches/{batch_id}/cancel")
+async def cancel_batch(batch_id: str, api_key: Optional[str] = Depends(check_api_key)):
+    error_check_ret = check_batch_api()
+    if error_check_ret is not None:
+        return error_check_ret
+    try:
+        get_own_batch(batch_id, api_key)
+        return batch_runner.cancel(batch_id)
+    except KeyError:
+        return create_error_response(
+            ErrorCode.PARAM_OUT_OF_RANGE, f"No batch with id {batch_id}"
+        )
+
+
 ### GENERAL API - NOT OPENAI COMPATIBLE ###
 
 
+@app.post("/api/v1/invalidate_model_cache", dependencies=[Depends(check_api_key)])
+async def invalidate_model_cache(request: APIInvalidateModelCacheRequest):
+    """
+    Drops the cached model list and the cached metadata of a worker or a model,
+    or of every worker when neither is given.
+    This is not part of the OpenAI API spec.
+    """
+    num_invalidated = model_registry.invalidate(request.worker_address, request.model)
+    return APIInvalidateModelCacheResponse(num_invalidated=num_invalidated)
+
+
 @app.post("/api/v1/token_check")
 async def count_tokens(request: APITokenCheckRequest):
     """
     Checks the token count for each message in your list
     This is not part of the OpenAI API spec.
     """
-    checkedList = []
+    # Encode the prompts of each model in one batch.
+    prompts_by_model = {}
     for item in request.prompts:
-        worker_addr = await get_worker_address(item.model)
-
-        context_len = await fetch_remote(
-            worker_addr + "/model_details",
-            {"prompt": item.prompt, "model": item.model},
-            "context_length",
+        prompts_by_model.setdefault(item.model, []).append(item.prompt)
+    token_nums = {}
+    context_lens = {}
+    for model_name, prompts in prompts_by_model.items():
+        worker_addr = await get_worker_address(model_name)
+        context_lens[model_name] = await model_registry.get_context_len(
+            worker_addr, model_name
         )
-
-        token_num = await fetch_remote(
-            worker_addr + "/count_token",
-            {"prompt": item.prompt, "model": item.model},
-            "count",
+        token_nums[model_name] = iter(
+            await count_prompt_tokens(worker_addr, model_name, prompts)
         )
 
+    checkedList = []
+    for item in request.prompts:
+        context_len = context_lens[item.model]
+        token_num = next(token_nums[item.model])
+
         can_fit = True
         if token_num + item.max_tokens > context_len:
             can_fit = False
@@ -800,7 +1780,9 @@ async def count_tokens(request: APITokenCheckRequest):
 
 
 @app.post("/api/v1/chat/completions")
-async def create_chat_completion(request: APIChatCompletionRequest):
+async def create_api_chat_completion(
+    request: APIChatCompletionRequest, raw_request: fastapi.Request
+):
     """Creates a completion for the chat message"""
     error_check_ret = await check_model(request)
     if error_check_ret is not None:
@@ -809,7 +1791,7 @@ async def create_chat_completion(request: APIChatCompletionRequest):
     if error_check_ret is not None:
         return error_check_ret
 
-    worker_addr = await get_worker_address(request.model)
+    worker_addr = await get_worker_address(request.model, get_affinity_key(request))
 
     gen_params = await get_gen_params(
         request.model,
@@ -839,6 +1821,7 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         return error_check_ret
 
     gen_params["max_new_tokens"] = max_new_tokens
+    gen_params.update(get_queue_params(raw_request, None))
 
     if request.stream:
         generator = chat_completion_stream_generator(
@@ -847,12 +1830,8 @@ async def create_chat_completion(request: APIChatCompletionRequest):
         return StreamingResponse(generator, media_type="text/event-stream")
 
     choices = []
-    chat_completions = []
-    for i in range(request.n):
-        content = asyncio.create_task(generate_completion(gen_params, worker_addr))
-        chat_completions.append(content)
     try:
-        all_tasks = await asyncio.gather(*chat_completions)
+        all_tasks = await generate_choices(gen_params, worker_addr, request.n)
     except Exception as e:
         return create_error_response(ErrorCode.INTERNAL_ERROR, str(e))
     usage = UsageInfo()
@@ -866,9 +1845,8 @@ async def create_chat_completion(request: APIChatCompletionRequest):
                 finish_reason=content.get("finish_reason", "stop"),
             )
         )
-        task_usage = UsageInfo.parse_obj(content["usage"])
-        for usage_key, usage_value in task_usage.dict().items():
-            setattr(usage, usage_key, getattr(usage, usage_key) + usage_value)
+        if "usage" in content:
+            add_usage(usage, content["usage"])
 
     return ChatCompletionResponse(model=request.model, choices=choices, usage=usage)
 
@@ -902,6 +1880,13 @@ def create_openai_api_server():
         type=lambda s: s.split(","),
         help="Optional list of comma separated API keys",
     )
+    parser.add_argument(
+        "--api-key-priorities",
+        type=json.loads,
+        default={},
+        help="The queue priorities of API keys in the workers, e.g., '{\"key\": 1}'. "
+        "Lower priorities are served first, the default is 0.",
+    )
     parser.add_argument(
         "--ssl",
         action="store_true",
@@ -909,6 +1894,114 @@ def create_openai_api_server():
         default=False,
         help="Enable SSL. Requires OS Environment variables 'SSL_KEYFILE' and 'SSL_CERTFILE'.",
     )
+    parser.add_argument(
+        "--max-connections",
+        type=int,
+        default=1024,
+        help="The maximum number of pooled connections to the controller and workers.",
+    )
+    parser.add_argument(
+        "--max-connections-per-host",
+        type=int,
+        default=256,
+        help="The maximum number of pooled connections to one controller or worker.",
+    )
+    parser.add_argument(
+        "--max-keepalive-connections",
+        type=int,
+        default=256,
+        help="The maximum number of idle connections kept alive.",
+    )
+    parser.add_argument(
+        "--keepalive-expiry",
+        type=float,
+        default=60.0,
+        help="Seconds before an idle connection is closed.",
+    )
+    parser.add_argument(
+        "--model-registry-ttl",
+        type=float,
+        default=60.0,
+        help="Seconds before the cached model list and worker metadata expire.",
+    )
+    parser.add_argument(
+        "--no-local-tokenizer",
+        action="store_true",
+        help="Always count prompt tokens on the workers instead of loading their tokenizers.",
+    )
+    parser.add_argument(
+        "--tokenizer-threads",
+        type=int,
+        default=4,
+        help="The number of threads for loading tokenizers and counting tokens.",
+    )
+    parser.add_argument(
+        "--tokenizer-trust-remote-code",
+        action="store_true",
+        help="Run the code of the model repositories to load the tokenizers for "
+        "counting tokens. Without it, the tokens of models with custom "
+        "tokenizers are counted on their workers.",
+    )
+    parser.add_argument(
+        "--controller-proxy",
+        action="store_true",
+        help="Send generation requests through the controller, which retries "
+        "them on another worker when a worker fails.",
+    )
+    parser.add_argument(
+        "--embedding-concurrency",
+        type=int,
+        default=16,
+        help="The number of embedding batches of one request sent to the "
+        "workers at once.",
+    )
+    parser.add_argument(
+        "--batch-dir",
+        type=str,
+        default=None,
+        help="Enable the batch API and keep its files and checkpoints in this "
+        "directory.",
+    )
+    parser.add_argument(
+        "--batch-priority",
+        type=int,
+        default=10,
+        help="The queue priority of the requests of batches. Lower priorities "
+        "are served first, so batches fill the idle capacity of the workers.",
+    )
+    parser.add_argument(
+        "--batch-concurrency",
+        type=int,
+        default=8,
+        help="The number of requests of batches that run at once.",
+    )
+    parser.add_argument(
+        "--response-cache-size",
+        type=int,
+        default=0,
+        help="Cache this many responses of deterministic (greedy) requests in "
+        "memory. 0 disables the in-memory cache.",
+    )
+    parser.add_argument(
+        "--response-cache-db",
+        type=str,
+        default=None,
+        help="Also cache the responses of deterministic requests in this "
+        "SQLite database, which survives restarts.",
+    )
+    parser.add_argument(
+        "--response-cache-max-db-size",
+        type=int,
+        default=1000000,
+        help="The number of responses kept in the database of the response cache.",
+    )
+    parser.add_argument(
+        "--response-cache-ttl",
+        type=float,
+        default=None,
+        help="Seconds before a cached response expires. By default, responses "
+        "are kept until they are evicted.",
+    )
     args = parser.parse_args()
 
     app.add_middleware(
@@ -920,6 +2013,25 @@ def create_openai_api_server():
     )
     app_settings.controller_address = args.controller_address
     app_settings.api_keys = args.api_keys
+    app_settings.api_key_priorities = args.api_key_priorities
+    app_settings.max_connections = args.max_connections
+    app_settings.max_connections_per_host = args.max_connections_per_host
+    app_settings.max_keepalive_connections = args.max_keepalive_connections
+    app_settings.keepalive_expiry = args.keepalive_expiry
+    app_settings.model_registry_ttl = args.model_registry_ttl
+    model_registry.ttl = args.model_registry_ttl
+    app_settings.local_tokenizer = not args.no_local_tokenizer
+    app_settings.tokenizer_threads = args.tokenizer_threads
+    app_settings.tokenizer_trust_remote_code = args.tokenizer_trust_remote_code
+    app_settings.controller_proxy = args.controller_proxy
+    app_settings.embedding_concurrency = args.embedding_concurrency
+    app_settings.batch_dir = args.batch_dir
+    app_settings.batch_priority = args.batch_priority
+    app_settings.batch_concurrency = args.batch_concurrency
+    app_settings.response_cache_size = args.response_cache_size
+    app_settings.response_cache_db = args.response_cache_db
+    app_settings.response_cache_max_db_size = args.response_cache_max_db_size
+    app_settings.response_cache_ttl = args.response_cache_ttl
 
     logger.info(f"args: {args}")
     return args
@@ -0,0 +1,401 @@
+"""
+A paged KV cache for the huggingface generation path.
+
+The default generate_stream keeps the KV cache of a request as per-layer
+tensors that are reallocated on every decoding step. They fragment the device
+memory, and when it runs out the request fails with a CUDA OOM error.
+
+This module keeps the KV cache of all requests of a worker in one pool of
+fixed-size blocks that is allocated once. Each sequence owns a block table
+that maps its positions to blocks. When the pool is full, idle sequences are
+preempted: their blocks are swapped out to CPU memory, or dropped and
+recomputed from their tokens later when the swap space is full too.
+
+Models only understand the legacy tuple format, so the contiguous KV cache
+returned by the last forward pass of a sequence is kept for its next step, and
+only the new positions are written to its blocks. The blocks are gathered into
+contiguous tensors only when a sequence comes back from a preemption. Under a
+CUDA OOM error, the contiguous copies of the idle sequences are dropped first,
+then the failing sequence is preempted until another one finishes its step.
+"""
+from collections import OrderedDict
+import math
+import threading
+import time
+from typing import Dict, Optional
+
+import torch
+
+from fastchat.serve.kv_cache_utils import to_legacy_cache
+
+
+class PagedSequence:
+    """A handle to one sequence of a PagedKVCache."""
+
+    def __init__(self, cache: "PagedKVCache", seq_id: int):
+        self.cache = cache
+        self.seq_id = seq_id
+        self.freed = False
+
+    def load(self, cancel_event: Optional[threading.Event] = None):
+        """
+        Return the KV cache of the sequence in the legacy tuple format.
+
+        The sequence is pinned until the next `store`, so it is not preempted
+        during its forward pass.
+
+        :param cancel_event: Stops waiting for free blocks when it is set.
+        :returns: None if the KV cache was dropped and must be recomputed, or
+            if `cancel_event` was set while waiting.
+        """
+        return self.cache.load(self.seq_id, cancel_event)
+
+    def store(self, past_key_values):
+        """Save the KV cache returned by the forward pass and unpin the sequence."""
+        self.cache.store(self.seq_id, past_key_values)
+
+    def preempt(self) -> bool:
+        """
+        Release device memory after a CUDA OOM error in the forward pass.
+
+        :returns: False if no other sequence can release memory, so running
+            the step again would fail the same way.
+        """
+        return self.cache.preempt(self.seq_id)
+
+    def free(self):
+        self.cache.free(self.seq_id)
+        self.freed = True
+
+    def __del__(self):
+        # An abandoned generator never reaches its explicit `free`. The lock
+        # may be held by this thread here, so defer the work to the next call.
+        if not self.freed:
+            self.cache.pending_frees.append(self.seq_id)
+
+
+class PagedKVCache:
+    def __init__(
+        self,
+        max_bytes: int,
+        block_size: int = 16,
+        max_swap_bytes: int = 0,
+        max_wait_time: float = 60.0,
+    ):
+        """
+        :param max_wait_time: The number of seconds a sequence waits for free
+            blocks or for memory after an OOM error before it fails.
+        """
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.max_swap_bytes = max_swap_bytes
+        self.max_wait_time = max_wait_time
+        self.cond = threading.Condition()
+
+        # Per-layer pools of shape [num_blocks, num_heads, block_size, head_dim].
+        # They are allocated on the first store, when the shapes are known.
+        self.key_pools = None
+        self.value_pools = None
+        self.num_blocks = 0
+        self.free_blocks = []
+
+        self.next_seq_id = 0
+        # Dict[seq_id -> List[block_id]]
+        self.block_tables = {}
+        # Dict[seq_id -> number of cached positions]
+        self.seq_lens = {}
+        # Resident sequences, ordered from least to most recently used
+        self.lru = OrderedDict()
+        # Sequences in the middle of a forward pass
+        self.pinned = set()
+        # Dict[seq_id -> contiguous KV cache of the last forward pass]
+        self.running_caches = {}
+        # The number of steps stored or sequences freed, to wait for progress
+        self.num_steps = 0
+        # Dict[seq_id -> num_steps when it was preempted by an OOM error]
+        self.oom_preempted = {}
+        # Dict[seq_id -> legacy KV cache on CPU]
+        self.swapped = {}
+        self.swap_bytes = 0
+        self.pending_frees = []
+
+        self.num_swap_outs = 0
+        self.num_recomputes = 0
+
+    def add_sequence(self) -> PagedSequence:
+        with self.cond:
+            seq_id = self.next_seq_id
+            self.next_seq_id += 1
+            self.block_tables[seq_id] = []
+            self.seq_lens[seq_id] = 0
+        return PagedSequence(self, seq_id)
+
+    def load(self, seq_id: int, cancel_event: Optional[threading.Event] = None):
+        with self.cond:
+            self._process_pending_frees()
+            deadline = time.monotonic() + self.max_wait_time
+            # After an OOM error, the memory comes back when another sequence
+            # finishes its step.
+            oom_step = self.oom_preempted.pop(seq_id, None)
+            while oom_step is not None and self.num_steps == oom_step:
+                if not self._wait(deadline, cancel_event):
+                    return None
+
+            self.pinned.add(seq_id)
+            if seq_id in self.swapped:
+                past_key_values = self.swapped[seq_id]
+                length = past_key_values[0][0].shape[-2]
+                if self._num_blocks_for(length) > self.num_blocks:
+                    # The sequence never fits the pool, so serve it from the
+                    # swap space directly.
+                    return tuple(
+                        tuple(t.to(self.key_pools[0].device) for t in layer)
+                        for layer in past_key_values
+                    )
+                # Blocks are released when running sequences finish their step.
+                while not self._reserve(seq_id, length):
+                    if not self._wait(deadline, cancel_event):
+                        return None
+                self._swap_in(seq_id)
+            elif self.seq_lens[seq_id] == 0:
+                return None
+
+            self.lru.move_to_end(seq_id)
+            if seq_id not in self.running_caches:
+                self.running_caches[seq_id] = self._gather(seq_id)
+            return self.running_caches[seq_id]
+
+    def store(self, seq_id: int, past_key_values):
+        past_key_values = to_legacy_cache(past_key_values)
+        length = past_key_values[0][0].shape[-2]
+        with self.cond:
+            self._process_pending_frees()
+            if self.key_pools is None:
+                self._init_pools(past_key_values)
+
+            start = self.seq_lens[seq_id]
+            if seq_id in self.swapped:
+                # The new KV cache covers every position, drop the stale copy.
+                self._drop_swapped(seq_id)
+                start = 0
+
+            if self._reserve(seq_id, length):
+                # Only the positions added by the step are written.
+                self._write(seq_id, start, length, past_key_values)
+                self.seq_lens[seq_id] = length
+                self.running_caches[seq_id] = past_key_values
+                self.lru[seq_id] = None
+                self.lru.move_to_end(seq_id)
+            else:
+                # Every other sequence is running, so preempt this one.
+                self._release_blocks(seq_id)
+                self._preempt(seq_id, past_key_values)
+
+            self.pinned.discard(seq_id)
+            self.num_steps += 1
+            self.cond.notify_all()
+
+    def preempt(self, seq_id: int) -> bool:
+        with self.cond:
+            self._process_pending_frees()
+            idle = [
+                s for s in self.running_caches if s != seq_id and s not in self.pinned
+            ]
+            if idle:
+                # Their KV caches stay in the blocks and are gathered again.
+                for s in idle:
+                    del self.running_caches[s]
+                return True
+            if not any(s != seq_id for s in self.pinned):
+                return False
+
+            past_key_values = self.running_caches.pop(seq_id, None)
+            if past_key_values is None and self.seq_lens[seq_id] > 0:
+                past_key_values = self._gather(seq_id)
+            self._release_blocks(seq_id)
+            if past_key_values is not None:
+                self._preempt(seq_id, past_key_values)
+            self.pinned.discard(seq_id)
+            self.oom_preempted[seq_id] = self.num_steps
+            self.cond.notify_all()
+            return True
+
+    def free(self, seq_id: int):
+        with self.cond:
+            self._free(seq_id)
+            self._process_pending_frees()
+
+    def _free(self, seq_id: int):
+        if seq_id not in self.block_tables:
+            return
+        self._release_blocks(seq_id)
+        if seq_id in self.swapped:
+            self._drop_swapped(seq_id)
+        del self.block_tables[seq_id]
+        del self.seq_lens[seq_id]
+        self.pinned.discard(seq_id)
+        self.oom_preempted.pop(seq_id, None)
+        self.num_steps += 1
+        self.cond.notify_all()
+
+    def _process_pending_frees(self):
+        while self.pending_frees:
+            self._free(self.pending_frees.pop())
+
+    def _wait(self, deadline: float, cancel_event: Optional[threading.Event]) -> bool:
+        """Wait for other sequences to make progress, False if cancelled."""
+        if cancel_event is not None and cancel_event.is_set():
+            return False
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise RuntimeError(
+                "Timed out waiting for memory in the paged KV cache after "
+                f"{self.max_wait_time} seconds."
+            )
+        self.cond.wait(timeout=min(remaining, 1))
+        self._process_pending_frees()
+        return True
+
+    def _init_pools(self, past_key_values):
+        for layer in past_key_values:
+            for t in layer:
+                if t.dim() != 4 or t.shape[0] != 1:
+                    raise ValueError(
+                        "The paged KV cache only supports KV caches of shape "
+                        f"[1, num_heads, seq_len, head_dim], got {list(t.shape)}."
+                    )
+        block_bytes = self.block_size * sum(
+            t.shape[1] * t.shape[3] * t.element_size()
+            for layer in past_key_values
+            for t in layer
+        )
+        self.num_blocks = self.max_bytes // block_bytes
+        if self.num_blocks == 0:
+            raise ValueError(
+                f"The paged KV cache needs at least {block_bytes} bytes for one block."
+            )
+
+        def new_pool(t):
+            return torch.empty(
+                (self.num_blocks, t.shape[1], self.block_size, t.shape[3]),
+                dtype=t.dtype,
+                device=t.device,
+            )
+
+        self.key_pools = [new_pool(k) for k, _ in past_key_values]
+        self.value_pools = [new_pool(v) for _, v in past_key_values]
+        self.free_blocks = list(range(self.num_blocks))
+
+    def _num_blocks_for(self, length: int) -> int:
+        return math.ceil(length / self.block_size)
+
+    def _reserve(self, seq_id: int, length: int) -> bool:
+        """Make the block table of a sequence cover `length` positions."""
+        table = self.block_tables[seq_id]
+        num_needed = self._num_blocks_for(length) - len(table)
+        if num_needed <= 0:
+            return True
+        if self._num_blocks_for(length) > self.num_blocks:
+            return False
+
+        while len(self.free_blocks) < num_needed:
+            victim = next(
+                (s for s in self.lru if s != seq_id and s not in self.pinned), None
+            )
+            if victim is None:
+                return False
+            past_key_values = self.running_caches.get(victim, None)
+            if past_key_values is None:
+                past_key_values = self._gather(victim)
+            self._release_blocks(victim)
+            self._preempt(victim, past_key_values)
+
+        for _ in range(num_needed):
+            table.append(self.free_blocks.pop())
+        return True
+
+    def _release_blocks(self, seq_id: int):
+        self.free_blocks.extend(self.block_tables[seq_id])
+        self.block_tables[seq_id] = []
+        self.lru.pop(seq_id, None)
+        self.running_caches.pop(seq_id, None)
+
+    def _preempt(self, seq_id: int, past_key_values):
+        """Swap out the KV cache of a sequence or drop it if there is no room."""
+        num_bytes = _num_bytes(past_key_values)
+        if self.swap_bytes + num_bytes <= self.max_swap_bytes:
+            self.swapped[seq_id] = tuple(
+                tuple(t.to("cpu") for t in layer) for layer in past_key_values
+            )
+            self.swap_bytes += num_bytes
+            self.num_swap_outs += 1
+        else:
+            self.seq_lens[seq_id] = 0
+            self.num_recomputes += 1
+
+    def _swap_in(self, seq_id: int):
+        device = self.key_pools[0].device
+        past_key_values = tuple(
+            tuple(t.to(device) for t in layer) for layer in self.swapped[seq_id]
+        )
+        length = past_key_values[0][0].shape[-2]
+        self._write(seq_id, 0, length, past_key_values)
+        self.seq_lens[seq_id] = length
+        self.running_caches[seq_id] = past_key_values
+        self._drop_swapped(seq_id)
+        self.lru[seq_id] = None
+
+    def _drop_swapped(self, seq_id: int):
+        self.swap_bytes -= _num_bytes(self.swapped.pop(seq_id))
+
+    def _write(self, seq_id: int, start: int, end: int, past_key_values):
+        if start >= end:
+            return
+        device = self.key_pools[0].device
+        positions = torch.arange(start, end, device=device)
+        table = torch.as_tensor(self.block_tables[seq_id], device=device)
+        block_ids = table[positions // self.block_size]
+        offsets = positions % self.block_size
+        for layer, (k, v) in enumerate(past_key_values):
+            # [1, num_heads, seq_len, head_dim] -> [seq_len, num_heads, head_dim]
+            self.key_pools[layer][block_ids, :, offsets] = (
+                k[0, :, start:end].transpose(0, 1).to(device)
+            )
+            self.value_pools[layer][block_ids, :, offsets] = (
+                v[0, :, start:end].transpose(0, 1).to(device)
+            )
+
+    def _gather(self, seq_id: int):
+        length = self.seq_lens[seq_id]
+        table = torch.as_tensor(
+            self.block_tables[seq_id], device=self.key_pools[0].device
+        )
+
+        def gather(pool):
+            blocks = pool[table].transpose(0, 1)
+            num_heads, head_dim = blocks.shape[0], blocks.shape[-1]
+            return blocks.reshape(1, num_heads, -1, head_dim)[:, :, :length]
+
+        return tuple(
+            (gather(k), gather(v)) for k, v in zip(self.key_pools, self.value_pools)
+        )
+
+    def get_status(self) -> Dict:
+        with self.cond:
+            num_used = self.num_blocks - len(self.free_blocks)
+            return {
+                "num_blocks": self.num_blocks,
+                "num_free_blocks": len(self.free_blocks),
+                "block_size": self.block_size,
+                "utilization": num_used / max(self.num_blocks, 1),
+                "num_sequences": len(self.block_tables),
+                "num_running_caches": len(self.running_caches),
+                "num_swapped": len(self.swapped),
+                "swap_bytes": self.swap_bytes,
+                "num_swap_outs": self.num_swap_outs,
+                "num_recomputes": self.num_recomputes,
+            }
+
+
+def _num_bytes(past_key_values) -> int:
+    return sum(t.numel() * t.element_size() for layer in past_key_values for t in layer)
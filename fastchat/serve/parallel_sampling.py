@@ -0,0 +1,303 @@
+"""
+Parallel sampling of several choices of one prompt for the huggingface
+generation path.
+
+The prompt is prefilled once, its KV cache is copied for every choice, and
+the choices are decoded as one batch. A choice samples with its own seed
+(`seed + index` when the request has a seed), so it does not depend on the
+other choices. A finished choice leaves the batch.
+
+With `best_of`, `best_of` choices are sampled and the `n` with the highest
+logprob per token are returned when all of them are finished. Otherwise the
+outputs of each choice are streamed as they are decoded. Every output has
+the `index` of its choice and the usage of the whole request.
+
+The KV cache is kept in the legacy tuple format.
+"""
+import gc
+from typing import Dict, List, Optional, Tuple
+
+import torch
+
+from fastchat.serve.kv_cache_utils import to_legacy_cache
+from fastchat.serve.sampler import (
+    SamplingParams,
+    compute_logprobs,
+    decode_top_logprobs,
+    sample,
+)
+from fastchat.utils import IncrementalDetokenizer, StopStringMatcher
+
+
+class Choice:
+    def __init__(
+        self,
+        index: int,
+        input_ids: List[int],
+        sampling_params: SamplingParams,
+        detokenizer: IncrementalDetokenizer,
+        stop_matcher: StopStringMatcher,
+        token_logprobs: List[Optional[float]],
+        top_logprobs: List[Optional[Dict[int, float]]],
+    ):
+        self.index = index
+        self.output_ids = list(input_ids)
+        self.sampling_params = sampling_params
+        self.detokenizer = detokenizer
+        self.stop_matcher = stop_matcher
+        # The logprobs of all tokens, including the prompt
+        self.token_logprobs = token_logprobs
+        self.top_logprobs = top_logprobs
+        # The decoded text and offset of each returned token for logprobs
+        self.token_texts = []
+        self.text_offsets = []
+        self.top_texts = []
+        self.cumulative_logprob = 0.0
+        self.num_new_tokens = 0
+        self.text = ""
+        self.logprobs = None
+        self.finish_reason = None
+
+    def update_text(self, tokenizer, start: int, with_logprobs: bool):
+        """
+        Decode the new tokens.
+
+        :returns: Whether the text has a stop string, and whether it ends with
+            a partial stop string.
+        """
+        self.detokenizer.update(self.output_ids)
+        output = self.detokenizer.text
+        if with_logprobs:
+            for pos in range(start + len(self.token_texts), len(self.output_ids)):
+                self.text_offsets.append(
+                    self.text_offsets[-1] + len(self.token_texts[-1])
+                    if self.token_texts
+                    else 0
+                )
+                self.token_texts.append(tokenizer.decode(self.output_ids[pos]))
+                self.top_texts.append(
+                    decode_top_logprobs(tokenizer, self.top_logprobs[pos])
+                )
+            self.logprobs = {
+                "text_offset": list(self.text_offsets),
+                "tokens": list(self.token_texts),
+                "token_logprobs": self.token_logprobs[start:],
+                "top_logprobs": list(self.top_texts),
+            }
+
+        pos, partial_len = self.stop_matcher.update(output)
+        if pos != -1:
+            output = output[:pos]
+        self.text = output
+        return pos != -1, partial_len > 0
+
+    def get_output(self, index: int, usage: Dict) -> Dict:
+        return {
+            "index": index,
+            "text": self.text,
+            "logprobs": self.logprobs,
+            "usage": usage,
+            "finish_reason": self.finish_reason,
+        }
+
+
+def get_num_choices(params: Dict) -> Tuple[int, int]:
+    """The number of returned choices and of sampled choices of a request."""
+    n = int(params.get("n", None) or 1)
+    best_of = max(int(params.get("best_of", None) or n), n)
+    return n, best_of
+
+
+def fork_cache(past_key_values, num_copies: int):
+    """Copy a legacy cache of batch size 1 into `num_copies` rows."""
+    return tuple(
+        tuple(t.repeat(num_copies, *([1] * (t.dim() - 1))) for t in layer)
+        for layer in past_key_values
+    )
+
+
+@torch.inference_mode()
+def generate_stream_parallel(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int = 2,
+    judge_sent_end: bool = False,
+    prefix_cache=None,
+):
+    if hasattr(model, "device"):
+        device = model.device
+
+    # Read parameters
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    logprobs = params.get("logprobs", None)
+    echo = bool(params.get("echo", True))
+    stop_str = params.get("stop", None)
+    stop_token_ids = params.get("stop_token_ids", None) or []
+    if tokenizer.eos_token_id not in stop_token_ids:
+        stop_token_ids.append(tokenizer.eos_token_id)
+    cancel_event = params.get("cancel_event", None)
+    n, best_of = get_num_choices(params)
+    # Rank the choices by their logprobs and only return the n best ones.
+    rank = best_of > n
+
+    request_params = SamplingParams.from_request(params)
+    input_ids = tokenizer(prompt).input_ids
+    max_src_len = context_len - max_new_tokens - 1
+    input_ids = input_ids[-max_src_len:]
+    input_echo_len = len(input_ids)
+    start = 0 if echo else input_echo_len
+    start_ids = torch.as_tensor([input_ids], device=device)
+
+    # Prefill once for all choices.
+    num_cached, cached_key_values = 0, None
+    if prefix_cache is not None and logprobs is None:
+        num_cached, cached_key_values = prefix_cache.lookup(input_ids)
+    out = model(
+        input_ids=start_ids[:, num_cached:],
+        past_key_values=cached_key_values,
+        use_cache=True,
+    )
+    past_key_values = to_legacy_cache(out.past_key_values)
+    logits = out.logits[:, -1, :]
+    prompt_token_logprobs, prompt_top_logprobs = [None], [None]
+    if logprobs is not None:
+        values, tops = compute_logprobs(
+            out.logits[0, :-1, :],
+            start_ids[0, 1:],
+            [logprobs] * (start_ids.shape[1] - 1),
+        )
+        prompt_token_logprobs.extend(values)
+        prompt_top_logprobs.extend(tops)
+    if prefix_cache is not None:
+        prefix_cache.insert(input_ids, past_key_values)
+    out = cached_key_values = None
+
+    try:
+        choices = []
+        for index in range(best_of):
+            sampling_params = SamplingParams(
+                temperature=request_params.temperature,
+                top_p=request_params.top_p,
+                top_k=request_params.top_k,
+                repetition_penalty=request_params.repetition_penalty,
+                seed=None
+                if request_params.seed is None
+                else request_params.seed + index,
+                logprobs=0 if logprobs is None and rank else logprobs,
+            )
+            choices.append(
+                Choice(
+                    index,
+                    input_ids,
+                    sampling_params,
+                    IncrementalDetokenizer(tokenizer, start),
+                    StopStringMatcher(stop_str, len_prompt if echo else 0),
+                    list(prompt_token_logprobs),
+                    list(prompt_top_logprobs),
+                )
+            )
+        past_key_values = fork_cache(past_key_values, best_of)
+        logits = logits.expand(best_of, -1)
+
+        def get_usage():
+            completion_tokens = sum(c.num_new_tokens for c in choices)
+            return {
+                "prompt_tokens": input_echo_len,
+                "completion_tokens": completion_tokens,
+                "total_tokens": input_echo_len + completion_tokens,
+            }
+
+        active = list(choices)
+        for i in range(max_new_tokens):
+            if i > 0:
+                out = model(
+                    input_ids=torch.as_tensor(
+                        [[c.output_ids[-1]] for c in active], device=device
+                    ),
+                    past_key_values=past_key_values,
+                    use_cache=True,
+                )
+                past_key_values = to_legacy_cache(out.past_key_values)
+                logits = out.logits[:, -1, :]
+                out = None
+            if device == "mps":
+                # Switch to CPU by avoiding some bugs in mps backend.
+                logits = logits.float().to("cpu")
+
+            sampler_output = sample(
+                logits,
+                [c.sampling_params for c in active],
+                [c.output_ids for c in active],
+            )
+            finished = []
+            for row, c in enumerate(active):
+                token = sampler_output.tokens[row]
+                c.output_ids.append(token)
+                c.num_new_tokens += 1
+                if sampler_output.logprobs[row] is not None:
+                    c.cumulative_logprob += sampler_output.logprobs[row]
+                if logprobs is not None:
+                    c.token_logprobs.append(sampler_output.logprobs[row])
+                    c.top_logprobs.append(sampler_output.top_logprobs[row])
+
+                stopped = token in stop_token_ids
+                if i % stream_interval == 0 or i == max_new_tokens - 1 or stopped:
+                    has_stop_str, partially_stopped = c.update_text(
+                        tokenizer, start, logprobs is not None
+                    )
+                    stopped = stopped or has_stop_str
+                    # Prevent yielding partial stop sequence
+                    if not rank and not stopped and not partially_stopped:
+                        yield c.get_output(c.index, get_usage())
+                if stopped:
+                    c.finish_reason = "stop"
+                    finished.append(row)
+
+            if finished:
+                for row in finished:
+                    if not rank:
+                        yield active[row].get_output(active[row].index, get_usage())
+                keep = [row for row in range(len(active)) if row not in finished]
+                active = [active[row] for row in keep]
+                if not active:
+                    break
+                index = torch.as_tensor(keep, device=past_key_values[0][0].device)
+                past_key_values = tuple(
+                    tuple(t.index_select(0, index) for t in layer)
+                    for layer in past_key_values
+                )
+            if cancel_event is not None and cancel_event.is_set():
+                for c in active:
+                    c.finish_reason = "abort"
+                break
+        else:
+            for c in active:
+                c.finish_reason = "length"
+
+        if rank:
+            # The best choices by the logprob per token, as the OpenAI API does
+            choices.sort(
+                key=lambda c: c.cumulative_logprob / max(c.num_new_tokens, 1),
+                reverse=True,
+            )
+            for index, c in enumerate(choices[:n]):
+                yield c.get_output(index, get_usage())
+        else:
+            for c in active:
+                if c.finish_reason is not None:
+                    yield c.get_output(c.index, get_usage())
+    finally:
+        # Clean, also when the generator is closed early because the client
+        # is gone.
+        past_key_values = out = None
+        gc.collect()
+        torch.cuda.empty_cache()
+        if device == "xpu":
+            torch.xpu.empty_cache()
+        if device == "npu":
+            torch.npu.empty_cache()
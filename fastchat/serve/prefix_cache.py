@@ -0,0 +1,157 @@
+"""
+A token-prefix KV cache for the huggingface generation path.
+
+Multi-turn chats resend the whole conversation on every turn, and most
+requests of a model share the system prompt of its conversation template.
+This cache keeps the KV cache of finished requests under an LRU byte budget
+and finds the longest cached prefix of a new prompt, so only the remaining
+suffix needs to be prefilled.
+
+Cached sequences are indexed by chained hashes of their full token blocks.
+A lookup walks the blocks of the new prompt, picks the entry behind the
+longest matching block and then extends the match token by token.
+"""
+from collections import OrderedDict
+import threading
+from typing import Dict, List, Optional, Tuple
+
+from fastchat.serve.kv_cache_utils import to_legacy_cache
+
+
+class PrefixCacheEntry:
+    def __init__(self, token_ids: Tuple[int], past_key_values, block_hashes: List):
+        self.token_ids = token_ids
+        self.past_key_values = past_key_values
+        self.block_hashes = block_hashes
+        self.num_bytes = sum(
+            t.numel() * t.element_size() for layer in past_key_values for t in layer
+        )
+
+
+class PrefixCache:
+    def __init__(self, max_bytes: int, block_size: int = 16):
+        self.max_bytes = max_bytes
+        self.block_size = block_size
+        self.lock = threading.Lock()
+
+        # Dict[entry_id -> PrefixCacheEntry], ordered from least to most recent
+        self.entries = OrderedDict()
+        # Dict[block hash -> Dict[entry_id -> None]], the entries that contain
+        # the block, in insertion order. Entries share the blocks of a common
+        # prefix, and a block stays indexed while any of them is cached.
+        self.block_index = {}
+        self.next_entry_id = 0
+        self.num_bytes = 0
+
+        self.num_queries = 0
+        self.num_query_tokens = 0
+        self.num_hit_tokens = 0
+
+    def _block_hashes(self, token_ids: List[int]) -> List:
+        hashes = []
+        prev = None
+        for start in range(0, len(token_ids) - self.block_size + 1, self.block_size):
+            prev = hash((prev, tuple(token_ids[start : start + self.block_size])))
+            hashes.append(prev)
+        return hashes
+
+    def _match(self, token_ids: List[int]) -> Tuple[Optional[int], int]:
+        """Return the entry sharing the longest prefix and the prefix length."""
+        best_id, best_len = None, 0
+        for h in reversed(self._block_hashes(token_ids)):
+            entry_ids = self.block_index.get(h)
+            if not entry_ids:
+                continue
+            # The newest entry with the block
+            entry_id = next(reversed(entry_ids))
+            cached = self.entries[entry_id].token_ids
+            max_len = min(len(cached), len(token_ids))
+            match_len = 0
+            while match_len < max_len and cached[match_len] == token_ids[match_len]:
+                match_len += 1
+            if match_len > best_len:
+                best_id, best_len = entry_id, match_len
+            break
+        return best_id, best_len
+
+    def lookup(self, token_ids: List[int]):
+        """
+        Find the longest cached prefix of `token_ids`.
+
+        At least one token is always left uncached, because the logits of the
+        last prompt token are needed to sample the first new token.
+
+        :returns: The number of cached tokens and their KV cache in the legacy
+            tuple format, or (0, None) when there is no hit.
+        """
+        with self.lock:
+            self.num_queries += 1
+            self.num_query_tokens += len(token_ids)
+            entry_id, match_len = self._match(token_ids)
+            match_len = min(match_len, len(token_ids) - 1)
+            if entry_id is None or match_len <= 0:
+                return 0, None
+
+            self.entries.move_to_end(entry_id)
+            self.num_hit_tokens += match_len
+            past_key_values = self.entries[entry_id].past_key_values
+        return match_len, tuple(
+            tuple(t[..., :match_len, :] for t in layer) for layer in past_key_values
+        )
+
+    def insert(self, token_ids: List[int], past_key_values):
+        """Cache the KV cache of `token_ids`, which must have the same length."""
+        past_key_values = to_legacy_cache(past_key_values)
+        token_ids = tuple(token_ids[: past_key_values[0][0].shape[-2]])
+        if len(token_ids) < self.block_size:
+            return
+        # Only keep the valid positions so the views do not pin extra memory.
+        past_key_values = tuple(
+            tuple(t[..., : len(token_ids), :].contiguous() for t in layer)
+            for layer in past_key_values
+        )
+        block_hashes = self._block_hashes(token_ids)
+
+        with self.lock:
+            entry_id, match_len = self._match(token_ids)
+            if entry_id is not None and match_len == len(token_ids):
+                # Everything is cached already.
+                self.entries.move_to_end(entry_id)
+                return
+
+            entry = PrefixCacheEntry(token_ids, past_key_values, block_hashes)
+            if entry.num_bytes > self.max_bytes:
+                return
+            if entry_id is not None and match_len == len(
+                self.entries[entry_id].token_ids
+            ):
+                # The new sequence extends a cached one (e.g., the next turn of
+                # a chat), so the old entry is no longer needed.
+                self._remove(entry_id)
+
+            new_id = self.next_entry_id
+            self.next_entry_id += 1
+            self.entries[new_id] = entry
+            for h in block_hashes:
+                self.block_index.setdefault(h, {})[new_id] = None
+            self.num_bytes += entry.num_bytes
+
+            while self.num_bytes > self.max_bytes:
+                self._remove(next(iter(self.entries)))
+
+    def _remove(self, entry_id: int):
+        entry = self.entries.pop(entry_id)
+        for h in entry.block_hashes:
+            entry_ids = self.block_index[h]
+            entry_ids.pop(entry_id, None)
+            if not entry_ids:
+                del self.block_index[h]
+        self.num_bytes -= entry.num_bytes
+
+    def get_status(self) -> Dict:
+        return {
+            "num_entries": len(self.entries),
+            "num_bytes": self.num_bytes,
+            "max_bytes": self.max_bytes,
+            "hit_rate": self.num_hit_tokens / max(self.num_query_tokens, 1),
+        }
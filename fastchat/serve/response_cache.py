@@ -0,0 +1,179 @@
+"""
+An exact-match cache of the responses of the OpenAI API server.
+
+Only deterministic requests are cached, i.e., greedy decoding. The key is
+the hash of the endpoint, the model, the normalized messages or prompt and
+the parameters that change a greedy output. The sampling parameters that do
+not, like the temperature, and the `stream` flag are left out, so a cached
+response serves both streaming and non-streaming requests.
+
+Responses are kept in an in-memory LRU, and optionally in a SQLite database
+that survives restarts and is shared by the API servers of a host. The
+database is accessed by one thread of the cache, off the event loop. The key
+only names the model, so with a TTL the responses expire, e.g., after the
+weights behind a model name change.
+"""
+import asyncio
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import hashlib
+import json
+import sqlite3
+import time
+from typing import Any, Dict, Optional, Tuple
+
+from pydantic import BaseModel
+
+# The sampling parameters that do not change the output of greedy decoding
+GREEDY_IGNORED_PARAMS = {"temperature", "top_p", "top_k", "seed", "stream", "user"}
+# Delete the oldest rows of the database every this many inserts
+PRUNE_INTERVAL = 1000
+
+
+def is_deterministic(request: BaseModel) -> bool:
+    """Whether a request decodes greedily, as SamplingParams.greedy does."""
+    temperature = request.temperature if request.temperature is not None else 0.7
+    top_p = request.top_p if request.top_p is not None else 1.0
+    return temperature < 1e-5 or top_p < 1e-8 or request.top_k == 1
+
+
+def normalize_messages(messages):
+    if isinstance(messages, str):
+        return messages
+    normalized = []
+    for message in messages:
+        message = {k: v for k, v in message.items() if v is not None}
+        content = message.get("content")
+        # Content made of text parts only is the same as their text
+        if isinstance(content, list) and all(
+            part.get("type") == "text" for part in content
+        ):
+            message["content"] = "".join(part["text"] for part in content)
+        normalized.append(message)
+    return normalized
+
+
+def get_response_cache_key(endpoint: str, request: BaseModel) -> Optional[str]:
+    """The cache key of a request, or None if its response is not cacheable."""
+    if not is_deterministic(request):
+        return None
+    params = request.dict(exclude=GREEDY_IGNORED_PARAMS)
+    if "messages" in params:
+        params["messages"] = normalize_messages(params["messages"])
+    if isinstance(params.get("stop"), str):
+        params["stop"] = [params["stop"]]
+    data = json.dumps([endpoint, params], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(data.encode()).hexdigest()
+
+
+class ResponseCache:
+    def __init__(
+        self,
+        max_size: int = 0,
+        db_path: Optional[str] = None,
+        max_db_size: int = 1000000,
+        ttl: Optional[float] = None,
+    ):
+        """
+        :param max_size: The number of responses in memory, 0 disables the LRU.
+        :param db_path: The SQLite database of the on-disk tier, None disables it.
+        :param max_db_size: The number of responses kept in the database.
+        :param ttl: Seconds before a cached response expires, None keeps it.
+        """
+        self.max_size = max_size
+        self.db_path = db_path
+        self.max_db_size = max_db_size
+        self.ttl = ttl
+        # OrderedDict[key -> (created, response)], the most recently used ones
+        # at the end
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.executor = None
+        self.db = None
+        self.num_inserts = 0
+        if db_path is not None:
+            # sqlite3 connections are bound to the thread that opens them.
+            self.executor = ThreadPoolExecutor(
+                max_workers=1, thread_name_prefix="response_cache"
+            )
+            self.executor.submit(self._open_db).result()
+
+    def __repr__(self):
+        return (
+            f"ResponseCache(size={len(self.entries)}/{self.max_size}, "
+            f"db={self.db_path}, hits={self.hits}, misses={self.misses})"
+        )
+
+    def _open_db(self):
+        self.db = sqlite3.connect(self.db_path)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute(
+            "CREATE TABLE IF NOT EXISTS responses "
+            "(key TEXT PRIMARY KEY, response TEXT, created REAL)"
+        )
+        self.db.commit()
+
+    def _is_expired(self, created: float) -> bool:
+        return self.ttl is not None and time.time() - created > self.ttl
+
+    def _db_get(self, key: str) -> Optional[Tuple[float, str]]:
+        row = self.db.execute(
+            "SELECT created, response FROM responses WHERE key = ?", (key,)
+        ).fetchone()
+        return row if row is not None and not self._is_expired(row[0]) else None
+
+    def _db_put(self, key: str, response: str):
+        self.db.execute(
+            "INSERT OR REPLACE INTO responses VALUES (?, ?, ?)",
+            (key, response, time.time()),
+        )
+        self.num_inserts += 1
+        if self.num_inserts % PRUNE_INTERVAL == 0:
+            self.db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses "
+                "ORDER BY created DESC LIMIT -1 OFFSET ?)",
+                (self.max_db_size,),
+            )
+            if self.ttl is not None:
+                self.db.execute(
+                    "DELETE FROM responses WHERE created < ?", (time.time() - self.ttl,)
+                )
+        self.db.commit()
+
+    def _put_memory(self, key: str, created: float, response: Dict[str, Any]):
+        if self.max_size <= 0:
+            return
+        self.entries[key] = (created, response)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get(self, key: str) -> Optional[Dict[str, Any]]:
+        response = None
+        entry = self.entries.get(key)
+        if entry is not None and self._is_expired(entry[0]):
+            del self.entries[key]
+        elif entry is not None:
+            self.entries.move_to_end(key)
+            response = entry[1]
+        if response is None and self.db is not None:
+            loop = asyncio.get_running_loop()
+            row = await loop.run_in_executor(self.executor, self._db_get, key)
+            if row is not None:
+                response = json.loads(row[1])
+                self._put_memory(key, row[0], response)
+        if response is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return response
+
+    async def put(self, key: str, response: Dict[str, Any]):
+        self._put_memory(key, time.time(), response)
+        if self.db is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(
+                self.executor, self._db_put, key, json.dumps(response)
+            )
@@ -0,0 +1,203 @@
+"""
+Batched sampling for the huggingface generation path.
+
+All rows of a [batch, vocab] logits tensor are processed in one pass, each
+with its own temperature, repetition penalty, top-p, top-k and seed. The
+processing order matches `prepare_logits_processor`, so a row samples from
+the same distribution as the huggingface logits warpers.
+
+Sampling uses the exponential race: argmax(probs / E) with E ~ Exp(1) is a
+sample of probs. The noise of a seeded row comes from its own generator, so
+its output does not depend on the other rows of the batch.
+"""
+from typing import Dict, List, Optional
+
+import torch
+
+
+class SamplingParams:
+    def __init__(
+        self,
+        temperature: float = 1.0,
+        top_p: float = 1.0,
+        top_k: int = -1,
+        repetition_penalty: float = 1.0,
+        seed: Optional[int] = None,
+        logprobs: Optional[int] = None,
+    ):
+        self.temperature = temperature
+        self.top_p = top_p
+        self.top_k = top_k  # -1 means disable
+        self.repetition_penalty = repetition_penalty
+        self.seed = seed
+        self.logprobs = logprobs
+        self.generator = None
+
+    @classmethod
+    def from_request(cls, params: Dict) -> "SamplingParams":
+        seed = params.get("seed", None)
+        return cls(
+            temperature=float(params.get("temperature", 1.0)),
+            top_p=float(params.get("top_p", 1.0)),
+            top_k=int(params.get("top_k", -1)),
+            repetition_penalty=float(params.get("repetition_penalty", 1.0)),
+            seed=int(seed) if seed is not None else None,
+            logprobs=params.get("logprobs", None),
+        )
+
+    @property
+    def greedy(self) -> bool:
+        return self.temperature < 1e-5 or self.top_p < 1e-8
+
+    def get_generator(self, device) -> torch.Generator:
+        if self.generator is None:
+            self.generator = torch.Generator(device=device)
+            self.generator.manual_seed(self.seed)
+        return self.generator
+
+
+class SamplerOutput:
+    def __init__(
+        self,
+        candidates: List[List[int]],
+        logprobs: List[Optional[float]],
+        top_logprobs: List[Optional[Dict[int, float]]],
+    ):
+        # The best `num_candidates` tokens of each row, the sample comes first
+        self.candidates = candidates
+        self.tokens = [c[0] for c in candidates]
+        # Raw logprobs of the sampled tokens, None for rows without logprobs
+        self.logprobs = logprobs
+        self.top_logprobs = top_logprobs
+
+
+def process_logits(
+    logits: torch.Tensor,
+    params: List[SamplingParams],
+    output_ids: Optional[List[List[int]]] = None,
+) -> torch.Tensor:
+    """
+    Apply temperature, repetition penalty, top-p and top-k to each row.
+
+    :param logits: The float logits of shape [batch, vocab].
+    :param output_ids: The previous tokens of each row for the repetition penalty.
+    """
+    batch_size, vocab_size = logits.shape
+    device = logits.device
+
+    # TemperatureLogitsWarper doesn't accept 0.0, 1.0 makes it a no-op.
+    temperatures = [p.temperature if p.temperature >= 1e-5 else 1.0 for p in params]
+    if any(t != 1.0 for t in temperatures):
+        logits = logits / torch.tensor(temperatures, device=device)[:, None]
+
+    penalties = [max(p.repetition_penalty, 1.0) for p in params]
+    if any(penalty > 1.0 for penalty in penalties):
+        # Token `vocab_size` pads the rows and is dropped from the mask.
+        max_len = max(len(ids) for ids in output_ids)
+        prev_ids = torch.full((batch_size, max_len), vocab_size, dtype=torch.long)
+        for row, ids in enumerate(output_ids):
+            if penalties[row] > 1.0 and ids:
+                prev_ids[row, : len(ids)] = torch.as_tensor(ids)
+        prev_ids = prev_ids.clamp_(max=vocab_size).to(device)
+        seen = torch.zeros(
+            (batch_size, vocab_size + 1), dtype=torch.bool, device=device
+        )
+        seen.scatter_(1, prev_ids, True)
+        penalties = torch.tensor(penalties, device=device)[:, None]
+        logits = torch.where(
+            seen[:, :vocab_size],
+            torch.where(logits > 0, logits / penalties, logits * penalties),
+            logits,
+        )
+
+    top_ps = [p.top_p if 1e-8 <= p.top_p < 1.0 else float("inf") for p in params]
+    top_ks = [p.top_k if p.top_k > 0 else vocab_size for p in params]
+    if any(p != float("inf") for p in top_ps) or any(k < vocab_size for k in top_ks):
+        sorted_logits, sorted_indices = logits.sort(dim=-1, descending=True)
+        sorted_probs = sorted_logits.softmax(dim=-1)
+        # Remove a token once the tokens ranked before it cover top_p.
+        remove = sorted_probs.cumsum(dim=-1) - sorted_probs >= torch.tensor(
+            top_ps, device=device
+        ).unsqueeze(-1)
+        ranks = torch.arange(vocab_size, device=device)
+        remove |= ranks[None, :] >= torch.tensor(top_ks, device=device)[:, None]
+        sorted_logits = sorted_logits.masked_fill(remove, -float("inf"))
+        logits = torch.empty_like(logits).scatter_(1, sorted_indices, sorted_logits)
+    return logits
+
+
+def compute_logprobs(
+    logits: torch.Tensor, token_ids: torch.Tensor, num_top_logprobs: List[int]
+):
+    """
+    Get the raw logprobs of `token_ids` and the top logprobs of each row.
+
+    :param logits: The raw logits of shape [batch, vocab].
+    :param token_ids: The chosen tokens of shape [batch].
+    :param num_top_logprobs: The number of top logprobs of each row.
+    :returns: The logprobs and the Dict[token_id -> logprob] of each row.
+    """
+    logprobs = torch.log_softmax(logits.float(), dim=-1)
+    token_logprobs = logprobs.gather(1, token_ids[:, None]).squeeze(1).tolist()
+    max_top = max(num_top_logprobs, default=0)
+    if max_top <= 0:
+        return token_logprobs, [None] * len(token_logprobs)
+
+    top_values, top_indices = logprobs.topk(max_top, dim=-1)
+    top_logprobs = []
+    for n, values, indices in zip(
+        num_top_logprobs, top_values.tolist(), top_indices.tolist()
+    ):
+        top_logprobs.append(dict(zip(indices[:n], values[:n])) if n > 0 else None)
+    return token_logprobs, top_logprobs
+
+
+@torch.inference_mode()
+def sample(
+    logits: torch.Tensor,
+    params: List[SamplingParams],
+    output_ids: Optional[List[List[int]]] = None,
+    num_candidates: int = 1,
+) -> SamplerOutput:
+    """
+    Sample the next token of every row.
+
+    :param logits: The raw logits of shape [batch, vocab].
+    :param output_ids: The previous tokens of each row for the repetition penalty.
+    :param num_candidates: The number of tokens to draw without replacement.
+    """
+    scores = process_logits(logits.float(), params, output_ids)
+    greedy = [p.greedy for p in params]
+    if not all(greedy):
+        # Exponential race: argmax(probs / noise) is a sample of probs.
+        noise = torch.empty_like(scores).exponential_()
+        for row, p in enumerate(params):
+            if p.seed is not None and not p.greedy:
+                noise[row].exponential_(generator=p.get_generator(scores.device))
+        sampled = scores.softmax(dim=-1) / noise
+        scores = torch.where(
+            torch.tensor(greedy, device=scores.device)[:, None], scores, sampled
+        )
+    candidates = scores.topk(num_candidates, dim=-1).indices
+
+    rows = [row for row, p in enumerate(params) if p.logprobs is not None]
+    token_logprobs = [None] * len(params)
+    top_logprobs = [None] * len(params)
+    if rows:
+        index = torch.as_tensor(rows, device=logits.device)
+        values, tops = compute_logprobs(
+            logits.index_select(0, index),
+            candidates[index, 0],
+            [params[row].logprobs or 0 for row in rows],
+        )
+        for row, value, top in zip(rows, values, tops):
+            token_logprobs[row] = value
+            top_logprobs[row] = top
+    return SamplerOutput(candidates.tolist(), token_logprobs, top_logprobs)
+
+
+def decode_top_logprobs(tokenizer, top_logprobs: Optional[Dict[int, float]]) -> Dict:
+    """Key the top logprobs of a position by token text for the API."""
+    if not top_logprobs:
+        return {}
+    return {tokenizer.decode(token): value for token, value in top_logprobs.items()}
@@ -6,7 +6,6 @@ python3 -m fastchat.serve.sglang_worker --model-path liuhaotian/llava-v1.5-7b --
 """
 
 import argparse
-import asyncio
 import json
 import multiprocessing
 from typing import List
@@ -20,14 +19,20 @@ from sglang.srt.utils import load_image, is_multimodal_model
 
 from fastchat.conversation import IMAGE_PLACEHOLDER_STR
 from fastchat.constants import ErrorCode, SERVER_ERROR_MSG
+from fastchat.serve.admission import (
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
 from fastchat.serve.base_model_worker import BaseModelWorker
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
 )
-from fastchat.utils import get_context_length, is_partial_stop
+from fastchat.utils import StopStringMatcher, get_context_length
 
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 
 
 @sgl.function
@@ -137,16 +142,15 @@ class SGLWorker(BaseModelWorker):
         )
 
         entire_output = prompt if echo else ""
+        stop_matcher = StopStringMatcher(stop)
         async for out, meta_info in state.text_async_iter(
             var_name="response", return_meta_data=True
         ):
-            partial_stop = any(is_partial_stop(out, i) for i in stop)
+            entire_output += out
 
             # prevent yielding partial stop sequence
-            if partial_stop:
+            if stop_matcher.update(entire_output)[1] > 0:
                 continue
-
-            entire_output += out
             prompt_tokens = meta_info["prompt_tokens"]
             completion_tokens = meta_info["completion_tokens"]
 
@@ -179,13 +183,13 @@ class SGLWorker(BaseModelWorker):
 
 
 def release_worker_semaphore():
-    worker.semaphore.release()
+    worker.admission_queue.release()
+    worker.push_load()
 
 
-def acquire_worker_semaphore():
-    if worker.semaphore is None:
-        worker.semaphore = asyncio.Semaphore(worker.limit_worker_concurrency)
-    return worker.semaphore.acquire()
+def acquire_worker_semaphore(params):
+    worker.push_load()
+    return worker.admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks():
@@ -197,7 +201,7 @@ def create_background_tasks():
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     generator = worker.generate_stream_gate(params)
     background_tasks = create_background_tasks()
     return StreamingResponse(generator, background=background_tasks)
@@ -206,7 +210,7 @@ async def api_generate_stream(request: Request):
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     output = await worker.generate_gate(params)
     release_worker_semaphore()
     return JSONResponse(output)
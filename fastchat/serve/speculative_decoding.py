@@ -0,0 +1,277 @@
+"""
+Speculative decoding for the huggingface generation path.
+
+A small draft model proposes `num_speculative_tokens` tokens autoregressively,
+and the target model scores all of them in one forward pass. Proposals are
+accepted by rejection sampling, so the output follows the distribution of the
+target model: a draft token d is kept with probability min(1, p(d) / q(d)),
+and the first rejected one is replaced by a sample of max(0, p - q). Greedy
+decoding keeps the proposals that match the argmax of the target model.
+
+Both models keep their KV cache in the legacy tuple format, which is cropped
+back to the accepted tokens after each verification step.
+
+Reference: Leviathan et al. Fast Inference from Transformers via Speculative
+Decoding. https://arxiv.org/abs/2211.17192
+"""
+import gc
+from typing import Dict
+
+import torch
+
+from fastchat.serve.kv_cache_utils import to_legacy_cache
+from fastchat.serve.sampler import (
+    SamplingParams,
+    compute_logprobs,
+    decode_top_logprobs,
+    process_logits,
+)
+from fastchat.utils import IncrementalDetokenizer, StopStringMatcher
+
+
+def crop_cache(past_key_values, length: int):
+    """Keep the first `length` positions of a legacy cache."""
+    return tuple(tuple(t[..., :length, :] for t in layer) for layer in past_key_values)
+
+
+@torch.inference_mode()
+def generate_stream_speculative(
+    model,
+    tokenizer,
+    params: Dict,
+    device: str,
+    context_len: int,
+    stream_interval: int = 2,
+    judge_sent_end: bool = False,
+    draft_model=None,
+    num_speculative_tokens: int = 5,
+):
+    if hasattr(model, "device"):
+        device = model.device
+    draft_device = draft_model.device
+
+    # Read parameters
+    prompt = params["prompt"]
+    len_prompt = len(prompt)
+    max_new_tokens = int(params.get("max_new_tokens", 256))
+    logprobs = params.get("logprobs", None)
+    echo = bool(params.get("echo", True))
+    stop_str = params.get("stop", None)
+    stop_token_ids = params.get("stop_token_ids", None) or []
+    if tokenizer.eos_token_id not in stop_token_ids:
+        stop_token_ids.append(tokenizer.eos_token_id)
+    cancel_event = params.get("cancel_event", None)
+
+    sampling_params = SamplingParams.from_request(params)
+    greedy = sampling_params.greedy
+    generator = None
+    if sampling_params.seed is not None:
+        generator = sampling_params.get_generator(device)
+    # The models may pad their vocabularies to different sizes.
+    vocab_size = min(model.config.vocab_size, draft_model.config.vocab_size)
+
+    def warp(logits, prefixes):
+        """Process logits of shape [n, vocab], row j follows prefixes[j]."""
+        logits = logits[:, :vocab_size].float().to(device)
+        return process_logits(logits, [sampling_params] * len(prefixes), prefixes)
+
+    def sample(probs):
+        if greedy:
+            return int(torch.argmax(probs))
+        return int(torch.multinomial(probs, num_samples=1, generator=generator))
+
+    def get_logprobs(logits, tokens):
+        return compute_logprobs(
+            logits[: len(tokens)],
+            torch.as_tensor(tokens, device=logits.device),
+            [logprobs or 0] * len(tokens),
+        )
+
+    input_ids = tokenizer(prompt).input_ids
+    # The target model looks ahead by up to num_speculative_tokens tokens.
+    max_src_len = context_len - max_new_tokens - num_speculative_tokens - 1
+    input_ids = input_ids[-max_src_len:]
+    output_ids = list(input_ids)
+    input_echo_len = len(input_ids)
+
+    # Prefill both models
+    out = model(input_ids=torch.as_tensor([input_ids], device=device), use_cache=True)
+    past_key_values = to_legacy_cache(out.past_key_values)
+    draft_key_values = to_legacy_cache(
+        draft_model(
+            input_ids=torch.as_tensor([input_ids], device=draft_device),
+            use_cache=True,
+        ).past_key_values
+    )
+
+    token_logprobs = [None]  # The first token has no logprobs.
+    top_logprobs = [None]
+    if logprobs is not None:
+        prompt_logprobs, prompt_top_logprobs = get_logprobs(
+            out.logits[0, :-1], input_ids[1:]
+        )
+        token_logprobs.extend(prompt_logprobs)
+        top_logprobs.extend(prompt_top_logprobs)
+
+    new_tokens = [sample(torch.softmax(warp(out.logits[:, -1], [output_ids])[0], -1))]
+    if logprobs is not None:
+        new_logprobs, new_top_logprobs = get_logprobs(out.logits[0, -1:], new_tokens)
+    del out
+
+    detokenizer = IncrementalDetokenizer(tokenizer, 0 if echo else input_echo_len)
+    stop_matcher = StopStringMatcher(stop_str, len_prompt if echo else 0)
+    token_texts = []  # The decoded text of each returned token for logprobs.
+    text_offsets = []
+    top_texts = []
+    num_proposed = num_accepted = 0
+    stopped = False
+    finish_reason = None
+    i = -1
+    while True:
+        prev_i = i
+        for j, token in enumerate(new_tokens):
+            i += 1
+            output_ids.append(token)
+            if logprobs is not None:
+                token_logprobs.append(new_logprobs[j])
+                top_logprobs.append(new_top_logprobs[j])
+            stopped = token in stop_token_ids
+            if stopped or i == max_new_tokens - 1:
+                break
+        finished = stopped or i == max_new_tokens - 1
+
+        # Yield the output tokens
+        if i // stream_interval > prev_i // stream_interval or finished:
+            start = 0 if echo else input_echo_len
+
+            detokenizer.update(output_ids)
+            output = detokenizer.text
+            ret_logprobs = None
+            if logprobs is not None:
+                # Only decode the tokens that are new since the last emit.
+                for pos in range(start + len(token_texts), len(output_ids)):
+                    text_offsets.append(
+                        text_offsets[-1] + len(token_texts[-1]) if token_texts else 0
+                    )
+                    token_texts.append(tokenizer.decode(output_ids[pos]))
+                    top_texts.append(decode_top_logprobs(tokenizer, top_logprobs[pos]))
+                ret_logprobs = {
+                    "text_offset": list(text_offsets),
+                    "tokens": list(token_texts),
+                    "token_logprobs": token_logprobs[start:],
+                    "top_logprobs": list(top_texts),
+                }
+
+            pos, partial_len = stop_matcher.update(output)
+            if pos != -1:
+                output = output[:pos]
+                stopped = True
+            partially_stopped = partial_len > 0
+
+            usage = {
+                "prompt_tokens": input_echo_len,
+                "completion_tokens": i,
+                "total_tokens": input_echo_len + i,
+                "acceptance_rate": num_accepted / max(num_proposed, 1),
+            }
+            # Prevent yielding partial stop sequence
+            if not partially_stopped:
+                yield {
+                    "text": output,
+                    "logprobs": ret_logprobs,
+                    "usage": usage,
+                    "finish_reason": None,
+                }
+
+        if stopped:
+            finish_reason = "stop"
+            break
+        if i == max_new_tokens - 1:
+            finish_reason = "length"
+            break
+        if cancel_event is not None and cancel_event.is_set():
+            finish_reason = "abort"
+            break
+
+        # Propose tokens with the draft model. Its cache may lag behind the
+        # accepted tokens by one or two positions.
+        draft_ids = output_ids[draft_key_values[0][0].shape[-2] :]
+        drafts, draft_probs = [], []
+        for _ in range(min(num_speculative_tokens, max_new_tokens - 1 - i)):
+            draft_out = draft_model(
+                input_ids=torch.as_tensor([draft_ids], device=draft_device),
+                past_key_values=draft_key_values,
+                use_cache=True,
+            )
+            draft_key_values = to_legacy_cache(draft_out.past_key_values)
+            draft_logits = warp(draft_out.logits[:, -1], [output_ids + drafts])[0]
+            draft_probs.append(torch.softmax(draft_logits, dim=-1))
+            drafts.append(sample(draft_probs[-1]))
+            draft_ids = drafts[-1:]
+
+        # Verify all proposals in one forward pass of the target model
+        num_cached = past_key_values[0][0].shape[-2]
+        out = model(
+            input_ids=torch.as_tensor(
+                [output_ids[num_cached:] + drafts], device=device
+            ),
+            past_key_values=past_key_values,
+            use_cache=True,
+        )
+        past_key_values = to_legacy_cache(out.past_key_values)
+        target_logits = out.logits[0, -len(drafts) - 1 :]
+        del out
+
+        # Row j assumes that the first j proposals are accepted.
+        target_probs = torch.softmax(
+            warp(
+                target_logits, [output_ids + drafts[:j] for j in range(len(drafts) + 1)]
+            ),
+            dim=-1,
+        )
+        new_tokens = []
+        for j, probs in enumerate(target_probs):
+            if j == len(drafts):
+                # Every proposal is accepted, take a bonus token.
+                token = sample(probs)
+            elif greedy:
+                token = int(torch.argmax(probs))
+            else:
+                draft_token, q = drafts[j], draft_probs[j]
+                r = torch.rand(1, generator=generator, device=device).item()
+                if r * q[draft_token] < probs[draft_token]:
+                    token = draft_token
+                else:
+                    residual = torch.clamp(probs - q, min=0)
+                    if residual.sum() <= 0:
+                        residual = probs
+                    token = sample(residual)
+            new_tokens.append(token)
+            if j == len(drafts) or token != drafts[j]:
+                break
+        if logprobs is not None:
+            new_logprobs, new_top_logprobs = get_logprobs(target_logits, new_tokens)
+
+        num_proposed += len(drafts)
+        num_accepted += len(new_tokens) - 1
+        # Drop the cache of the rejected proposals.
+        num_valid = len(output_ids) + len(new_tokens) - 1
+        past_key_values = crop_cache(past_key_values, num_valid)
+        draft_key_values = crop_cache(draft_key_values, num_valid)
+
+    # Finish stream event, which contains finish reason
+    yield {
+        "text": output,
+        "logprobs": ret_logprobs,
+        "usage": usage,
+        "finish_reason": finish_reason,
+    }
+
+    # Clean
+    del past_key_values, draft_key_values
+    gc.collect()
+    torch.cuda.empty_cache()
+    if device == "xpu":
+        torch.xpu.empty_cache()
+    if device == "npu":
+        torch.npu.empty_cache()
@@ -0,0 +1,134 @@
+"""
+Run a JSONL file of requests as a batch on the OpenAI API server and write the
+results to a JSONL file, in the order of the requests.
+
+The server must be started with --batch-dir. The id of the batch is kept next
+to the output file until the results are written, so that running the same
+command again after an interruption waits for the same batch instead of
+submitting a new one.
+
+Each line of the input file is a request like
+{"custom_id": "q1", "method": "POST", "url": "/v1/chat/completions",
+ "body": {"model": "vicuna-7b-v1.5", "messages": [{"role": "user", "content": "Hi"}]}}
+
+Usage:
+python3 -m fastchat.serve.submit_batch --input-file requests.jsonl --output-file results.jsonl
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import requests
+
+DONE_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+
+def get_endpoint(input_file: str) -> str:
+    with open(input_file) as f:
+        for line in f:
+            if line.strip():
+                return json.loads(line)["url"]
+    raise ValueError(f"{input_file} has no requests.")
+
+
+def submit(session: requests.Session, args) -> str:
+    with open(args.input_file, "rb") as f:
+        ret = session.post(
+            f"{args.api_base}/files",
+            params={"purpose": "batch", "filename": os.path.basename(args.input_file)},
+            data=f,
+        )
+    ret.raise_for_status()
+    file_id = ret.json()["id"]
+
+    ret = session.post(
+        f"{args.api_base}/batches",
+        json={
+            "input_file_id": file_id,
+            "endpoint": args.endpoint or get_endpoint(args.input_file),
+            "completion_window": args.completion_window,
+        },
+    )
+    ret.raise_for_status()
+    return ret.json()["id"]
+
+
+def download(session: requests.Session, args, file_id: str):
+    ret = session.get(f"{args.api_base}/files/{file_id}/content")
+    ret.raise_for_status()
+    return [json.loads(line) for line in ret.text.splitlines() if line.strip()]
+
+
+def main(args):
+    session = requests.Session()
+    if args.api_key:
+        session.headers["Authorization"] = f"Bearer {args.api_key}"
+
+    batch_id_file = args.output_file + ".batch_id"
+    if os.path.exists(batch_id_file):
+        with open(batch_id_file) as f:
+            batch_id = f.read().strip()
+        print(f"Resume batch {batch_id}")
+    else:
+        batch_id = submit(session, args)
+        with open(batch_id_file, "w") as f:
+            f.write(batch_id)
+        print(f"Submit batch {batch_id}")
+
+    while True:
+        ret = session.get(f"{args.api_base}/batches/{batch_id}")
+        ret.raise_for_status()
+        batch = ret.json()
+        counts = batch["request_counts"]
+        print(
+            f"{batch['status']}: {counts['completed']} completed, "
+            f"{counts['failed']} failed, {counts['total']} total"
+        )
+        if batch["status"] in DONE_STATUSES:
+            break
+        time.sleep(args.poll_interval)
+
+    if batch["status"] == "failed" and batch["output_file_id"] is None:
+        for error in batch["errors"]["data"]:
+            print(f"line {error.get('line')}: {error['message']}", file=sys.stderr)
+        os.remove(batch_id_file)
+        sys.exit(1)
+
+    results = {}
+    for file_id in [batch["output_file_id"], batch["error_file_id"]]:
+        for result in download(session, args, file_id):
+            results[result["custom_id"]] = result
+    with open(args.input_file) as fin, open(args.output_file, "w") as fout:
+        for line in fin:
+            if line.strip():
+                result = results.get(json.loads(line)["custom_id"], None)
+                if result is not None:
+                    fout.write(json.dumps(result, ensure_ascii=False) + "\n")
+    os.remove(batch_id_file)
+    print(f"Write {len(results)} results to {args.output_file}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input-file", type=str, required=True)
+    parser.add_argument("--output-file", type=str, required=True)
+    parser.add_argument("--api-base", type=str, default="http://localhost:8000/v1")
+    parser.add_argument("--api-key", type=str, default=None)
+    parser.add_argument(
+        "--endpoint",
+        type=str,
+        default=None,
+        help="Defaults to the url of the first request.",
+    )
+    parser.add_argument("--completion-window", type=str, default="24h")
+    parser.add_argument(
+        "--poll-interval",
+        type=float,
+        default=10,
+        help="Seconds between the status checks of the batch.",
+    )
+    args = parser.parse_args()
+
+    main(args)
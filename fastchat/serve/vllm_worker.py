@@ -5,7 +5,6 @@ See documentations at docs/vllm_integration.md
 """
 
 import argparse
-import asyncio
 import json
 from typing import List
 
@@ -17,15 +16,21 @@ from vllm.engine.arg_utils import AsyncEngineArgs
 from vllm.sampling_params import SamplingParams
 from vllm.utils import random_uuid
 
+from fastchat.serve.admission import (
+    WorkerOverloadedError,
+    get_admission_params,
+    handle_worker_overloaded,
+)
 from fastchat.serve.base_model_worker import BaseModelWorker
 from fastchat.serve.model_worker import (
     logger,
     worker_id,
 )
-from fastchat.utils import get_context_length, is_partial_stop
+from fastchat.utils import StopStringMatcher, StreamDelta, get_context_length
 
 
 app = FastAPI()
+app.add_exception_handler(WorkerOverloadedError, handle_worker_overloaded)
 
 
 class VLLMWorker(BaseModelWorker):
@@ -117,6 +122,9 @@ class VLLMWorker(BaseModelWorker):
             best_of=best_of,
         )
         results_generator = engine.generate(context, sampling_params, request_id)
+        stop_matcher = StopStringMatcher(stop)
+        # Send only the new text if the client asks for deltas.
+        stream_delta = StreamDelta() if params.get("stream_delta") else None
 
         async for request_output in results_generator:
             prompt = request_output.prompt
@@ -128,9 +136,8 @@ class VLLMWorker(BaseModelWorker):
                 text_outputs = [output.text for output in request_output.outputs]
             text_outputs = " ".join(text_outputs)
 
-            partial_stop = any(is_partial_stop(text_outputs, i) for i in stop)
             # prevent yielding partial stop sequence
-            if partial_stop:
+            if stop_matcher.update(text_outputs)[1] > 0:
                 continue
 
             aborted = False
@@ -160,10 +167,16 @@ class VLLMWorker(BaseModelWorker):
                 if len(request_output.outputs) == 1
                 else [output.finish_reason for output in request_output.outputs],
             }
+            if stream_delta is not None:
+                ret = stream_delta.update(ret)
+                ret["delta"] = True
             # Emit twice here to ensure a 'finish_reason' with empty content in the OpenAI API response.
             # This aligns with the behavior of model_worker.
             if request_output.finished:
                 yield (json.dumps({**ret, **{"finish_reason": None}}) + "\0").encode()
+                if stream_delta is not None:
+                    # The new text is in the chunk above.
+                    ret["text"] = ""
             yield (json.dumps(ret) + "\0").encode()
 
             if aborted:
@@ -176,13 +189,13 @@ class VLLMWorker(BaseModelWorker):
 
 
 def release_worker_semaphore():
-    worker.semaphore.release()
+    worker.admission_queue.release()
+    worker.push_load()
 
 
-def acquire_worker_semaphore():
-    if worker.semaphore is None:
-        worker.semaphore = asyncio.Semaphore(worker.limit_worker_concurrency)
-    return worker.semaphore.acquire()
+def acquire_worker_semaphore(params):
+    worker.push_load()
+    return worker.admission_queue.acquire(**get_admission_params(params))
 
 
 def create_background_tasks(request_id):
@@ -198,7 +211,7 @@ def create_background_tasks(request_id):
 @app.post("/worker_generate_stream")
 async def api_generate_stream(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     request_id = random_uuid()
     params["request_id"] = request_id
     params["request"] = request
@@ -210,7 +223,7 @@ async def api_generate_stream(request: Request):
 @app.post("/worker_generate")
 async def api_generate(request: Request):
     params = await request.json()
-    await acquire_worker_semaphore()
+    await acquire_worker_semaphore(params)
     request_id = random_uuid()
     params["request_id"] = request_id
     params["request"] = request
@@ -0,0 +1,183 @@
+"""
+Load telemetry of a model worker for the load-aware dispatching of the controller.
+
+The worker measures its decode throughput, smoothed into the speed that
+the controller weighs it by, the prompt tokens of the requests
+that have not produced their first token yet (including the ones waiting for
+the worker semaphore), its rolling time to first token (TTFT) and its KV
+cache occupancy, and pushes them to the controller over the worker channel
+when a request starts or finishes, and at least every
+WORKER_TELEMETRY_INTERVAL seconds.
+"""
+from collections import deque
+import json
+import threading
+import time
+from typing import Callable, Dict, Optional
+
+# Seconds between two parses of the usage in the output stream of a request
+USAGE_PARSE_INTERVAL = 0.5
+# The lowest speed of a worker in tokens/s, so that an idle or slow worker is
+# never weighted by zero
+MIN_WORKER_SPEED = 1.0
+
+
+class RequestStats:
+    def __init__(self, prompt_chars: int, prompt_tokens: int):
+        self.arrival_time = time.time()
+        self.prompt_chars = prompt_chars
+        # An estimate until the worker reports the real count
+        self.prompt_tokens = prompt_tokens
+        self.prompt_tokens_known = False
+        self.completion_tokens = 0
+        self.started = False
+        self.last_parse_time = 0.0
+
+
+class WorkerTelemetry:
+    def __init__(
+        self,
+        window: float = 10.0,
+        alpha: float = 0.2,
+        get_kv_cache_usage: Optional[Callable[[], float]] = None,
+    ):
+        """
+        :param window: Seconds over which the decode throughput is measured.
+        :param alpha: The smoothing factor of the moving averages.
+        :param get_kv_cache_usage: Returns the used fraction of the KV cache.
+        """
+        self.window = window
+        self.alpha = alpha
+        self.get_kv_cache_usage = get_kv_cache_usage
+        self.lock = threading.Lock()
+
+        self.requests = set()
+        self.pending_prompt_tokens = 0
+        # (time, number of generated tokens) of the last `window` seconds
+        self.token_events = deque()
+        # The start of the current busy period, None while idle
+        self.busy_since = None
+        # Moving averages, None until the first request finishes
+        self.speed = None
+        self.ttft = None
+        self.avg_prompt_tokens = None
+        self.avg_completion_tokens = None
+        # Estimates the prompt tokens of a request before it is tokenized.
+        self.chars_per_token = 4.0
+
+    def _ewma(self, old: Optional[float], new: float) -> float:
+        return new if old is None else (1 - self.alpha) * old + self.alpha * new
+
+    def start_request(self, params: Dict) -> RequestStats:
+        """Register a request when it arrives, before it waits for the worker."""
+        prompt_chars = len(str(params.get("prompt", "")))
+        stats = RequestStats(prompt_chars, int(prompt_chars / self.chars_per_token))
+        with self.lock:
+            if not self.requests:
+                self.busy_since = stats.arrival_time
+            self.requests.add(stats)
+            self.pending_prompt_tokens += stats.prompt_tokens
+        return stats
+
+    def _on_first_output(self, stats: RequestStats):
+        with self.lock:
+            stats.started = True
+            self.pending_prompt_tokens -= stats.prompt_tokens
+            self.ttft = self._ewma(self.ttft, time.time() - stats.arrival_time)
+
+    def _on_usage(self, stats: RequestStats, usage: Dict):
+        now = time.time()
+        with self.lock:
+            if "prompt_tokens" in usage and not stats.prompt_tokens_known:
+                stats.prompt_tokens_known = True
+                if not stats.started:
+                    self.pending_prompt_tokens += (
+                        usage["prompt_tokens"] - stats.prompt_tokens
+                    )
+                stats.prompt_tokens = usage["prompt_tokens"]
+                if stats.prompt_tokens > 0:
+                    self.chars_per_token = self._ewma(
+                        self.chars_per_token, stats.prompt_chars / stats.prompt_tokens
+                    )
+            num_new = usage.get("completion_tokens", 0) - stats.completion_tokens
+            if num_new > 0:
+                stats.completion_tokens += num_new
+                self.token_events.append((now, num_new))
+
+    def finish_request(self, stats: RequestStats, usage: Optional[Dict] = None):
+        if usage:
+            self._on_usage(stats, usage)
+        with self.lock:
+            if stats not in self.requests:
+                return
+            self.requests.discard(stats)
+            if not self.requests:
+                self.busy_since = None
+            if not stats.started:
+                self.pending_prompt_tokens -= stats.prompt_tokens
+            if stats.completion_tokens > 0:
+                self.avg_prompt_tokens = self._ewma(
+                    self.avg_prompt_tokens, stats.prompt_tokens
+                )
+                self.avg_completion_tokens = self._ewma(
+                    self.avg_completion_tokens, stats.completion_tokens
+                )
+
+    def track_stream(self, stats: RequestStats, stream):
+        """Wrap the output stream of a request, which yields `\\0` delimited JSON."""
+        chunk = None
+        try:
+            for chunk in stream:
+                if not stats.started:
+                    self._on_first_output(stats)
+                if time.time() - stats.last_parse_time >= USAGE_PARSE_INTERVAL:
+                    stats.last_parse_time = time.time()
+                    self._on_usage(stats, _parse_usage(chunk))
+                yield chunk
+        finally:
+            self.finish_request(stats, _parse_usage(chunk))
+
+    def get_stats(self) -> Dict:
+        now = time.time()
+        with self.lock:
+            while self.token_events and self.token_events[0][0] < now - self.window:
+                self.token_events.popleft()
+            num_tokens = sum(n for _, n in self.token_events)
+            if self.busy_since is not None and num_tokens > 0:
+                # The throughput while busy. Idle periods would understate the
+                # speed, so they keep the last value.
+                busy_time = max(min(now - self.busy_since, self.window), 1e-3)
+                self.speed = self._ewma(self.speed, num_tokens / busy_time)
+            avg_completion_tokens = self.avg_completion_tokens or 0
+            # Prompt tokens to prefill plus the expected remaining decode steps
+            outstanding_tokens = self.pending_prompt_tokens + sum(
+                max(avg_completion_tokens - s.completion_tokens, 0)
+                for s in self.requests
+            )
+            avg_request_tokens = 0
+            if self.avg_prompt_tokens is not None:
+                avg_request_tokens = self.avg_prompt_tokens + avg_completion_tokens
+            stats = {
+                "decode_tokens_per_s": num_tokens / self.window,
+                # 0 until the first measurement
+                "speed": self.speed or 0.0,
+                "pending_prompt_tokens": self.pending_prompt_tokens,
+                "outstanding_tokens": int(outstanding_tokens),
+                "avg_request_tokens": avg_request_tokens,
+                "num_requests": len(self.requests),
+                "ttft": self.ttft or 0.0,
+            }
+        stats["kv_cache_usage"] = (
+            self.get_kv_cache_usage() if self.get_kv_cache_usage else 0.0
+        )
+        return stats
+
+
+def _parse_usage(chunk) -> Dict:
+    if not chunk:
+        return {}
+    try:
+        output = json.loads(chunk.rstrip(b"\0"))
+        return output.get("usage", None) or {}
+    except (ValueError, TypeError, AttributeError):
+        return {}
@@ -9,8 +9,9 @@ import logging
 import logging.handlers
 import os
 import platform
+import queue
 import sys
-from typing import AsyncGenerator, Generator
+from typing import AsyncGenerator, Dict, Generator, Iterable, List, Tuple, Union
 import warnings
 
 import requests
@@ -304,6 +305,223 @@ def is_partial_stop(output: str, stop_str: str):
     return False
 
 
+class StopStringMatcher:
+    """
+    Find stop strings in a growing text with an Aho-Corasick automaton.
+
+    Every update only scans the characters appended since the last update, so
+    the cost per emit does not grow with the text or the number of stop
+    strings. The text must only grow by appending; a shorter text restarts the
+    scan from scratch.
+    """
+
+    def __init__(self, stop_strs: Union[str, Iterable[str], None], start: int = 0):
+        """
+        :param stop_strs: A stop string or a list of stop strings.
+        :param start: The number of leading characters that are not scanned,
+            e.g., the prompt when it is echoed.
+        """
+        if stop_strs is None:
+            stop_strs = []
+        elif isinstance(stop_strs, str):
+            stop_strs = [stop_strs]
+        elif not isinstance(stop_strs, Iterable):
+            raise ValueError("Invalid stop field type.")
+        self.start = start
+
+        # The trie of the stop strings. Node 0 is the root.
+        self.goto = [{}]
+        self.depth = [0]
+        # The length of the longest stop string that ends at each node
+        self.match_len = [0]
+        for stop_str in stop_strs:
+            node = 0
+            for ch in stop_str:
+                if ch not in self.goto[node]:
+                    self.goto.append({})
+                    self.depth.append(self.depth[node] + 1)
+                    self.match_len.append(0)
+                    self.goto[node][ch] = len(self.goto) - 1
+                node = self.goto[node][ch]
+            self.match_len[node] = len(stop_str)
+
+        # Failure links, built in breadth-first order
+        self.fail = [0] * len(self.goto)
+        nodes = list(self.goto[0].values())
+        for node in nodes:
+            for ch, child in self.goto[node].items():
+                fail = self.fail[node]
+                while fail and ch not in self.goto[fail]:
+                    fail = self.fail[fail]
+                self.fail[child] = self.goto[fail].get(ch, 0)
+                self.match_len[child] = max(
+                    self.match_len[child], self.match_len[self.fail[child]]
+                )
+                nodes.append(child)
+        self.reset()
+
+    def reset(self):
+        self.state = 0
+        self.num_scanned = self.start
+        self.stop_pos = -1
+
+    def update(self, text: str) -> Tuple[int, int]:
+        """
+        Scan the characters of `text` that were not scanned before.
+
+        :returns: The start of the first stop string in `text` or -1, and the
+            length of the longest suffix of `text` that is a partial stop string.
+        """
+        if len(text) < self.num_scanned:
+            self.reset()
+        if self.stop_pos == -1:
+            goto, fail, match_len = self.goto, self.fail, self.match_len
+            state = self.state
+            for pos in range(self.num_scanned, len(text)):
+                ch = text[pos]
+                while state and ch not in goto[state]:
+                    state = fail[state]
+                state = goto[state].get(ch, 0)
+                if match_len[state]:
+                    self.stop_pos = pos + 1 - match_len[state]
+                    break
+            self.state = state
+            self.num_scanned = max(len(text), self.num_scanned)
+
+        if self.stop_pos != -1:
+            return self.stop_pos, 0
+        return -1, self.depth[self.state]
+
+
+class StreamDelta:
+    """
+    Turn the cumulative outputs of a generation stream into deltas, so that a
+    chunk only carries the text and the logprobs that are new.
+
+    Trailing replacement characters of an incomplete UTF-8 sequence are held
+    back until the sequence is complete or the stream finishes, like
+    IncrementalDetokenizer does. A text that gets shorter than the one
+    already sent yields an empty delta.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.num_logprobs = 0
+
+    def update(self, output: Dict) -> Dict:
+        text = output["text"]
+        if output.get("finish_reason", None) is None:
+            text = text.rstrip("\ufffd")
+        ret = {**output, "text": text[len(self.text) :]}
+        if len(text) > len(self.text):
+            self.text = text
+
+        logprobs = output.get("logprobs", None)
+        if logprobs is not None:
+            ret["logprobs"] = {k: v[self.num_logprobs :] for k, v in logprobs.items()}
+            self.num_logprobs = len(logprobs["tokens"])
+        return ret
+
+
+class IncrementalDetokenizer:
+    """
+    Decode a growing list of token ids by only decoding the new tail.
+
+    It keeps a prefix offset and a read offset into the token ids. Each update
+    decodes the window starting at the prefix offset with and without the new
+    tokens and returns the difference, so the cost of an update does not grow
+    with the length of the output.
+    """
+
+    # Number of already decoded tokens kept as context for the next update
+    CONTEXT_TOKENS = 5
+
+    def __init__(
+        self,
+        tokenizer,
+        offset: int = 0,
+        skip_special_tokens: bool = True,
+        spaces_between_special_tokens: bool = False,
+        clean_up_tokenization_spaces: bool = True,
+    ):
+        self.tokenizer = tokenizer
+        self.decode_kwargs = dict(
+            skip_special_tokens=skip_special_tokens,
+            spaces_between_special_tokens=spaces_between_special_tokens,
+            clean_up_tokenization_spaces=clean_up_tokenization_spaces,
+        )
+        self.prefix_offset = offset
+        self.read_offset = offset
+        self.text = ""
+
+    def update(self, token_ids: List[int]) -> str:
+        """Consume the token ids after the read offset and return the new text."""
+        if len(token_ids) <= self.read_offset:
+            return ""
+        prefix_text = self.tokenizer.decode(
+            token_ids[self.prefix_offset : self.read_offset], **self.decode_kwargs
+        )
+        new_text = self.tokenizer.decode(
+            token_ids[self.prefix_offset :], **self.decode_kwargs
+        )
+        # Hold back incomplete utf-8 characters until more tokens arrive.
+        if len(new_text) <= len(prefix_text) or new_text.endswith("\ufffd"):
+            return ""
+
+        delta = new_text[len(prefix_text) :]
+        self.prefix_offset = max(self.read_offset, len(token_ids) - self.CONTEXT_TOKENS)
+        self.read_offset = len(token_ids)
+        self.text += delta
+        return delta
+
+
+class IncrementalTextIteratorStreamer:
+    """
+    A drop-in replacement of `transformers.TextIteratorStreamer` built on
+    `IncrementalDetokenizer`.
+
+    `TextIteratorStreamer` re-decodes everything since the last newline on every
+    token. This streamer yields exactly one (possibly empty) text delta per
+    generated token instead.
+    """
+
+    def __init__(
+        self, tokenizer, skip_prompt: bool = False, timeout=None, **decode_kwargs
+    ):
+        self.detokenizer = IncrementalDetokenizer(tokenizer, **decode_kwargs)
+        self.skip_prompt = skip_prompt
+        self.next_tokens_are_prompt = True
+        self.timeout = timeout
+        self.token_ids = []
+        self.text_queue = queue.Queue()
+
+    def put(self, value):
+        if len(value.shape) > 1:
+            if value.shape[0] > 1:
+                raise ValueError("The streamer only supports batch size 1")
+            value = value[0]
+
+        if self.skip_prompt and self.next_tokens_are_prompt:
+            self.next_tokens_are_prompt = False
+            return
+        self.next_tokens_are_prompt = False
+
+        self.token_ids.extend(value.tolist())
+        self.text_queue.put(self.detokenizer.update(self.token_ids))
+
+    def end(self):
+        self.text_queue.put(None)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        value = self.text_queue.get(timeout=self.timeout)
+        if value is None:
+            raise StopIteration()
+        return value
+
+
 def run_cmd(cmd: str):
     """Run a bash command."""
     print(cmd)
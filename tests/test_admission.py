@@ -0,0 +1,90 @@
+import asyncio
+
+import pytest
+
+from fastchat.serve.admission import AdmissionQueue, WorkerOverloadedError
+
+
+async def grant_order(queue, requests):
+    """
+    Queue `requests` of (name, priority, tenant) behind a running request and
+    return the names in the order their slots are granted.
+    """
+    order = []
+
+    async def wait(name, priority, tenant):
+        await queue.acquire(priority, tenant)
+        order.append(name)
+
+    await queue.acquire()
+    tasks = [asyncio.ensure_future(wait(*r)) for r in requests]
+    await asyncio.sleep(0)
+    for _ in requests:
+        queue.release()
+        await asyncio.sleep(0)
+    await asyncio.gather(*tasks)
+    return order
+
+
+def test_priority_order():
+    queue = AdmissionQueue(limit=1)
+    requests = [("low", 5, None), ("high", 0, None), ("mid", 3, None)]
+    order = asyncio.run(grant_order(queue, requests))
+    assert order == ["high", "mid", "low"]
+
+
+def test_tenants_take_turns():
+    queue = AdmissionQueue(limit=1)
+    requests = [
+        ("a1", 0, "a"),
+        ("a2", 0, "a"),
+        ("a3", 0, "a"),
+        ("b1", 0, "b"),
+        ("c1", 0, "c"),
+        ("batch", 10, "a"),
+    ]
+    order = asyncio.run(grant_order(queue, requests))
+    assert order == ["a1", "b1", "c1", "a2", "a3", "batch"]
+
+
+def test_queue_full():
+    async def run():
+        queue = AdmissionQueue(limit=1, max_queue_size=1)
+        await queue.acquire()
+        waiter = asyncio.ensure_future(queue.acquire())
+        await asyncio.sleep(0)
+        with pytest.raises(WorkerOverloadedError):
+            await queue.acquire()
+        assert queue.get_queue_length() == 2
+        queue.release()
+        await waiter
+
+    asyncio.run(run())
+
+
+def test_queue_time_deadline():
+    async def run():
+        queue = AdmissionQueue(limit=1, max_queue_time=10)
+        await queue.acquire()
+        # The deadline of the request is shorter than the one of the worker.
+        with pytest.raises(WorkerOverloadedError):
+            await queue.acquire(max_queue_time=0.01)
+        assert queue.num_waiting == 0 and queue.queues == {}
+
+    asyncio.run(run())
+
+
+def test_cancelled_waiter_leaves_queue():
+    async def run():
+        queue = AdmissionQueue(limit=1)
+        await queue.acquire()
+        waiter = asyncio.ensure_future(queue.acquire(tenant="a"))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await waiter
+        assert queue.num_waiting == 0
+        queue.release()
+        assert queue.num_running == 0
+
+    asyncio.run(run())
@@ -0,0 +1,69 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import threading
+from types import SimpleNamespace
+
+import pytest
+
+from fastchat.serve.base_model_worker import stream_until_disconnect
+
+
+def test_disconnect_closes_generator_after_running_step():
+    worker = SimpleNamespace(executor=ThreadPoolExecutor(2))
+    step_started = threading.Event()
+    resume = threading.Event()
+    events = []
+
+    def generate():
+        try:
+            yield "a"
+            step_started.set()
+            resume.wait()
+            yield "b"
+        finally:
+            events.append("cleanup")
+
+    async def run():
+        cancel_event = threading.Event()
+        closed = asyncio.Event()
+        chunks = []
+
+        def on_close():
+            events.append("on_close")
+            closed.set()
+
+        async def consume():
+            stream = stream_until_disconnect(worker, generate(), cancel_event, on_close)
+            async for chunk in stream:
+                chunks.append(chunk)
+
+        task = asyncio.create_task(consume())
+        while not step_started.is_set():
+            await asyncio.sleep(0.01)
+        # The client is gone while the second step is running.
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+        assert cancel_event.is_set()
+        assert events == []
+
+        resume.set()
+        await asyncio.wait_for(closed.wait(), timeout=5)
+        assert chunks == ["a"]
+        assert events == ["cleanup", "on_close"]
+
+    asyncio.run(run())
+
+
+def test_finished_stream_calls_on_close():
+    worker = SimpleNamespace(executor=ThreadPoolExecutor(1))
+
+    async def run():
+        closed = asyncio.Event()
+        stream = stream_until_disconnect(
+            worker, (c for c in "ab"), threading.Event(), closed.set
+        )
+        assert [chunk async for chunk in stream] == ["a", "b"]
+        await asyncio.wait_for(closed.wait(), timeout=5)
+
+    asyncio.run(run())
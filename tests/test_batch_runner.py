@@ -0,0 +1,162 @@
+import asyncio
+import json
+
+import pytest
+
+from fastchat.protocol.openai_api_protocol import BatchRequest
+from fastchat.serve import batch_runner
+from fastchat.serve.batch_runner import (
+    BatchRunner,
+    BatchStore,
+    get_owner,
+    get_schedule_key,
+    read_custom_ids,
+)
+
+ENDPOINT = "/v1/completions"
+
+
+def request_line(custom_id, prompt="Hi"):
+    return json.dumps(
+        {
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": ENDPOINT,
+            "body": {"model": "m", "prompt": prompt},
+        }
+    )
+
+
+def read_lines(store, file_id):
+    with open(store.get_file_path(file_id)) as f:
+        return [json.loads(line) for line in f]
+
+
+async def run_batch(store, execute, lines, owner=None):
+    """Run a batch of `lines` to its end and return it."""
+    runner = BatchRunner(store, execute, concurrency=2)
+    runner.start()
+    try:
+        file = store.create_file(
+            "input.jsonl", "batch", "\n".join(lines).encode(), owner=owner
+        )
+        batch = runner.create(
+            BatchRequest(input_file_id=file.id, endpoint=ENDPOINT), 0, owner
+        )
+        while batch.id in runner.active:
+            await asyncio.sleep(0.01)
+        return runner.get(batch.id)
+    finally:
+        runner.stop()
+
+
+def test_read_custom_ids_drops_torn_line(tmp_path):
+    path = tmp_path / "output.jsonl"
+    path.write_text('{"custom_id": "a"}\n{"custom_id": "b"}\n{"custom_')
+    assert read_custom_ids(str(path)) == ["a", "b"]
+    assert path.read_text() == '{"custom_id": "a"}\n{"custom_id": "b"}\n'
+    assert read_custom_ids(str(tmp_path / "missing.jsonl")) == []
+
+
+def test_schedule_key_groups_prefixes():
+    requests = [
+        json.loads(request_line("1", "b" * 10)),
+        json.loads(request_line("2", "a" * 20)),
+        json.loads(request_line("3", "b" * 5)),
+    ]
+    order = [r["custom_id"] for r in sorted(requests, key=get_schedule_key)]
+    assert order == ["2", "3", "1"]
+
+
+def test_check_id(tmp_path):
+    store = BatchStore(str(tmp_path))
+    with pytest.raises(KeyError):
+        store.get_file("../batches/x")
+    with pytest.raises(KeyError):
+        store.load_batch("missing")
+
+
+def test_batch_completes(tmp_path):
+    store = BatchStore(str(tmp_path))
+    calls = []
+
+    async def execute(url, body, priority, tenant):
+        calls.append((url, body["prompt"], tenant))
+        if body["prompt"] == "bad":
+            return 400, {"object": "error", "message": "bad prompt"}
+        return 200, {"id": "cmpl-1", "choices": []}
+
+    lines = [request_line("a"), request_line("b", "bad"), request_line("c")]
+    batch = asyncio.run(run_batch(store, execute, lines))
+
+    assert batch.status == "completed"
+    assert batch.request_counts.dict() == {"total": 3, "completed": 2, "failed": 1}
+    assert all(tenant == batch.id for _, _, tenant in calls)
+    outputs = read_lines(store, batch.output_file_id)
+    assert sorted(o["custom_id"] for o in outputs) == ["a", "c"]
+    assert outputs[0]["response"]["request_id"] == "cmpl-1"
+    errors = read_lines(store, batch.error_file_id)
+    assert errors[0]["custom_id"] == "b"
+    assert errors[0]["response"]["status_code"] == 400
+    assert store.get_file(batch.output_file_id).bytes > 0
+
+
+def test_overloaded_requests_are_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch_runner, "BATCH_RETRY_INTERVAL", 0.01)
+    store = BatchStore(str(tmp_path))
+    attempts = []
+
+    async def execute(url, body, priority, tenant):
+        attempts.append(body["prompt"])
+        if len(attempts) < 3:
+            return 429, {}
+        return 200, {"id": "cmpl-1"}
+
+    batch = asyncio.run(run_batch(store, execute, [request_line("a")]))
+    assert batch.status == "completed"
+    assert len(attempts) == 3
+    assert batch.request_counts.completed == 1
+
+
+def test_invalid_lines_fail_the_batch(tmp_path):
+    store = BatchStore(str(tmp_path))
+
+    async def execute(url, body, priority, tenant):
+        raise AssertionError("no request of an invalid batch runs")
+
+    lines = [request_line("a"), "not json", request_line("a")]
+    batch = asyncio.run(run_batch(store, execute, lines))
+    assert batch.status == "failed"
+    assert [e["line"] for e in batch.errors["data"]] == [2, 3]
+    assert batch.output_file_id is None
+
+
+def test_batches_are_scoped_to_owners(tmp_path):
+    store = BatchStore(str(tmp_path))
+    alice, bob = get_owner("key-a"), get_owner("key-b")
+
+    async def execute(url, body, priority, tenant):
+        return 200, {}
+
+    async def run():
+        batch = await run_batch(store, execute, [request_line("a")], alice)
+        runner = BatchRunner(store, execute)
+        runner.start()
+        try:
+            assert [b.id for b in runner.list_batches(alice)] == [batch.id]
+            assert runner.list_batches(bob) == []
+            assert runner.list_batches() == []
+            # The input file of another owner cannot be used.
+            with pytest.raises(KeyError):
+                runner.create(
+                    BatchRequest(input_file_id=batch.input_file_id, endpoint=ENDPOINT),
+                    0,
+                    bob,
+                )
+        finally:
+            runner.stop()
+        # The owner is kept in the store but not sent to the clients.
+        assert store.get_file(batch.output_file_id).owner == alice
+        assert "owner" not in batch.dict()
+
+    asyncio.run(run())
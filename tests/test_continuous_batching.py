@@ -0,0 +1,130 @@
+import threading
+from types import SimpleNamespace
+
+import torch
+
+from fastchat.serve.continuous_batching import ContinuousBatchingEngine
+
+VOCAB_SIZE = 64
+
+
+class CountingModel(torch.nn.Module):
+    """
+    A model whose next token is the number of valid positions in its KV cache.
+
+    Padding positions are zeros in the cache, so a row whose cache or attention
+    mask gets mixed up with another row produces wrong tokens.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.started = threading.Event()
+        self.gate = threading.Event()
+        self.gate.set()
+        self.num_calls = 0
+        self.on_call = None
+        self.decode_batch_sizes = []
+
+    def forward(
+        self, input_ids, attention_mask=None, past_key_values=None, use_cache=True
+    ):
+        self.started.set()
+        self.gate.wait()
+        self.num_calls += 1
+        if self.on_call is not None:
+            self.on_call(self.num_calls)
+        batch_size, seq_len = input_ids.shape
+        keys = torch.ones(batch_size, 1, seq_len, 1)
+        if past_key_values is not None:
+            keys = torch.cat([past_key_values[0][0], keys], dim=-2)
+            self.decode_batch_sizes.append(batch_size)
+        counts = keys.sum(dim=(1, 2, 3)).long()
+        if attention_mask is not None:
+            assert attention_mask.shape[1] == keys.shape[2]
+            assert torch.equal(attention_mask.sum(dim=1), counts)
+
+        logits = torch.zeros(batch_size, seq_len, VOCAB_SIZE)
+        logits[torch.arange(batch_size), -1, counts % VOCAB_SIZE] = 1.0
+        return SimpleNamespace(logits=logits, past_key_values=((keys, keys),))
+
+
+class NumberTokenizer:
+    eos_token_id = VOCAB_SIZE - 1
+
+    def __call__(self, prompt):
+        return SimpleNamespace(input_ids=[int(x) for x in prompt.split()])
+
+    def decode(self, token_ids, **kwargs):
+        return " ".join(str(int(i)) for i in token_ids)
+
+
+def make_engine(model, max_batch_size=2):
+    return ContinuousBatchingEngine(
+        model,
+        NumberTokenizer(),
+        "cpu",
+        context_len=VOCAB_SIZE,
+        stream_interval=1,
+        max_batch_size=max_batch_size,
+    )
+
+
+def make_params(prompt_len, max_new_tokens, **kwargs):
+    return {
+        "prompt": " ".join(["1"] * prompt_len),
+        "temperature": 0.0,
+        "max_new_tokens": max_new_tokens,
+        "echo": False,
+        **kwargs,
+    }
+
+
+def expected_text(prompt_len, max_new_tokens):
+    return " ".join(str(prompt_len + i) for i in range(max_new_tokens))
+
+
+def test_requests_join_and_leave_the_batch():
+    model = CountingModel()
+    engine = make_engine(model, max_batch_size=2)
+    requests = [(2, 3), (5, 8), (3, 5)]
+    outputs = [None] * len(requests)
+
+    def run(i):
+        outputs[i] = list(engine.generate_stream(make_params(*requests[i])))[-1]
+
+    # Hold the prefill of the first request until all of them are submitted.
+    model.gate.clear()
+    threads = [threading.Thread(target=run, args=(i,)) for i in range(3)]
+    threads[0].start()
+    model.started.wait()
+    for thread in threads[1:]:
+        thread.start()
+    while engine.waiting.qsize() < 2:
+        pass
+    model.gate.set()
+    for thread in threads:
+        thread.join(timeout=30)
+
+    for output, request in zip(outputs, requests):
+        assert output["text"] == expected_text(*request)
+        assert output["finish_reason"] == "length"
+        assert output["usage"]["prompt_tokens"] == request[0]
+    # The third request joins once the first one retires.
+    assert max(model.decode_batch_sizes) == 2
+
+
+def test_cancelled_request_is_retired():
+    model = CountingModel()
+    engine = make_engine(model)
+    cancel_event = threading.Event()
+    # The client goes away during the second decode step.
+    model.on_call = lambda num_calls: num_calls == 3 and cancel_event.set()
+    stream = engine.generate_stream(make_params(4, 20, cancel_event=cancel_event))
+    outputs = list(stream)
+    assert [o["text"] for o in outputs] == ["4", "4 5", "4 5 6"]
+    assert outputs[-1]["finish_reason"] is None
+
+    model.on_call = None
+
+    output = list(engine.generate_stream(make_params(6, 4)))[-1]
+    assert output["text"] == expected_text(6, 4)
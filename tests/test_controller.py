@@ -0,0 +1,388 @@
+import asyncio
+import json
+import random
+import time
+
+import httpx
+
+from fastchat.constants import ErrorCode
+from fastchat.serve import controller as controller_module
+from fastchat.serve.controller import Controller
+
+
+def register(controller, worker_name, model_names=("m",), speed=1.0, **kwargs):
+    status = {
+        "model_names": list(model_names),
+        "speed": speed,
+        "queue_length": 0,
+        **kwargs,
+    }
+    asyncio.run(controller.register_worker(worker_name, True, status, False))
+
+
+def dispatch(controller, num_requests, model_name="m", **kwargs):
+    """Count the requests that go to each worker."""
+    counts = {}
+    for _ in range(num_requests):
+        w_name = controller.get_worker_address(model_name, **kwargs)
+        counts[w_name] = counts.get(w_name, 0) + 1
+    return counts
+
+
+def test_models_are_indexed():
+    controller = Controller("shortest_queue")
+    register(controller, "http://w1", ["a", "b"])
+    register(controller, "http://w2", ["a"])
+    assert sorted(controller.list_models()) == ["a", "b"]
+    assert controller.get_worker_address("b") == "http://w1"
+    assert controller.get_worker_address("c") == ""
+
+    controller.remove_worker("http://w1")
+    assert controller.list_models() == ["a"]
+    assert controller.get_worker_address("b") == ""
+
+    # A worker that registers again replaces its models.
+    register(controller, "http://w2", ["c"])
+    assert controller.list_models() == ["c"]
+
+
+def test_shortest_queue_counts_dispatched_requests():
+    controller = Controller("shortest_queue")
+    register(controller, "http://w1", speed=1.0)
+    register(controller, "http://w2", speed=2.0)
+    # Each request is counted until the next heart beat, so a burst is spread
+    # by the speed of the workers.
+    assert dispatch(controller, 6) == {"http://w1": 2, "http://w2": 4}
+
+    controller.receive_heart_beat("http://w1", 0)
+    assert controller.get_worker_address("m") == "http://w1"
+
+
+def test_lottery_follows_speed():
+    random.seed(0)
+    controller = Controller("lottery")
+    register(controller, "http://w1", speed=1.0)
+    register(controller, "http://w2", speed=3.0)
+    counts = dispatch(controller, 2000)
+    assert abs(counts["http://w2"] / 2000 - 0.75) < 0.05
+
+
+def telemetry(speed=10.0, outstanding_tokens=0, ttft=0.0, kv_cache_usage=0.0):
+    return {
+        "speed": speed,
+        "outstanding_tokens": outstanding_tokens,
+        "avg_request_tokens": 100,
+        "ttft": ttft,
+        "kv_cache_usage": kv_cache_usage,
+    }
+
+
+def test_least_outstanding_tokens():
+    controller = Controller("least_outstanding_tokens")
+    # 100 s and 300 s of work
+    register(controller, "http://w1", telemetry=telemetry(10.0, 1000))
+    register(controller, "http://w2", telemetry=telemetry(2.0, 600))
+    assert controller.get_worker_address("m") == "http://w1"
+
+    # The telemetry of the workers replaces the counted requests.
+    controller.receive_telemetry("http://w1", 4, telemetry(10.0, 5000))
+    assert controller.get_worker_address("m") == "http://w2"
+
+
+def test_full_kv_cache_is_avoided():
+    controller = Controller("least_outstanding_tokens")
+    register(
+        controller, "http://w1", telemetry=telemetry(10.0, 100, kv_cache_usage=0.98)
+    )
+    register(controller, "http://w2", telemetry=telemetry(10.0, 500))
+    assert controller.get_worker_address("m") == "http://w2"
+
+
+def test_ewma_latency():
+    controller = Controller("ewma_latency")
+    register(controller, "http://w1", telemetry=telemetry(ttft=0.1))
+    register(controller, "http://w2", telemetry=telemetry(ttft=1.0))
+    # The expected latency grows with the requests in flight.
+    assert dispatch(controller, 11) == {"http://w1": 10, "http://w2": 1}
+
+
+def test_new_worker_gets_the_speed_of_its_peers():
+    controller = Controller("lottery")
+    register(controller, "http://w1", telemetry=telemetry(30.0))
+    register(controller, "http://w2", speed=1.0, telemetry=telemetry(0.0))
+    assert controller.worker_info["http://w2"].speed == 30.0
+
+    controller.receive_telemetry("http://w2", 0, telemetry(20.0))
+    assert controller.model_workers["m"].speeds["http://w2"] == 20.0
+
+
+def make_affinity_controller(num_workers):
+    controller = Controller("affinity")
+    for i in range(num_workers):
+        register(controller, f"http://w{i}")
+    return controller
+
+
+def route_sessions(controller, keys):
+    """The worker of each session when the workers are idle."""
+    routes = {}
+    for key in keys:
+        routes[key] = controller.get_worker_address("m", affinity_key=key)
+        controller.receive_heart_beat(routes[key], 0)
+    return routes
+
+
+def test_sessions_stick_to_their_worker():
+    controller = make_affinity_controller(4)
+    keys = [f"user-{i}" for i in range(50)]
+    routes = route_sessions(controller, keys)
+    assert route_sessions(controller, keys) == routes
+    assert len(set(routes.values())) == 4
+
+    # Removing a worker only moves its own sessions.
+    controller.remove_worker("http://w0")
+    new_routes = route_sessions(controller, keys)
+    for key in keys:
+        if routes[key] != "http://w0":
+            assert new_routes[key] == routes[key]
+
+
+def test_hot_session_spills_over():
+    controller = make_affinity_controller(4)
+    counts = dispatch(controller, 8, affinity_key="user-0")
+    # A worker only gets a request while its load is under the load factor
+    # times the average load including that request.
+    assert len(counts) > 1
+    assert max(counts.values()) - 1 < 1.25 * 8 / 4
+
+
+class Chunks(httpx.AsyncByteStream):
+    """A response body that arrives in chunks, optionally breaking after them."""
+
+    def __init__(self, *chunks, error=None):
+        self.chunks = chunks
+        self.error = error
+
+    async def __aiter__(self):
+        for chunk in self.chunks:
+            yield chunk
+        if self.error is not None:
+            raise self.error
+
+
+def make_proxy(handler, num_workers=2, **kwargs):
+    """
+    A controller whose workers are answered by `handler(worker_name)`, which
+    returns the output of the worker or a response.
+    """
+
+    async def handle(request):
+        ret = await handler(f"http://{request.url.host}")
+        if isinstance(ret, httpx.Response):
+            return ret
+        body = json.dumps(ret).encode()
+        if request.url.path.endswith("_stream"):
+            body += b"\0"
+        return httpx.Response(200, stream=Chunks(body))
+
+    controller = Controller("shortest_queue", **kwargs)
+    controller.client = httpx.AsyncClient(transport=httpx.MockTransport(handle))
+    for i in range(num_workers):
+        register(controller, f"http://w{i}")
+    return controller
+
+
+def ok(worker_name):
+    return {"text": worker_name, "error_code": 0}
+
+
+def generate_stream(controller, params):
+    async def run():
+        return [
+            json.loads(chunk[:-1])
+            async for chunk in controller.worker_api_generate_stream(params)
+        ]
+
+    return asyncio.run(run())
+
+
+def test_failed_request_is_retried():
+    async def handler(worker_name):
+        if worker_name == "http://w0":
+            raise httpx.ConnectError("connection refused")
+        return ok(worker_name)
+
+    controller = make_proxy(handler)
+    params = {"model": "m", "worker_address": "http://w0"}
+    ret = asyncio.run(controller.worker_api_generate(params))
+    assert ret["text"] == "http://w1"
+    assert controller.breakers["http://w0"].num_failures == 1
+
+    outputs = generate_stream(controller, params)
+    assert [o["text"] for o in outputs] == ["http://w1"]
+
+
+def test_overloaded_worker_is_skipped():
+    async def handler(worker_name):
+        if worker_name == "http://w0":
+            return httpx.Response(
+                429, json={"text": "busy", "error_code": ErrorCode.ENGINE_OVERLOADED}
+            )
+        return ok(worker_name)
+
+    controller = make_proxy(handler)
+    params = {"model": "m", "worker_address": "http://w0"}
+    assert asyncio.run(controller.worker_api_generate(params))["text"] == "http://w1"
+    outputs = generate_stream(controller, params)
+    assert [o["text"] for o in outputs] == ["http://w1"]
+    # An overloaded worker is not a failed one.
+    assert "http://w0" not in controller.breakers
+
+
+def test_stream_is_not_retried_after_the_first_chunk():
+    async def handler(worker_name):
+        chunk = json.dumps(ok(worker_name)).encode() + b"\0"
+        return httpx.Response(
+            200, stream=Chunks(chunk, error=httpx.ReadError("connection lost"))
+        )
+
+    controller = make_proxy(handler)
+    outputs = generate_stream(controller, {"model": "m"})
+    assert outputs[0]["text"] == "http://w0"
+    assert outputs[1]["error_code"] == ErrorCode.CONTROLLER_WORKER_TIMEOUT
+    assert len(outputs) == 2
+
+
+def test_slow_request_is_hedged():
+    async def handler(worker_name):
+        if worker_name == "http://w0":
+            await asyncio.sleep(10)
+        return ok(worker_name)
+
+    controller = make_proxy(handler, hedge_delay=0.05)
+    params = {"model": "m", "worker_address": "http://w0"}
+    start = time.monotonic()
+    assert asyncio.run(controller.worker_api_generate(params))["text"] == "http://w1"
+    assert time.monotonic() - start < 5
+
+
+def test_all_workers_failing():
+    async def handler(worker_name):
+        raise httpx.ConnectError("connection refused")
+
+    controller = make_proxy(handler, num_workers=3, max_attempts=2)
+    ret = asyncio.run(controller.worker_api_generate({"model": "m"}))
+    assert ret["error_code"] == ErrorCode.CONTROLLER_WORKER_TIMEOUT
+    assert len(controller.breakers) == 2
+
+    ret = asyncio.run(controller.worker_api_generate({"model": "x"}))
+    assert ret["error_code"] == ErrorCode.CONTROLLER_NO_WORKER
+
+
+def test_circuit_breaker():
+    async def handler(worker_name):
+        return ok(worker_name)
+
+    controller = make_proxy(handler, breaker_failures=2, breaker_cooldown=0.1)
+    controller.record_failure("http://w0")
+    assert controller.is_available("http://w0")
+    controller.record_failure("http://w0")
+    # w0 is the least loaded worker but its breaker is open.
+    assert dispatch(controller, 3) == {"http://w1": 3}
+    ret = asyncio.run(
+        controller.worker_api_generate({"model": "m", "worker_address": "http://w0"})
+    )
+    assert ret["text"] == "http://w1"
+
+    time.sleep(0.1)
+    assert controller.get_worker_address("m") == "http://w0"
+    # One more failure opens it again.
+    controller.record_failure("http://w0")
+    assert not controller.is_available("http://w0")
+    controller.record_success("http://w0")
+    assert controller.is_available("http://w0")
+
+
+def channel_message(worker_name, queue_length, **kwargs):
+    msg = {
+        "worker_name": worker_name,
+        "queue_length": queue_length,
+        "telemetry": telemetry(**kwargs),
+    }
+    return json.dumps(msg).encode() + b"\n"
+
+
+def test_worker_channel_pushes_load():
+    controller = Controller("least_outstanding_tokens")
+    register(controller, "http://w0")
+    w_info = controller.worker_info["http://w0"]
+    seen = []
+
+    async def stream():
+        msg = channel_message("http://w0", 3, outstanding_tokens=300)
+        # A message may be split over chunks.
+        yield msg[:10]
+        yield msg[10:]
+        seen.append((w_info.queue_length, w_info.outstanding_tokens))
+        yield channel_message("http://w0", 1, outstanding_tokens=100)
+        seen.append((w_info.queue_length, w_info.outstanding_tokens))
+        assert controller.channels == {"http://w0": 1}
+
+    asyncio.run(controller.handle_worker_channel(stream()))
+    assert seen == [(3, 300), (1, 100)]
+    # A closed channel removes its worker right away.
+    assert controller.list_models() == []
+    assert controller.channels == {}
+
+
+def test_silent_worker_channel_times_out(monkeypatch):
+    monkeypatch.setattr(controller_module, "WORKER_CHANNEL_TIMEOUT", 0.05)
+    controller = Controller("shortest_queue")
+    register(controller, "http://w0")
+
+    async def stream():
+        yield channel_message("http://w0", 0)
+        await asyncio.sleep(10)
+
+    asyncio.run(asyncio.wait_for(controller.handle_worker_channel(stream()), 5))
+    assert controller.list_models() == []
+
+
+def test_unknown_worker_channel_is_closed():
+    controller = Controller("shortest_queue")
+    register(controller, "http://w0")
+
+    async def stream():
+        yield channel_message("http://w1", 0)
+        raise AssertionError("the channel of an unknown worker is not read")
+
+    asyncio.run(controller.handle_worker_channel(stream()))
+    assert controller.list_models() == ["m"]
+    assert controller.channels == {}
+
+
+def test_reconnected_worker_keeps_its_new_channel():
+    controller = Controller("shortest_queue")
+    register(controller, "http://w0")
+
+    async def run():
+        opened = asyncio.Event()
+        close_old = asyncio.Event()
+
+        async def old_stream():
+            yield channel_message("http://w0", 0)
+            opened.set()
+            await close_old.wait()
+
+        async def new_stream():
+            yield channel_message("http://w0", 0)
+            close_old.set()
+            await asyncio.sleep(0.1)
+            assert controller.list_models() == ["m"]
+
+        old = asyncio.create_task(controller.handle_worker_channel(old_stream()))
+        await opened.wait()
+        await controller.handle_worker_channel(new_stream())
+        await old
+
+    asyncio.run(run())
@@ -0,0 +1,66 @@
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import torch
+
+from fastchat.serve.embedding_batcher import EmbeddingBatcher
+
+
+class FakeEmbedder:
+    """Embeds a text as its length and records the batches."""
+
+    def __init__(self):
+        self.batches = []
+
+    def __call__(self, texts):
+        self.batches.append(list(texts))
+        if "bad" in texts:
+            raise ValueError("bad text")
+        embeddings = torch.tensor([[float(len(t)), 1.0] for t in texts])
+        return embeddings, [len(t) for t in texts]
+
+
+def test_concurrent_requests_share_a_batch():
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=4, max_wait=0.5)
+    requests = [["a"], ["bb", "ccc"], ["dddd"], ["eeeee"]]
+    with ThreadPoolExecutor(len(requests)) as executor:
+        results = list(executor.map(batcher.embed, requests))
+
+    for inputs, (embeddings, token_nums) in zip(requests, results):
+        assert token_nums == [len(t) for t in inputs]
+        assert embeddings[:, 0].tolist() == [float(len(t)) for t in inputs]
+    # No batch goes over max_batch_size, and a request is never split.
+    assert sum(len(b) for b in embedder.batches) == 5
+    assert len(embedder.batches) < len(requests)
+    assert all(len(b) <= 4 for b in embedder.batches)
+
+
+def test_cache_and_duplicates():
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_wait=0, cache_size=2)
+    embeddings, token_nums = batcher.embed(["a", "bb", "a"])
+    assert embedder.batches == [["a", "bb"]]
+    assert token_nums == [1, 2, 1]
+    assert torch.equal(embeddings[0], embeddings[2])
+
+    batcher.embed(["bb", "ccc"])
+    assert embedder.batches[-1] == ["ccc"]
+    assert (batcher.cache.hits, batcher.cache.misses) == (1, 4)
+    # "a" is the least recently used one.
+    batcher.embed(["a"])
+    assert embedder.batches[-1] == ["a"]
+
+
+def test_error_fails_the_requests_of_its_batch():
+    embedder = FakeEmbedder()
+    batcher = EmbeddingBatcher(embedder, max_batch_size=8, max_wait=0.5)
+    with ThreadPoolExecutor(2) as executor:
+        futures = [executor.submit(batcher.embed, [t]) for t in ["bad", "good"]]
+        for future in futures:
+            with pytest.raises(ValueError):
+                future.result()
+    assert [sorted(b) for b in embedder.batches] == [["bad", "good"]]
+
+    # The batching thread keeps running.
+    assert batcher.embed(["ok"])[1] == [2]
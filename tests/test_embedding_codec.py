@@ -0,0 +1,65 @@
+import base64
+
+import numpy as np
+import pytest
+
+from fastchat.serve.embedding_codec import (
+    EMBEDDING_DTYPES,
+    decode_embeddings,
+    embeddings_to_base64,
+    encode_embeddings,
+    is_binary_embeddings,
+)
+
+
+def normalized(rows, dim):
+    embeddings = np.random.default_rng(0).standard_normal((rows, dim))
+    return (embeddings / np.linalg.norm(embeddings, axis=1, keepdims=True)).astype(
+        np.float32
+    )
+
+
+@pytest.mark.parametrize("dtype,tol", [("float32", 0), ("float16", 1e-3)])
+def test_float_round_trip(dtype, tol):
+    embeddings = normalized(3, 16)
+    data = encode_embeddings(embeddings, token_num=42, dtype=dtype)
+    assert is_binary_embeddings(data)
+
+    decoded, token_num = decode_embeddings(data)
+    assert token_num == 42
+    assert decoded.dtype == EMBEDDING_DTYPES[dtype]
+    assert decoded.shape == (3, 16)
+    assert np.abs(decoded.astype(np.float32) - embeddings).max() <= tol
+
+
+def test_int8_round_trip():
+    embeddings = normalized(2, 8)
+    decoded, _ = decode_embeddings(encode_embeddings(embeddings, 1, "int8"))
+    assert decoded.dtype == np.int8
+    assert np.abs(decoded / 127 - embeddings).max() <= 0.5 / 127 + 1e-6
+
+
+def test_empty_embeddings():
+    decoded, token_num = decode_embeddings(
+        encode_embeddings(np.zeros((0, 4), np.float32), 0)
+    )
+    assert decoded.shape == (0, 4) and token_num == 0
+
+
+def test_unsupported_dtype():
+    with pytest.raises(ValueError):
+        encode_embeddings(normalized(1, 4), 1, "int4")
+
+
+def test_json_is_not_binary():
+    assert not is_binary_embeddings(b'{"embedding": [[0.1]], "token_num": 1}')
+
+
+def test_base64_rows():
+    embeddings = normalized(2, 5)
+    encoded = embeddings_to_base64(embeddings)
+    assert len(encoded) == 2
+    for row, s in zip(embeddings, encoded):
+        np.testing.assert_array_equal(
+            np.frombuffer(base64.b64decode(s), dtype=np.float32), row
+        )
@@ -0,0 +1,100 @@
+import random
+from types import SimpleNamespace
+
+import torch
+import torch.nn.functional as F
+
+from fastchat.serve.model_worker import ModelWorker
+
+
+class TokenTableModel(torch.nn.Module):
+    """
+    A model whose hidden state of a token only depends on the token, so the
+    mean pooled embedding of a text does not depend on its batch or padding.
+    """
+
+    def __init__(self):
+        super().__init__()
+        generator = torch.Generator().manual_seed(0)
+        self.table = torch.randn(100, 8, generator=generator)
+        self.input_shapes = []
+
+    def forward(self, input_ids, output_hidden_states=False):
+        self.input_shapes.append(tuple(input_ids.shape))
+        return SimpleNamespace(hidden_states=[self.table[input_ids]])
+
+
+class NumberTokenizer:
+    pad_token_id = 0
+
+    def batch_encode_plus(self, texts, truncation=None, max_length=None):
+        input_ids = [[int(x) for x in text.split()] for text in texts]
+        if truncation:
+            input_ids = [ids[:max_length] for ids in input_ids]
+        return {"input_ids": input_ids}
+
+
+def make_worker(context_len, embed_batch_size, embed_batch_tokens, truncate=False):
+    # Only the attributes used by the embedding path
+    worker = ModelWorker.__new__(ModelWorker)
+    worker.model = TokenTableModel()
+    worker.tokenizer = NumberTokenizer()
+    worker.device = "cpu"
+    worker.context_len = context_len
+    worker.embed_in_truncate = truncate
+    worker.embed_batch_size = embed_batch_size
+    worker.embed_batch_tokens = embed_batch_tokens
+    return worker
+
+
+def embed(worker, texts):
+    return worker._ModelWorker__embed_batch(texts)
+
+
+def expected_embedding(worker, text):
+    ids = [int(x) for x in text.split()]
+    return F.normalize(worker.model.table[ids].mean(dim=0), dim=0)
+
+
+def make_text(length):
+    return " ".join(str(random.randint(1, 99)) for _ in range(length))
+
+
+def test_buckets_keep_the_input_order():
+    random.seed(0)
+    worker = make_worker(context_len=16, embed_batch_size=4, embed_batch_tokens=24)
+    texts = [make_text(length) for length in [7, 1, 12, 3, 3, 9, 2, 5, 1]]
+    embeddings, token_nums = embed(worker, texts)
+
+    assert token_nums == [len(text.split()) for text in texts]
+    for text, embedding in zip(texts, embeddings):
+        assert torch.allclose(embedding, expected_embedding(worker, text), atol=1e-6)
+    for rows, cols in worker.model.input_shapes:
+        assert rows <= 4
+        assert rows * cols <= 24
+    # Sorted by length, [1, 1, 2, 3], [3, 5, 7] and [9, 12] fill the buckets.
+    assert worker.model.input_shapes == [(4, 3), (3, 7), (2, 12)]
+
+
+def test_long_texts_are_split_at_context_len():
+    random.seed(0)
+    worker = make_worker(context_len=4, embed_batch_size=8, embed_batch_tokens=64)
+    texts = [make_text(10), make_text(2)]
+    embeddings, token_nums = embed(worker, texts)
+
+    assert token_nums == [10, 2]
+    for text, embedding in zip(texts, embeddings):
+        assert torch.allclose(embedding, expected_embedding(worker, text), atol=1e-6)
+    # The later chunks only run on the text that reaches into them.
+    assert worker.model.input_shapes == [(2, 4), (1, 4), (1, 2)]
+
+
+def test_truncated_texts():
+    random.seed(0)
+    worker = make_worker(4, 8, 64, truncate=True)
+    text = make_text(10)
+    embeddings, token_nums = embed(worker, [text])
+
+    assert token_nums == [4]
+    expected = expected_embedding(worker, " ".join(text.split()[:4]))
+    assert torch.allclose(embeddings[0], expected, atol=1e-6)
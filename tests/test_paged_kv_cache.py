@@ -0,0 +1,221 @@
+import threading
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from fastchat.serve.inference import generate_stream
+from fastchat.serve.paged_kv_cache import PagedKVCache
+
+# A block of 4 positions of 2 layers of 1 head of dimension 1 in float32
+BLOCK_BYTES = 4 * 2 * 2 * 4
+
+
+def make_kv(start, length, num_layers=2):
+    t = torch.arange(start, start + length, dtype=torch.float32).view(1, 1, -1, 1)
+    return tuple((t.clone(), -t) for _ in range(num_layers))
+
+
+def assert_kv_equal(actual, expected):
+    assert len(actual) == len(expected)
+    for (k1, v1), (k2, v2) in zip(actual, expected):
+        assert torch.equal(k1, k2)
+        assert torch.equal(v1, v2)
+
+
+def test_store_and_load():
+    cache = PagedKVCache(4 * BLOCK_BYTES, block_size=4)
+    seq = cache.add_sequence()
+    assert seq.load() is None
+
+    seq.store(make_kv(0, 6))
+    assert cache.get_status()["num_free_blocks"] == 2
+    assert_kv_equal(seq.load(), make_kv(0, 6))
+
+    # The next step appends positions to the last block and a new one.
+    seq.store(make_kv(0, 9))
+    assert cache.get_status()["num_free_blocks"] == 1
+    assert_kv_equal(seq.load(), make_kv(0, 9))
+    seq.store(make_kv(0, 9))
+
+    seq.free()
+    status = cache.get_status()
+    assert status["num_free_blocks"] == status["num_blocks"] == 4
+    assert status["num_sequences"] == 0
+
+
+def test_preempt_swaps_out_least_recently_used():
+    cache = PagedKVCache(4 * BLOCK_BYTES, block_size=4, max_swap_bytes=1 << 20)
+    a, b, c = cache.add_sequence(), cache.add_sequence(), cache.add_sequence()
+    a.store(make_kv(0, 8))
+    b.store(make_kv(100, 8))
+    # The pool is full, so a is swapped out to make room for c.
+    c.store(make_kv(200, 8))
+    status = cache.get_status()
+    assert status["num_swapped"] == 1
+    assert status["num_swap_outs"] == 1
+
+    # Swapping a back in preempts b, the least recently used one now.
+    assert_kv_equal(a.load(), make_kv(0, 8))
+    a.store(make_kv(0, 8))
+    assert b.seq_id in cache.swapped
+    assert_kv_equal(b.load(), make_kv(100, 8))
+    b.store(make_kv(100, 8))
+    assert_kv_equal(c.load(), make_kv(200, 8))
+    c.store(make_kv(200, 8))
+
+
+def test_preempt_without_swap_space_recomputes():
+    cache = PagedKVCache(4 * BLOCK_BYTES, block_size=4, max_swap_bytes=0)
+    a, b = cache.add_sequence(), cache.add_sequence()
+    a.store(make_kv(0, 8))
+    b.store(make_kv(100, 12))
+
+    assert cache.get_status()["num_recomputes"] == 1
+    # The KV cache of a was dropped and must be recomputed from its tokens.
+    assert a.load() is None
+    a.store(make_kv(0, 4))
+    assert_kv_equal(a.load(), make_kv(0, 4))
+    a.store(make_kv(0, 4))
+
+
+def test_step_writes_only_new_positions():
+    cache = PagedKVCache(4 * BLOCK_BYTES, block_size=4)
+    seq = cache.add_sequence()
+    seq.store(make_kv(0, 6))
+    # The cache returned by the step is loaded as is, without a gather.
+    seq.load()
+    kv = make_kv(0, 7)
+    seq.store(kv)
+    assert seq.load()[0][0] is kv[0][0]
+
+    # The positions already in the blocks are not written again.
+    changed = tuple((k + 100, v + 100) for k, v in make_kv(0, 8))
+    seq.store(changed)
+    cache.running_caches.clear()
+    expected = make_kv(0, 8)
+    loaded = seq.load()
+    assert torch.equal(loaded[0][0][..., :7, :], expected[0][0][..., :7, :])
+    assert loaded[0][0][0, 0, 7, 0] == 107
+
+
+def test_load_stops_waiting():
+    cache = PagedKVCache(
+        2 * BLOCK_BYTES, block_size=4, max_swap_bytes=1 << 20, max_wait_time=0.1
+    )
+    a, b = cache.add_sequence(), cache.add_sequence()
+    a.store(make_kv(0, 8))
+    a.load()
+    # a is running, so b is swapped out right away.
+    b.store(make_kv(100, 8))
+    assert b.seq_id in cache.swapped
+
+    cancel_event = threading.Event()
+    cancel_event.set()
+    assert b.load(cancel_event) is None
+    with pytest.raises(RuntimeError):
+        b.load()
+
+
+def test_oom_preemption():
+    cache = PagedKVCache(4 * BLOCK_BYTES, block_size=4, max_swap_bytes=1 << 20)
+    a, b = cache.add_sequence(), cache.add_sequence()
+    a.store(make_kv(0, 4))
+    b.store(make_kv(100, 4))
+
+    # The contiguous copy of the idle sequence b is dropped first.
+    a.load()
+    assert a.preempt()
+    assert cache.get_status()["num_running_caches"] == 1
+    assert_kv_equal(b.load(), make_kv(100, 4))
+
+    # With b running, a is swapped out and waits for b to finish its step.
+    assert a.preempt()
+    assert a.seq_id in cache.swapped
+    loaded = []
+    thread = threading.Thread(target=lambda: loaded.append(a.load()))
+    thread.start()
+    thread.join(timeout=0.2)
+    assert loaded == []
+    b.store(make_kv(100, 5))
+    thread.join(timeout=5)
+    assert_kv_equal(loaded[0], make_kv(0, 4))
+
+
+def test_oom_of_a_single_sequence():
+    cache = PagedKVCache(4 * BLOCK_BYTES, block_size=4)
+    seq = cache.add_sequence()
+    seq.store(make_kv(0, 4))
+    seq.load()
+    assert not seq.preempt()
+
+
+class CountingModel:
+    """A one layer model whose next token is the length of its KV cache."""
+
+    config = SimpleNamespace(is_encoder_decoder=False)
+
+    def __init__(self, oom_call=None):
+        self.oom_call = oom_call
+        self.num_calls = 0
+
+    def __call__(self, input_ids, use_cache=True, past_key_values=None):
+        self.num_calls += 1
+        if self.num_calls == self.oom_call:
+            raise torch.cuda.OutOfMemoryError("CUDA out of memory.")
+        keys = torch.ones(1, 1, input_ids.shape[1], 1)
+        if past_key_values is not None:
+            keys = torch.cat([past_key_values[0][0], keys], dim=-2)
+        logits = torch.zeros(1, input_ids.shape[1], 64)
+        logits[0, -1, keys.shape[2]] = 1.0
+        return SimpleNamespace(logits=logits, past_key_values=((keys, keys),))
+
+
+class NumberTokenizer:
+    eos_token_id = 63
+
+    def __call__(self, prompt):
+        return SimpleNamespace(input_ids=[int(x) for x in prompt.split()])
+
+    def decode(self, token_ids, **kwargs):
+        return " ".join(str(int(i)) for i in token_ids)
+
+
+def run_generate_stream(model, cache):
+    params = {"prompt": "1 1 1", "temperature": 0.0, "max_new_tokens": 5}
+    params["echo"] = False
+    outputs = generate_stream(
+        model, NumberTokenizer(), params, "cpu", 64, stream_interval=1, kv_cache=cache
+    )
+    return list(outputs)[-1]
+
+
+def test_generate_stream_recovers_from_oom():
+    cache = PagedKVCache(1 << 20, block_size=4)
+    idle = cache.add_sequence()
+    idle.store(((torch.ones(1, 1, 6, 1), torch.ones(1, 1, 6, 1)),))
+
+    output = run_generate_stream(CountingModel(oom_call=3), cache)
+    assert output["text"] == "3 4 5 6 7"
+    assert cache.get_status()["num_sequences"] == 1
+    assert torch.equal(idle.load()[0][0], torch.ones(1, 1, 6, 1))
+
+
+def test_generate_stream_oom_without_other_sequences():
+    cache = PagedKVCache(1 << 20, block_size=4)
+    with pytest.raises(torch.cuda.OutOfMemoryError):
+        run_generate_stream(CountingModel(oom_call=3), cache)
+    assert cache.get_status()["num_sequences"] == 0
+
+
+def test_closed_generate_stream_frees_its_blocks():
+    cache = PagedKVCache(1 << 20, block_size=4)
+    params = {"prompt": "1 1 1", "temperature": 0.0, "max_new_tokens": 5}
+    params["echo"] = False
+    outputs = generate_stream(
+        CountingModel(), NumberTokenizer(), params, "cpu", 64, 1, kv_cache=cache
+    )
+    assert next(outputs)["text"] == "3"
+    assert cache.get_status()["num_sequences"] == 1
+    outputs.close()
+    assert cache.get_status()["num_sequences"] == 0
@@ -0,0 +1,89 @@
+from types import SimpleNamespace
+
+import torch
+
+from fastchat.serve.parallel_sampling import generate_stream_parallel
+
+VOCAB_SIZE = 8
+
+
+class BigramModel:
+    """A model whose logits only depend on the last token."""
+
+    config = SimpleNamespace(is_encoder_decoder=False)
+
+    def __init__(self):
+        generator = torch.Generator().manual_seed(0)
+        self.table = 2.0 * torch.randn(VOCAB_SIZE, VOCAB_SIZE, generator=generator)
+
+    def __call__(self, input_ids, past_key_values=None, use_cache=True):
+        keys = input_ids[:, None, :, None].float()
+        if past_key_values is not None:
+            keys = torch.cat([past_key_values[0][0], keys], dim=-2)
+        return SimpleNamespace(
+            logits=self.table[input_ids], past_key_values=((keys, keys),)
+        )
+
+
+class NumberTokenizer:
+    # Never sampled, so the generations run to max_new_tokens.
+    eos_token_id = VOCAB_SIZE
+
+    def __call__(self, prompt):
+        return SimpleNamespace(input_ids=[int(x) for x in prompt.split()])
+
+    def decode(self, token_ids, **kwargs):
+        if isinstance(token_ids, int):
+            token_ids = [token_ids]
+        return " ".join(str(int(i)) for i in token_ids)
+
+
+def run(**kwargs):
+    params = {
+        "prompt": "1 2 3",
+        "temperature": 1.0,
+        "max_new_tokens": 6,
+        "echo": False,
+        "seed": 7,
+        **kwargs,
+    }
+    return list(
+        generate_stream_parallel(
+            BigramModel(), NumberTokenizer(), params, "cpu", 64, stream_interval=1
+        )
+    )
+
+
+def final_outputs(outputs):
+    return {o["index"]: o for o in outputs if o["finish_reason"] is not None}
+
+
+def test_choices_do_not_depend_on_each_other():
+    outputs = final_outputs(run(n=3))
+    assert sorted(outputs) == [0, 1, 2]
+    for index, output in outputs.items():
+        assert output["finish_reason"] == "length"
+        alone = final_outputs(run(seed=7 + index))[0]
+        assert output["text"] == alone["text"]
+
+    # Every output has the usage of the whole request.
+    assert outputs[2]["usage"]["completion_tokens"] == 18
+    assert outputs[2]["usage"]["prompt_tokens"] == 3
+
+
+def test_best_of_returns_the_best_choices():
+    sampled = final_outputs(run(n=4, logprobs=0))
+
+    def score(output):
+        logprobs = output["logprobs"]["token_logprobs"]
+        return sum(logprobs) / len(logprobs)
+
+    best = sorted(sampled.values(), key=score, reverse=True)[:2]
+    assert len({o["text"] for o in sampled.values()}) > 1
+
+    outputs = run(n=2, best_of=4)
+    # Nothing is streamed before all choices are ranked.
+    assert all(o["finish_reason"] is not None for o in outputs)
+    assert [o["index"] for o in outputs] == [0, 1]
+    assert [o["text"] for o in outputs] == [o["text"] for o in best]
+    assert outputs[-1]["usage"]["completion_tokens"] == 24
@@ -0,0 +1,75 @@
+import torch
+
+from fastchat.serve.prefix_cache import PrefixCache
+
+
+def make_kv(token_ids, num_layers=2):
+    """A KV cache whose values are the token ids, to check what is returned."""
+    t = torch.tensor(token_ids, dtype=torch.float32).view(1, 1, -1, 1)
+    return tuple((t.clone(), t.clone()) for _ in range(num_layers))
+
+
+def test_lookup_longest_prefix():
+    cache = PrefixCache(1 << 20, block_size=4)
+    cache.insert(list(range(12)), make_kv(range(12)))
+
+    match_len, kv = cache.lookup(list(range(10)) + [99, 98])
+    assert match_len == 10
+    assert kv[0][0].flatten().tolist() == list(range(10))
+
+    # Shorter than one block
+    assert cache.lookup([0, 1, 2]) == (0, None)
+    # Different first block
+    assert cache.lookup([7] + list(range(1, 12))) == (0, None)
+
+
+def test_lookup_leaves_last_token():
+    cache = PrefixCache(1 << 20, block_size=4)
+    cache.insert(list(range(8)), make_kv(range(8)))
+    match_len, _ = cache.lookup(list(range(8)))
+    assert match_len == 7
+
+
+def test_insert_replaces_extended_entry():
+    cache = PrefixCache(1 << 20, block_size=4)
+    cache.insert(list(range(8)), make_kv(range(8)))
+    cache.insert(list(range(12)), make_kv(range(12)))
+    assert cache.get_status()["num_entries"] == 1
+    assert cache.lookup(list(range(12)) + [0])[0] == 12
+
+
+def test_lru_eviction():
+    kv_bytes = sum(
+        t.numel() * t.element_size() for layer in make_kv(range(8)) for t in layer
+    )
+    cache = PrefixCache(2 * kv_bytes, block_size=4)
+    a, b, c = [[i] * 8 for i in (1, 2, 3)]
+    cache.insert(a, make_kv(a))
+    cache.insert(b, make_kv(b))
+    # Touch a, so that b is the least recently used entry.
+    assert cache.lookup(a + [0])[0] == 8
+    cache.insert(c, make_kv(c))
+
+    assert cache.get_status()["num_entries"] == 2
+    assert cache.get_status()["num_bytes"] <= 2 * kv_bytes
+    assert cache.lookup(a + [0])[0] == 8
+    assert cache.lookup(b + [0])[0] == 0
+    assert cache.lookup(c + [0])[0] == 8
+
+
+def test_eviction_keeps_shared_blocks():
+    cache = PrefixCache(1 << 20, block_size=4)
+    first = list(range(8))
+    second = list(range(4)) + [50, 51, 52, 53]
+    cache.insert(first, make_kv(first))
+    cache.insert(second, make_kv(second))
+
+    # Evict the newest entry, which also indexed the shared first block.
+    cache._remove(next(reversed(cache.entries)))
+    match_len, kv = cache.lookup(list(range(4)) + [60, 61])
+    assert match_len == 4
+    assert kv[0][0].flatten().tolist() == list(range(4))
+    assert cache.lookup(first + [0])[0] == 8
+
+    cache._remove(next(iter(cache.entries)))
+    assert cache.block_index == {}
@@ -0,0 +1,95 @@
+import asyncio
+import time
+
+from fastchat.protocol.openai_api_protocol import (
+    ChatCompletionRequest,
+    CompletionRequest,
+)
+from fastchat.serve.response_cache import ResponseCache, get_response_cache_key
+
+
+def chat_request(**kwargs):
+    return ChatCompletionRequest(
+        model="m", messages=[{"role": "user", "content": "Hi"}], **kwargs
+    )
+
+
+def test_key_of_greedy_requests():
+    key = get_response_cache_key("chat", chat_request(temperature=0))
+    assert key is not None
+    # Sampling parameters that do not change a greedy output and `stream`
+    assert (
+        get_response_cache_key(
+            "chat", chat_request(temperature=0, top_p=0.5, seed=3, stream=True)
+        )
+        == key
+    )
+    assert get_response_cache_key("chat", chat_request(top_k=1)) is not None
+
+    # Parameters that change the output
+    assert (
+        get_response_cache_key("chat", chat_request(temperature=0, max_tokens=8)) != key
+    )
+    assert get_response_cache_key("completions", chat_request(temperature=0)) != key
+
+
+def test_no_key_when_sampling():
+    assert get_response_cache_key("chat", chat_request()) is None
+    assert get_response_cache_key("chat", chat_request(temperature=0.7)) is None
+
+
+def test_normalized_messages():
+    text = chat_request(temperature=0)
+    parts = ChatCompletionRequest(
+        model="m",
+        messages=[{"role": "user", "content": [{"type": "text", "text": "Hi"}]}],
+        temperature=0,
+    )
+    assert get_response_cache_key("chat", text) == get_response_cache_key("chat", parts)
+
+    stop_str = CompletionRequest(model="m", prompt="a", temperature=0, stop="\n")
+    stop_list = CompletionRequest(model="m", prompt="a", temperature=0, stop=["\n"])
+    assert get_response_cache_key("cmpl", stop_str) == get_response_cache_key(
+        "cmpl", stop_list
+    )
+
+
+def test_memory_lru():
+    async def run():
+        cache = ResponseCache(max_size=2)
+        await cache.put("a", {"v": 1})
+        await cache.put("b", {"v": 2})
+        assert await cache.get("a") == {"v": 1}
+        await cache.put("c", {"v": 3})
+        assert await cache.get("b") is None
+        assert await cache.get("a") == {"v": 1}
+        assert await cache.get("c") == {"v": 3}
+        assert (cache.hits, cache.misses) == (3, 1)
+
+    asyncio.run(run())
+
+
+def test_database_survives_restart(tmp_path):
+    db_path = str(tmp_path / "cache.db")
+
+    async def run():
+        cache = ResponseCache(max_size=0, db_path=db_path)
+        await cache.put("a", {"v": 1})
+        restarted = ResponseCache(max_size=10, db_path=db_path)
+        assert await restarted.get("a") == {"v": 1}
+        # Promoted to the memory tier
+        assert "a" in restarted.entries
+
+    asyncio.run(run())
+
+
+def test_ttl(tmp_path):
+    async def run():
+        cache = ResponseCache(max_size=10, db_path=str(tmp_path / "c.db"), ttl=0.05)
+        await cache.put("a", {"v": 1})
+        assert await cache.get("a") == {"v": 1}
+        time.sleep(0.1)
+        assert await cache.get("a") is None
+        assert "a" not in cache.entries
+
+    asyncio.run(run())
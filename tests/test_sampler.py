@@ -0,0 +1,62 @@
+import math
+
+import torch
+
+from fastchat.serve.sampler import SamplingParams, process_logits, sample
+
+
+def test_greedy_is_argmax():
+    logits = torch.tensor([[0.1, 2.0, 0.3], [5.0, 1.0, 4.0]])
+    params = [SamplingParams(temperature=0.0), SamplingParams(top_k=1)]
+    assert sample(logits, params).tokens == [1, 0]
+
+
+def test_top_k_and_top_p_mask():
+    logits = torch.log(torch.tensor([[0.5, 0.3, 0.15, 0.05]]))
+    scores = process_logits(logits, [SamplingParams(top_k=2)])
+    assert torch.isinf(scores[0, 2:]).all() and torch.isfinite(scores[0, :2]).all()
+
+    # The first two tokens cover 0.8 >= top_p, so the others are removed.
+    scores = process_logits(logits, [SamplingParams(top_p=0.7)])
+    assert torch.isfinite(scores[0, :2]).all() and torch.isinf(scores[0, 2:]).all()
+
+
+def test_repetition_penalty():
+    logits = torch.tensor([[2.0, -2.0, 1.0]])
+    scores = process_logits(logits, [SamplingParams(repetition_penalty=2.0)], [[0, 1]])
+    assert scores.tolist() == [[1.0, -4.0, 1.0]]
+
+
+def test_seeded_rows_do_not_depend_on_batch():
+    torch.manual_seed(0)
+    logits = torch.randn(1, 50)
+
+    def draw(batch_size):
+        params = [SamplingParams(seed=7)] + [
+            SamplingParams() for _ in range(batch_size - 1)
+        ]
+        batch = logits.repeat(batch_size, 1)
+        return [sample(batch, params).tokens[0] for _ in range(10)]
+
+    assert draw(1) == draw(4)
+
+
+def test_samples_follow_distribution():
+    probs = torch.tensor([0.7, 0.2, 0.1])
+    logits = torch.log(probs).repeat(4000, 1)
+    tokens = sample(logits, [SamplingParams() for _ in range(4000)]).tokens
+    freqs = [tokens.count(i) / len(tokens) for i in range(3)]
+    for freq, prob in zip(freqs, probs.tolist()):
+        assert abs(freq - prob) < 0.05
+
+
+def test_logprobs():
+    logits = torch.tensor([[1.0, 2.0, 3.0]])
+    output = sample(logits, [SamplingParams(temperature=0.0, logprobs=2)])
+    log_z = math.log(sum(math.exp(x) for x in (1.0, 2.0, 3.0)))
+    assert output.tokens == [2]
+    assert abs(output.logprobs[0] - (3.0 - log_z)) < 1e-5
+    assert list(output.top_logprobs[0]) == [2, 1]
+
+    output = sample(logits, [SamplingParams(temperature=0.0)])
+    assert output.logprobs == [None] and output.top_logprobs == [None]
@@ -0,0 +1,107 @@
+from types import SimpleNamespace
+
+import pytest
+import torch
+
+from fastchat.protocol.openai_api_protocol import UsageInfo
+from fastchat.serve.speculative_decoding import generate_stream_speculative
+
+VOCAB_SIZE = 50
+
+
+class PrefixSumModel:
+    """
+    A model whose next token is the sum of all tokens so far plus one. The
+    tokens are read back from its KV cache, so a cache that is not cropped to
+    the accepted tokens produces wrong tokens.
+
+    :param disagree: The prefix lengths at which a draft model adds one more.
+    """
+
+    def __init__(self, disagree=lambda length: False):
+        self.config = SimpleNamespace(vocab_size=VOCAB_SIZE, is_encoder_decoder=False)
+        self.device = torch.device("cpu")
+        self.disagree = disagree
+
+    def __call__(self, input_ids, past_key_values=None, use_cache=True):
+        tokens = input_ids[0].float()
+        past = torch.zeros(0)
+        if past_key_values is not None:
+            past = past_key_values[0][0].flatten()
+        keys = torch.cat([past, tokens])
+        sums = torch.cumsum(keys, dim=0)[len(past) :]
+        logits = torch.zeros(1, len(tokens), VOCAB_SIZE)
+        for pos, s in enumerate(sums.tolist()):
+            length = len(past) + pos + 1
+            token = int(s) + 1 + int(self.disagree(length))
+            logits[0, pos, token % VOCAB_SIZE] = 1.0
+        cache = keys.view(1, 1, -1, 1)
+        return SimpleNamespace(logits=logits, past_key_values=((cache, cache),))
+
+
+class NumberTokenizer:
+    # Never sampled, so the generations run to max_new_tokens.
+    eos_token_id = VOCAB_SIZE
+
+    def __call__(self, prompt):
+        return SimpleNamespace(input_ids=[int(x) for x in prompt.split()])
+
+    def decode(self, token_ids, **kwargs):
+        return " ".join(str(int(i)) for i in token_ids)
+
+
+def target_tokens(prompt_ids, max_new_tokens):
+    ids = list(prompt_ids)
+    for _ in range(max_new_tokens):
+        ids.append((sum(ids) + 1) % VOCAB_SIZE)
+    return ids[len(prompt_ids) :]
+
+
+def run(draft_model, max_new_tokens=12, num_speculative_tokens=4):
+    params = {
+        "prompt": "1 2 3",
+        "temperature": 0.0,
+        "max_new_tokens": max_new_tokens,
+        "echo": False,
+    }
+    outputs = generate_stream_speculative(
+        PrefixSumModel(),
+        NumberTokenizer(),
+        params,
+        "cpu",
+        context_len=64,
+        stream_interval=1,
+        draft_model=draft_model,
+        num_speculative_tokens=num_speculative_tokens,
+    )
+    return list(outputs)[-1]
+
+
+@pytest.mark.parametrize(
+    "disagree,acceptance_rate",
+    [
+        (lambda length: False, 1.0),
+        (lambda length: True, 0.0),
+        (lambda length: length % 3 == 0, None),
+    ],
+)
+def test_output_follows_target_model(disagree, acceptance_rate):
+    output = run(PrefixSumModel(disagree))
+    expected = " ".join(str(t) for t in target_tokens([1, 2, 3], 12))
+    assert output["text"] == expected
+    assert output["finish_reason"] == "length"
+
+    rate = output["usage"]["acceptance_rate"]
+    if acceptance_rate is None:
+        assert 0.0 < rate < 1.0
+    else:
+        assert rate == acceptance_rate
+
+
+def test_usage_omits_unset_acceptance_rate():
+    usage = UsageInfo(prompt_tokens=3, completion_tokens=2, total_tokens=5)
+    assert "acceptance_rate" not in usage.dict()
+    assert "acceptance_rate" not in usage.json()
+
+    usage.acceptance_rate = 0.5
+    assert usage.dict()["acceptance_rate"] == 0.5
@@ -0,0 +1,93 @@
+from fastchat.utils import StopStringMatcher, StreamDelta
+
+
+def stream_until_stop(matcher, chunks):
+    """Feed a growing text chunk by chunk like generate_stream does."""
+    text = ""
+    for chunk in chunks:
+        text += chunk
+        pos, partial_len = matcher.update(text)
+        if pos != -1:
+            return text[:pos], 0
+    return text, partial_len
+
+
+def test_stop_string_across_chunks():
+    matcher = StopStringMatcher(["</s>", "###"])
+    assert stream_until_stop(matcher, ["Hello <", "/", "s> world"]) == ("Hello ", 0)
+
+    matcher = StopStringMatcher("###")
+    assert stream_until_stop(matcher, ["a#", "#", "#b"]) == ("a", 0)
+
+
+def test_partial_stop_string():
+    matcher = StopStringMatcher(["USER:"])
+    assert matcher.update("Hi US") == (-1, 2)
+    # The partial match fails, nothing is held back anymore.
+    assert matcher.update("Hi USA") == (-1, 0)
+    assert matcher.update("Hi USA USER") == (-1, 4)
+    assert matcher.update("Hi USA USER: x") == (7, 0)
+
+
+def test_first_stop_string_wins():
+    matcher = StopStringMatcher(["bc", "abcd"])
+    assert matcher.update("xabcd") == (2, 0)
+
+    matcher = StopStringMatcher(["world", "o w"])
+    assert matcher.update("hello world") == (4, 0)
+
+
+def test_stop_string_after_start():
+    # The echoed prompt is not scanned.
+    matcher = StopStringMatcher(["stop"], start=10)
+    assert matcher.update("please stop") == (-1, 0)
+    assert matcher.update("please stop, now stop") == (17, 0)
+
+
+def test_shorter_text_restarts():
+    matcher = StopStringMatcher(["ab"])
+    assert matcher.update("xxa") == (-1, 1)
+    assert matcher.update("ab") == (0, 0)
+
+
+def test_no_stop_strings():
+    assert StopStringMatcher(None).update("anything") == (-1, 0)
+
+
+def test_stream_delta():
+    delta = StreamDelta()
+    assert delta.update({"text": "Hel", "error_code": 0}) == {
+        "text": "Hel",
+        "error_code": 0,
+    }
+    assert delta.update({"text": "Hello"})["text"] == "lo"
+    # An incomplete UTF-8 sequence is held back until it is complete.
+    assert delta.update({"text": "Hello �"})["text"] == " "
+    assert delta.update({"text": "Hello é"})["text"] == "é"
+    # A text that gets shorter yields nothing.
+    assert delta.update({"text": "Hello"})["text"] == ""
+
+
+def test_stream_delta_keeps_complete_replacement_characters():
+    delta = StreamDelta()
+    # Only a trailing replacement character can be an incomplete sequence.
+    assert delta.update({"text": "a\ufffdb\ufffd"})["text"] == "a\ufffdb"
+    assert delta.update({"text": "a\ufffdbc"})["text"] == "c"
+    # The last output sends everything.
+    ret = delta.update({"text": "a\ufffdbc\ufffd", "finish_reason": "stop"})
+    assert ret["text"] == "\ufffd"
+
+
+def test_stream_delta_logprobs():
+    delta = StreamDelta()
+    ret = delta.update(
+        {"text": "ab", "logprobs": {"tokens": ["a", "b"], "token_logprobs": [-1, -2]}}
+    )
+    assert ret["logprobs"]["tokens"] == ["a", "b"]
+    ret = delta.update(
+        {
+            "text": "abc",
+            "logprobs": {"tokens": ["a", "b", "c"], "token_logprobs": [-1, -2, -3]},
+        }
+    )
+    assert ret["logprobs"] == {"tokens": ["c"], "token_logprobs": [-3]}